@@ -1,9 +1,9 @@
 # Infrastructure:
-from fairpyx.instances import Instance
+from fairpyx.instances import Instance, ArrayInstance
 from fairpyx.allocations import AllocationBuilder, validate_allocation, allocation_is_fractional, rounded_allocation
 from fairpyx.satisfaction import AgentBundleValueMatrix
 from fairpyx.explanations import ExplanationLogger, ConsoleExplanationLogger, StringsExplanationLogger, FilesExplanationLogger
-from fairpyx.adaptors import divide
+from fairpyx.adaptors import divide, divide_many
 
 import fairpyx.algorithms as algorithms
 
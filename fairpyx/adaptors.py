@@ -10,9 +10,14 @@ Author: Erel Segal-Halevi
 Since: 2023-07
 """
 
-import numpy as np
+import numpy as np, multiprocessing, multiprocessing.connection, time
+from collections import deque
+from itertools import product
 from fairpyx import Instance, AgentBundleValueMatrix, validate_allocation, allocation_is_fractional, AllocationBuilder, ExplanationLogger
 
+import logging
+logger = logging.getLogger(__name__)
+
 def divide(
     algorithm: callable,
     instance: Instance = None,
@@ -150,6 +155,136 @@ def divide_random_instance(
 
 
 
+def allocation_metrics(instance:Instance, allocation:dict)->dict:
+    """
+    Measures of the satisfaction of the agents from an (integral) allocation, using the normalized values of AgentBundleValueMatrix.
+
+    >>> instance = Instance(valuations={"Alice": {"c1":2, "c2": 3}, "Bob": {"c1": 4, "c2": 5}}, agent_capacities=1, item_capacities=1)
+    >>> metrics = allocation_metrics(instance, {"Alice": ["c1"], "Bob": ["c2"]})
+    >>> metrics["egalitarian_value"], metrics["max_envy"], metrics["num_with_top_1"]
+    (66.66666666666667, 33.33333333333333, 1)
+    """
+    matrix = AgentBundleValueMatrix(instance, allocation)
+    matrix.use_normalized_values()
+    return {
+        "utilitarian_value": matrix.utilitarian_value(),
+        "egalitarian_value": matrix.egalitarian_value(),
+        "max_envy": matrix.max_envy(),
+        "mean_envy": matrix.mean_envy(),
+        "max_deficit": matrix.max_deficit(),
+        "mean_deficit": matrix.mean_deficit(),
+        "num_with_top_1": matrix.count_agents_with_top_rank(1),
+        "num_with_top_2": matrix.count_agents_with_top_rank(2),
+        "num_with_top_3": matrix.count_agents_with_top_rank(3),
+    }
+
+
+def _run_task(connection, algorithm:callable, instance_generator:callable, random_seed:int, memory_limit:int, kwargs:dict):
+    """
+    The body of a worker process of divide_many: generate the instance, divide it, and send back the allocation and its metrics.
+    """
+    if memory_limit is not None:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    try:
+        instance = instance_generator(random_seed=random_seed)
+        start_time = time.perf_counter()
+        allocation = divide(algorithm, instance=instance, **kwargs)
+        result = {"runtime": time.perf_counter() - start_time, "allocation": allocation}
+        if not allocation_is_fractional(allocation):
+            result.update(allocation_metrics(instance, allocation))
+    except (Exception, MemoryError) as error:
+        result = {"error": f"{type(error).__name__}: {error}"}
+    connection.send(result)
+    connection.close()
+
+
+def divide_many(
+        algorithms: list,
+        instance_generators: dict,
+        random_seeds: list,
+        max_workers: int = None,
+        timeout: float = None,
+        memory_limit: int = None,
+        **kwargs
+):
+    """
+    Apply each of the given algorithms to each of the instances generated by the given generators with the given random seeds,
+    in parallel processes, and yield the results as the tasks finish (not necessarily in the order of the grid).
+
+    Each task runs in its own process, which generates its instance from its seed; so the instances are never pickled
+    (with the "fork" start method, which is used where it is available, neither are the algorithms and the generators).
+    Only the results are sent back.
+
+    :param algorithms: a list of course-allocation algorithms (each accepts an AllocationBuilder).
+    :param instance_generators: a dict mapping a name to a function that accepts the keyword argument random_seed and returns an Instance,
+           e.g. functools.partial(Instance.random_uniform, num_of_agents=100, ...).
+    :param random_seeds: the seeds sent to every generator.
+    :param max_workers: the maximum number of processes running at the same time (default: the number of CPUs).
+    :param timeout: the maximum running time of a task, in seconds; a task that runs longer is killed.
+    :param memory_limit: the maximum address space of a task process, in bytes (Unix only); a task that needs more fails with a MemoryError.
+    :param kwargs: any other arguments expected by the algorithms.
+
+    :return: a generator of dicts. Each dict has the keys "algorithm" (its name), "instance" (the generator name) and "random_seed";
+             then either "runtime", "allocation" and (for integral allocations) the keys of allocation_metrics, or "error".
+
+    >>> from fairpyx.algorithms.picking_sequence import round_robin, serial_dictatorship
+    >>> generators = {"tiny": lambda random_seed: Instance(valuations=np.random.default_rng(random_seed).integers(1, 10, (3, 4)), agent_capacities=2, item_capacities=2)}
+    >>> results = sorted(divide_many([round_robin, serial_dictatorship], generators, random_seeds=[1, 2], max_workers=2), key=lambda result: (result["algorithm"], result["random_seed"]))
+    >>> [(result["algorithm"], result["instance"], result["random_seed"], result["allocation"]) for result in results]    # doctest: +NORMALIZE_WHITESPACE
+    [('round_robin', 'tiny', 1, {0: [2, 3], 1: [1, 3], 2: [0, 2]}), ('round_robin', 'tiny', 2, {0: [0, 1], 1: [1, 2], 2: [2, 3]}),
+     ('serial_dictatorship', 'tiny', 1, {0: [2, 3], 1: [2, 3], 2: [0, 1]}), ('serial_dictatorship', 'tiny', 2, {0: [0, 1], 1: [1, 2], 2: [2, 3]})]
+    >>> sorted(results[0].keys())    # doctest: +NORMALIZE_WHITESPACE
+    ['algorithm', 'allocation', 'egalitarian_value', 'instance', 'max_deficit', 'max_envy', 'mean_deficit', 'mean_envy',
+     'num_with_top_1', 'num_with_top_2', 'num_with_top_3', 'random_seed', 'runtime', 'utilitarian_value']
+
+    >>> def sleeping_algorithm(alloc): time.sleep(10)
+    >>> list(divide_many([sleeping_algorithm], generators, random_seeds=[1], timeout=0.5))
+    [{'algorithm': 'sleeping_algorithm', 'instance': 'tiny', 'random_seed': 1, 'error': 'TimeoutError: killed after 0.5 seconds'}]
+    """
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    context = multiprocessing.get_context(start_method)
+    tasks = deque(product(instance_generators.items(), algorithms, random_seeds))
+    running = {}     # maps the receiving end of each task's pipe to (process, description, start time)
+
+    def finish(connection, result:dict):
+        process, description, _ = running.pop(connection)
+        process.join()
+        connection.close()
+        logger.info("Finished %s: %s", description, result.get("error", "OK"))
+        return {**description, **result}
+
+    while tasks or running:
+        while tasks and len(running) < max_workers:
+            (instance_name, instance_generator), algorithm, random_seed = tasks.popleft()
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_task, args=(sender, algorithm, instance_generator, random_seed, memory_limit, kwargs), daemon=True)
+            process.start()
+            sender.close()
+            description = {"algorithm": algorithm.__name__, "instance": instance_name, "random_seed": random_seed}
+            running[receiver] = (process, description, time.monotonic())
+
+        wait_time = None
+        if timeout is not None:
+            wait_time = max(0, min(start + timeout for _, _, start in running.values()) - time.monotonic())
+        for connection in multiprocessing.connection.wait(list(running), timeout=wait_time):
+            try:
+                result = connection.recv()
+            except EOFError:     # the process died without sending a result
+                running[connection][0].join()
+                result = {"error": f"ProcessError: the worker exited with code {running[connection][0].exitcode}"}
+            yield finish(connection, result)
+
+        if timeout is not None:
+            now = time.monotonic()
+            for connection, (process, _, start) in list(running.items()):
+                if now - start >= timeout:
+                    process.kill()
+                    yield finish(connection, {"error": f"TimeoutError: killed after {timeout} seconds"})
+
+
 if __name__ == "__main__":
     import doctest, sys
     print("\n", doctest.testmod(), "\n")
@@ -13,6 +13,7 @@ from fairpyx.algorithms.fractional_egalitarian import fractional_egalitarian_uti
 import cvxpy, numpy as np, networkz as nx
 from fairpyx.utils.solve import solve
 from collections import defaultdict
+import heapq
 # import matplotlib.pyplot as plt # for plotting the consumption graph (for debugging)
 
 
@@ -26,22 +27,55 @@ class ConsumptionGraph:
     and an edge between each agent and the items of which he has positive quantity.
 
     Overrides networkx graph to fix a bug when agent and item have the same name.
+
+    For the rounding loop of almost_egalitarian_allocation, the graph also keeps three priority queues, so that each rounding step takes O(log E) time
+    instead of a scan of all the nodes or edges:
+    * full edges (an agent with at least full_fraction of an item), ordered by the item and then by the agent;
+    * agent leaves (agents of degree 1), ordered by the agent;
+    * all edges, ordered by weight.
+    The queues use lazy deletion: an entry is pushed whenever an edge or a degree changes, and stale entries are skipped when popped.
+    Agents and items are ordered by their first appearance in the allocation.
+
+    >>> graph = ConsumptionGraph({"a": {"x": 0.5, "y": 0.5}, "b": {"x": 0.5, "y": 0.2, "z": 0.99}})
+    >>> graph.pop_full_edge()
+    ('b', 'z')
+    >>> graph.pop_full_edge() is None
+    True
+    >>> graph.pop_agent_leaf() is None
+    True
+    >>> graph.min_weight_edge()
+    ('b', 'y')
+    >>> graph.remove_edge("b", "y")
+    >>> graph.set_weight("a", "y", 1.0)
+    >>> graph.min_weight_edge(), graph.pop_full_edge()
+    (('a', 'x'), ('a', 'y'))
+    >>> graph.remove_edge("b", "z")
+    >>> graph.pop_agent_leaf()
+    'b'
     """
 
-    def __init__(self, allocation:dict, min_fraction=0.01, agent_item_value=None):
+    def __init__(self, allocation:dict, min_fraction=0.01, agent_item_value=None, full_fraction:float=None):
         """
         :param allocation - the fractional allocation (maps each agent to a map from item to fraction).
         :param min_fraction - smallest fraction for which an edge will be created.
         :param agent_item_value - a function that maps agent,item to the agent's value for the item.
+        :param full_fraction - smallest fraction for which an edge is a full edge (default: 1-2*min_fraction).
         """
         self.graph = nx.Graph()
+        self.full_fraction = 1-2*min_fraction if full_fraction is None else full_fraction
 
         self.map_agent_to_items = defaultdict(dict)
         self.map_item_to_agents  = defaultdict(dict)
         self.num_of_edges = 0
+        self._agent_rank = {}
+        self._item_rank = {}
+        self._full_edges = []       # heap of (item rank, agent rank, agent, item)
+        self._agent_leaves = []     # heap of (agent rank, agent)
+        self._edges_by_weight = []  # heap of (weight, agent rank, item rank, agent, item)
 
         for agent,bundle in allocation.items():
             for item,fraction in bundle.items():
+                self._item_rank.setdefault(item, len(self._item_rank))
                 if fraction>=min_fraction:
                     # value = None if agent_item_value is None else agent_item_value(agent,item)
                     self.add_edge(agent,item, weight=np.round(fraction,2))
@@ -51,15 +85,60 @@ class ConsumptionGraph:
 
     def add_edge(self, agent, item, weight=0):
         if not self.has_edge(agent,item):
+            self._agent_rank.setdefault(agent, len(self._agent_rank))
+            self._item_rank.setdefault(item, len(self._item_rank))
             self.map_item_to_agents[item][agent] = weight
             self.map_agent_to_items[agent][item] = weight
             self.num_of_edges += 1
+            self._push_edge(agent, item, weight)
+            self._push_if_leaf(agent)
 
     def remove_edge(self, agent, item):
         if self.has_edge(agent,item):
             del self.map_item_to_agents[item][agent]
             del self.map_agent_to_items[agent][item]
             self.num_of_edges -= 1
+            self._push_if_leaf(agent)
+
+    def _push_edge(self, agent, item, weight):
+        heapq.heappush(self._edges_by_weight, (weight, self._agent_rank[agent], self._item_rank[item], agent, item))
+        if weight >= self.full_fraction:
+            heapq.heappush(self._full_edges, (self._item_rank[item], self._agent_rank[agent], agent, item))
+
+    def _push_if_leaf(self, agent):
+        if len(self.map_agent_to_items[agent]) == 1:
+            heapq.heappush(self._agent_leaves, (self._agent_rank[agent], agent))
+
+    def pop_full_edge(self):
+        """
+        Remove and return the first full edge (agent,item) in the queue (the edge itself stays in the graph), or None if there is none.
+        """
+        while self._full_edges:
+            _, _, agent, item = heapq.heappop(self._full_edges)
+            if self.has_edge(agent,item) and self.weight(agent,item) >= self.full_fraction:
+                return (agent, item)
+        return None
+
+    def pop_agent_leaf(self):
+        """
+        Remove and return the first agent of degree 1 in the queue, or None if there is none.
+        """
+        while self._agent_leaves:
+            _, agent = heapq.heappop(self._agent_leaves)
+            if self.agent_degree(agent) == 1:
+                return agent
+        return None
+
+    def min_weight_edge(self):
+        """
+        Return an edge (agent,item) with minimum weight, or None if the graph has no edges.
+        """
+        while self._edges_by_weight:
+            weight, _, _, agent, item = self._edges_by_weight[0]
+            if self.has_edge(agent,item) and self.weight(agent,item) == weight:
+                return (agent, item)
+            heapq.heappop(self._edges_by_weight)
+        return None
 
     def agent_degree(self, agent)->int:
         return len(self.map_agent_to_items[agent])
@@ -96,6 +175,7 @@ class ConsumptionGraph:
     def set_weight(self, agent, item, weight):
         self.map_item_to_agents[item][agent] = weight
         self.map_agent_to_items[agent][item] = weight
+        self._push_edge(agent, item, weight)
 
     def edges(self): 
         """
@@ -217,69 +297,48 @@ def almost_egalitarian_allocation(alloc: AllocationBuilder, surplus_donation:boo
 
     # draw_bipartite_weighted_graph(fractional_allocation_graph, alloc.remaining_agents())
     while fractional_allocation_graph.number_of_edges()>0:
-        # Look for an item leaf:
-        # edges_with_fraction_near_1 = [(u,v) for u,v in fractional_allocation_graph.edges if fractional_allocation_graph[u][v]['weight'] >= 1-2*MIN_EDGE_FRACTION]
-        # max_value_edge = max(edges_with_fraction_near_1, key=lambda u,v: fractional_allocation_graph[u][v]['value'])
-
-        found_item_leaf = False
-        for item_min_weight in list(alloc.remaining_items()):
-            if not fractional_allocation_graph.contains_item(item_min_weight):
-                continue
-            item_neighbors = list(fractional_allocation_graph.item_neighbors(item_min_weight))
-            for agent_min_weight in item_neighbors:
-                if agent_min_weight not in fractional_allocation:
-                    raise ValueError(f"agent {agent_min_weight} not in fractional allocation {fractional_allocation}")
-                fractional_bundle = fractional_allocation[agent_min_weight]
-                if item_min_weight not in fractional_bundle:
-                    raise ValueError(f"item {item_min_weight} not in fractional bundle of agent {agent_min_weight} = {fractional_bundle}")
-                if fractional_allocation[agent_min_weight][item_min_weight] >= 1-2*MIN_EDGE_FRACTION:
-                    # Give an entire unit of the item to the neighbor agent
-                    alloc.give(agent_min_weight, item_min_weight)
-                    explanation_logger.info("Course %s is a leaf node, and you are its only neighbor, so you get all of it to yourself.", item_min_weight, agents=agent_min_weight)
-                    fractional_allocation[agent_min_weight][item_min_weight] = 0
-                    fractional_allocation_graph.remove_edge(agent_min_weight,item_min_weight)
-                    if not agent_min_weight in alloc.remaining_agent_capacities:
-                        explanation_logger.info("You have received %s and you have no remaining capacity.", alloc.bundles[agent_min_weight], agents=agent_min_weight)
-                        remove_agent_from_graph(agent_min_weight)
-                    explanation_logger.debug("\nfractional_allocation_graph: %s", fractional_allocation_graph)
-                    found_item_leaf = True
-        if found_item_leaf:
-            # draw_bipartite_weighted_graph(fractional_allocation_graph, alloc.remaining_agents())
+        # Look for an item leaf - an agent who has almost an entire unit of a remaining item:
+        full_edge = fractional_allocation_graph.pop_full_edge()
+        if full_edge is not None:
+            agent_min_weight,item_min_weight = full_edge
+            if item_min_weight not in alloc.remaining_item_capacities:
+                continue     # the item has no remaining capacity (and will never have), so this edge is handled as an ordinary edge.
+            # Give an entire unit of the item to the neighbor agent
+            alloc.give(agent_min_weight, item_min_weight)
+            explanation_logger.info("Course %s is a leaf node, and you are its only neighbor, so you get all of it to yourself.", item_min_weight, agents=agent_min_weight)
+            fractional_allocation[agent_min_weight][item_min_weight] = 0
+            fractional_allocation_graph.remove_edge(agent_min_weight,item_min_weight)
+            if not agent_min_weight in alloc.remaining_agent_capacities:
+                explanation_logger.info("You have received %s and you have no remaining capacity.", alloc.bundles[agent_min_weight], agents=agent_min_weight)
+                remove_agent_from_graph(agent_min_weight)
+            explanation_logger.debug("\nfractional_allocation_graph: %s", fractional_allocation_graph)
             continue
 
         # No item is a leaf - look for an agent leaf:
-        found_agent_leaf = False
-        for agent_min_weight in list(alloc.remaining_agents()):
-            if not fractional_allocation_graph.contains_agent(agent_min_weight):
-                continue
-            agent_degree = fractional_allocation_graph.agent_degree(agent_min_weight)
-            explanation_logger.debug(f"  Your degree in the consumption graph is {agent_degree}", agents=agent_min_weight)
-            if agent_degree==1:
-                # A leaf agent: disconnect him from his only neighbor (since it is a good)
-                item_min_weight = fractional_allocation_graph.agent_first_neighbor(agent_min_weight)
-                if fractional_allocation_graph.item_degree(item_min_weight)>1:
-                    explanation_logger.info("\nYou are a leaf node, so you lose your only neighbor %s", item_min_weight, agents=agent_min_weight)
-                    remove_agent_from_graph(agent_min_weight)
+        agent_min_weight = fractional_allocation_graph.pop_agent_leaf()
+        if agent_min_weight is not None:
+            explanation_logger.debug(f"  Your degree in the consumption graph is 1", agents=agent_min_weight)
+            # A leaf agent: disconnect him from his only neighbor (since it is a good)
+            item_min_weight = fractional_allocation_graph.agent_first_neighbor(agent_min_weight)
+            if fractional_allocation_graph.item_degree(item_min_weight)>1:
+                explanation_logger.info("\nYou are a leaf node, so you lose your only neighbor %s", item_min_weight, agents=agent_min_weight)
+                remove_agent_from_graph(agent_min_weight)
+            else:
+                fractional_allocation[agent_min_weight][item_min_weight] = 0
+                fractional_allocation_graph.remove_edge(agent_min_weight,item_min_weight)
+                if agent_min_weight not in alloc.remaining_agent_capacities:
+                    logger.warn("Agent %s is the only one who could get item %s, but the agent has no remaining capacity!", agent_min_weight, item_min_weight)
+                elif item_min_weight not in alloc.remaining_item_capacities:
+                    logger.warn("Agent %s is the only one who could get item %s, but the item has no remaining capacity!", agent_min_weight, item_min_weight)
                 else:
-                    fractional_allocation[agent_min_weight][item_min_weight] = 0
-                    fractional_allocation_graph.remove_edge(agent_min_weight,item_min_weight)
-                    if agent_min_weight not in alloc.remaining_agent_capacities:
-                        logger.warn("Agent %s is the only one who could get item %s, but the agent has no remaining capacity!", agent_min_weight, item_min_weight)
-                    elif item_min_weight not in alloc.remaining_item_capacities:
-                        logger.warn("Agent %s is the only one who could get item %s, but the item has no remaining capacity!", agent_min_weight, item_min_weight)
-                    else:
-                        alloc.give(agent_min_weight, item_min_weight)
-                        explanation_logger.info("Both you and course %s are leaf nodes, so you get all of it to yourself.", item_min_weight, agents=agent_min_weight)
-
-                explanation_logger.debug("\nfractional_allocation_graph: %s", fractional_allocation_graph)
-                found_agent_leaf = True
-                break  # after removing one agent, proceed to remove leaf items
-        if found_agent_leaf:
-            # draw_bipartite_weighted_graph(fractional_allocation_graph, alloc.remaining_agents())
+                    alloc.give(agent_min_weight, item_min_weight)
+                    explanation_logger.info("Both you and course %s are leaf nodes, so you get all of it to yourself.", item_min_weight, agents=agent_min_weight)
+
+            explanation_logger.debug("\nfractional_allocation_graph: %s", fractional_allocation_graph)
             continue
 
         # No leaf at all - remove an edge with a small weight:
-        edge_with_min_weight = min(fractional_allocation_graph.edges(), key=lambda edge:fractional_allocation_graph.weight(edge[0],edge[1]))
+        edge_with_min_weight = fractional_allocation_graph.min_weight_edge()
         agent_min_weight,item_min_weight = edge_with_min_weight
         min_weight = fractional_allocation_graph.weight(agent_min_weight,item_min_weight)
         # logger.warning("No leafs - removing edge %s with minimum weight %g", edge_with_min_weight, min_weight)
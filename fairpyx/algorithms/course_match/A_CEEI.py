@@ -8,11 +8,17 @@ Programmer: Naama Shiponi and Ben Dabush
 Date: 1/6/2024
 """
 import logging
+import multiprocessing
 import random
 import time
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from fairpyx import Instance, AllocationBuilder
-from itertools import combinations
+from fairpyx.algorithms.course_match.schedule_ranking import ScheduleRanking
+from fairpyx.algorithms.course_match.demand_oracle import DemandOracle
+from fairpyx.algorithms.course_match.knapsack_demand import KnapsackDemandOracle
+from fairpyx.algorithms.course_match.tabu_list import TabuList
+from fairpyx.algorithms.course_match.preference_cache import PreferenceCache
 
 
 # logging.basicConfig(level=logging.DEBUG)
@@ -22,13 +28,18 @@ logger = logging.getLogger(__name__)
 """
 Algorithm 1: Approximate Competitive Equilibrium from Equal Incomes (A-CEEI), finds the best price vector that matches student preferences and course capacities.
 """
-def A_CEEI(alloc: AllocationBuilder, budget : dict , time_limit: int = 60, seed = None) -> dict:
+def A_CEEI(alloc: AllocationBuilder, budget : dict , time_limit: int = 60, seed = None, workers: int = 1, tabu_list_size: int = None, exact_neighbors: bool = False, preference_cache: PreferenceCache = None) -> dict:
     """
     Perform heuristic search to find the best price vector that matches student preferences and course capacities.
 
     :param allocation: Allocation object.
     :param budget (float): Initial budget.
     :param time (float): Time limit for the search.
+    :param seed: seed for the random restarts.
+    :param workers: number of processes that run independent restart chains in parallel (default 1: no parallelism).
+    :param tabu_list_size: maximum number of demand vectors in the tabu list of each restart (default None: unbounded).
+    :param exact_neighbors: if True, individual-adjustment neighbors raise prices exactly to the next demand breakpoint.
+    :param preference_cache: the schedule rankings of the students, shared with the other stages of Course Match (computed if not given).
 
     :return (dict) best price vector.
     
@@ -47,11 +58,32 @@ def A_CEEI(alloc: AllocationBuilder, budget : dict , time_limit: int = 60, seed
     >>> allocation = AllocationBuilder(instance)
     >>> {k: round(v) for k, v in A_CEEI(allocation, budget, 10, 60).items()}
     {'c1': 1, 'c2': 1, 'c3': 1}
+    >>> price_vector = A_CEEI(allocation, budget, 10, 60, workers=2)
+    >>> compute_surplus_demand_for_each_course(price_vector, allocation, budget, find_preferred_schedule_adapter(allocation))
+    {'c1': 0, 'c2': 0, 'c3': 0}
 
 
     """
     logger.info("Starting A_CEEI algorithm with budget=%s and time limit %d.",budget, time_limit)
-   
+    if preference_cache is None:
+        preference_cache = PreferenceCache(alloc.instance)
+    preferred_schedule = preference_cache.demand_oracle(budget)
+    logger.debug("Calling find_preference_order_for_each_student %s",preferred_schedule)
+    if workers > 1:
+        best_price_vector, best_error = run_parallel_restart_chains(alloc, budget, preferred_schedule, time_limit, seed, workers, tabu_list_size, exact_neighbors)
+    else:
+        best_price_vector, best_error = run_restart_chains(alloc, budget, preferred_schedule, time_limit, seed, tabu_list_size=tabu_list_size, exact_neighbors=exact_neighbors)
+    logger.info("A-CEEI algorithm completed. Best price vector: %s with error: %f", best_price_vector, best_error)      
+    return best_price_vector
+
+
+def run_restart_chains(alloc: AllocationBuilder, budget: dict, preferred_schedule: dict, time_limit: float, seed=None, should_stop: callable = lambda: False, tabu_list_size: int = None, exact_neighbors: bool = False):
+    """
+    The sequential search of A-CEEI: tabu-search chains from random price vectors, one after another,
+    until the time limit, until a price vector with zero clearing error is found, or until should_stop() returns True.
+
+    :return a tuple (best price vector, its clearing error).
+    """
     def initialize_price_vector(budget,seed):
         return {k: random.uniform(0, max(budget.values())) for k in alloc.instance.items}
     
@@ -60,9 +92,7 @@ def A_CEEI(alloc: AllocationBuilder, budget : dict , time_limit: int = 60, seed
     start_time = time.time()
     steps = [0.1, 0.2, 0.3, 0.4, 0.5]  # Example step sizes, can be adjusted
 
-    preferred_schedule = find_preferred_schedule_adapter(alloc)
-    logger.debug("Calling find_preference_order_for_each_student %s",preferred_schedule)
-    while time.time() - start_time < time_limit :
+    while time.time() - start_time < time_limit and best_error > 0 and not should_stop():
         if seed:
             seed+=1        
             random.seed(seed)
@@ -71,10 +101,10 @@ def A_CEEI(alloc: AllocationBuilder, budget : dict , time_limit: int = 60, seed
         search_error = alpha(compute_surplus_demand_for_each_course(price_vector, alloc, budget, preferred_schedule))
         logger.debug("Initial search on _random_ price_ %s error: %f",price_vector, search_error)
 
-        tabu_list = []
+        tabu_list = TabuList(max_size=tabu_list_size)
         c = 0
-        while c < 5:
-            neighbors = find_neighbors(price_vector, alloc, budget, steps, preferred_schedule)
+        while c < 5 and not should_stop():
+            neighbors = find_neighbors(price_vector, alloc, budget, steps, preferred_schedule, exact_neighbors)
             logger.debug("Found %d neighbors : %s", len(neighbors), neighbors)
             
             while neighbors:
@@ -107,15 +137,69 @@ def A_CEEI(alloc: AllocationBuilder, budget : dict , time_limit: int = 60, seed
                     best_price_vector = price_vector
                     if best_error == 0:
                         break
-    logger.info("A-CEEI algorithm completed. Best price vector: %s with error: %f", best_price_vector, best_error)      
-    return best_price_vector
+        logger.debug("Restart done, %s", tabu_list)
+    return best_price_vector, best_error
+
+
+### Parallel restarts
+
+# The state shared by the restart-chain worker processes. It is set once per process by `_init_restart_chain_worker`;
+# with the "fork" start method it is inherited from the parent process without pickling.
+_worker_state = {}
+
+def _init_restart_chain_worker(alloc: AllocationBuilder, budget: dict, preferred_schedule: dict, stop_event):
+    if preferred_schedule is None:     # not forked: the lazy rankings cannot be pickled, so each worker computes its own.
+        preferred_schedule = PreferenceCache(alloc.instance).demand_oracle(budget)
+    _worker_state.update(alloc=alloc, budget=budget, preferred_schedule=preferred_schedule, stop_event=stop_event)
+
+
+def _run_restart_chain_worker(time_limit: float, seed: int, tabu_list_size: int, exact_neighbors: bool):
+    stop_event = _worker_state["stop_event"]
+    best_price_vector, best_error = run_restart_chains(
+        _worker_state["alloc"], _worker_state["budget"], _worker_state["preferred_schedule"],
+        time_limit, seed, should_stop=stop_event.is_set, tabu_list_size=tabu_list_size, exact_neighbors=exact_neighbors)
+    if best_error == 0:
+        stop_event.set()
+    return best_price_vector, best_error
+
+
+def derive_worker_seeds(seed, workers: int) -> list:
+    """
+    Derive an independent seed for each worker from the given seed (or from fresh entropy, if seed is None).
+
+    >>> derive_worker_seeds(60, 3) == derive_worker_seeds(60, 3)
+    True
+    >>> len(set(derive_worker_seeds(60, 3)))
+    3
+    """
+    return [int(child.generate_state(1)[0]) + 1 for child in np.random.SeedSequence(seed).spawn(workers)]
+
+
+def run_parallel_restart_chains(alloc: AllocationBuilder, budget: dict, preferred_schedule: dict, time_limit: float, seed, workers: int, tabu_list_size: int = None, exact_neighbors: bool = False):
+    """
+    Run `workers` independent restart chains in a process pool, each with its own derived seed.
+    All the workers stop as soon as one of them finds a price vector with zero clearing error.
 
+    :return a tuple (best price vector, its clearing error) over all workers.
+    """
+    start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    context = multiprocessing.get_context(start_method)
+    stop_event = context.Event()
+    shared_preferred_schedule = preferred_schedule if start_method == "fork" else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_restart_chain_worker,
+                             initargs=(alloc, budget, shared_preferred_schedule, stop_event)) as executor:
+        futures = [executor.submit(_run_restart_chain_worker, time_limit, worker_seed, tabu_list_size, exact_neighbors) for worker_seed in derive_worker_seeds(seed, workers)]
+        results = [future.result() for future in futures]
+    for worker, (price_vector, error) in enumerate(results):
+        logger.info("Worker %d: best error %f", worker, error)
+    return min(results, key=lambda result: result[1])
 
 
 def find_preference_order_for_each_student(valuations:dict, agent_capacities:dict, item_conflicts:dict, agent_conflicts:dict):
     """
-    Finds, for each student, the complete preference ordering on all possible schedules.
-    This is a pre-processing step: we compute all preference ordering once, and then use it to find the best schedule that fits the budget.
+    Finds, for each student, the preference ordering on all possible schedules.
+    The ordering is lazy: each student gets a ScheduleRanking, which generates the schedules best-first,
+    only as far as they are actually read (e.g. by find_best_schedule, until the first affordable schedule).
     
     :param valuations: Dictionary of valuations.
     :param agent_capacities: Dictionary of agent capacities.
@@ -129,93 +213,20 @@ def find_preference_order_for_each_student(valuations:dict, agent_capacities:dic
     >>> item_conflicts = {"c1": ["c2"], "c2": ["c1"], "c3": []}
     >>> agent_conflicts = {"Alice": ["c2"], "Bob": [], "Tom": []}
     >>> valuations = {"Alice": {"c1": 90, "c2": 60, "c3": 50}, "Bob": {"c1": 50, "c2": 81, "c3": 60}, "Tom": {"c1": 100, "c2": 95, "c3": 30}}
-    >>> find_preference_order_for_each_student(valuations, agent_capacities, item_conflicts, agent_conflicts)
+    >>> preferred_schedules = find_preference_order_for_each_student(valuations, agent_capacities, item_conflicts, agent_conflicts)
+    >>> preferred_schedules["Bob"][0]
+    [0, 1, 1]
+    >>> {agent: list(schedules) for agent, schedules in preferred_schedules.items()}
     {'Alice': [[1, 0, 1], [1, 0, 0], [0, 0, 1]], 'Bob': [[0, 1, 1], [1, 0, 1], [0, 1, 0], [0, 0, 1], [1, 0, 0]], 'Tom': [[1, 0, 0], [0, 1, 0], [0, 0, 1]]}
     """
-        
-    def is_valid_schedule(schedule, item_conflicts, agent_conflicts, agent):
-        '''
-        Check if a schedule is valid.
-        :param schedule: Dictionary of items in the schedule.
-        :param item_conflicts: Dictionary of item conflicts.
-        :param agent_conflicts: Dictionary of agent conflicts.
-        :param agent: Agent name.
-        
-        :return (bool) True if the schedule is valid, False otherwise.
-        
-        :example
-        >>> schedule = {"c1": 1, "c2": 0, "c3": 1}
-        >>> item_conflicts = {"c1": ["c2"], "c2": ["c1"], "c3": []}
-        >>> agent_conflicts = {"Alice": ["c2"], "Bob": [], "Tom": []}
-        >>> is_valid_schedule({"c1": 1, "c2": 0, "c3": 1}, item_conflicts, agent_conflicts, "Alice")
-        True
-        >>> is_valid_schedule({"c1": 1, "c2": 1, "c3": 1}, item_conflicts, agent_conflicts, "Alice")
-        False
-        '''
-        # Check item conflicts
-        for item, conflicts in item_conflicts.items():
-            if schedule.get(item, 0) == 1:
-                for conflicted_item in conflicts:
-                    if schedule.get(conflicted_item, 0) == 1:
-                        return False
-        # Check agent conflicts
-        for conflicted_item in agent_conflicts.get(agent, []):
-            if schedule.get(conflicted_item, 0) == 1:
-                return False
-        return True
-
-
-    def generate_all_schedules(items, capacity):
-        '''
-        Generate all possible schedules for a given set of items and capacity.
-        :param items: List of items.
-        :param capacity: Capacity.
-        
-        :return (list) List of all possible schedules.
-        
-        :example
-        >>> items = ["c1", "c2", "c3"]
-        >>> capacity = 2
-        >>> generate_all_schedules(items, capacity)
-        [{'c1': 1, 'c2': 0, 'c3': 0}, {'c1': 0, 'c2': 1, 'c3': 0}, {'c1': 0, 'c2': 0, 'c3': 1}, {'c1': 1, 'c2': 1, 'c3': 0}, {'c1': 1, 'c2': 0, 'c3': 1}, {'c1': 0, 'c2': 1, 'c3': 1}]
-        '''
-        all_schedules = []
-        for num_courses_per_agent in range(1, capacity + 1):
-            for schedule in combinations(items, num_courses_per_agent):
-                schedule_dict = {item: 1 if item in schedule else 0 for item in items}
-                if is_valid_schedule(schedule_dict, item_conflicts, agent_conflicts, agent):
-                    all_schedules.append(schedule_dict)
-        return all_schedules
-    
-
     preferred_schedules = dict()
-
     for agent in agent_capacities.keys():
-        items = valuations[agent].keys()
-        capacity = agent_capacities[agent]
-        all_schedules = generate_all_schedules(items, capacity)
-        logger.debug("All schedules for agent %s: %s", agent, all_schedules)
-        # Calculate valuations for valid schedules
-        schedule_valuations = dict()
-        for schedule in all_schedules:
-            total_valuation = sum(valuations[agent][item] for item in schedule if schedule[item] == 1)
-            schedule_valuations[total_valuation] = schedule_valuations.get(total_valuation, [])
-            schedule_valuations[total_valuation].append([schedule[item] for item in items])
-        # Sort the schedules by total valuation in descending order
-        sorted_valuations = sorted(schedule_valuations.keys(), reverse=True)
-
-        for val in sorted_valuations:
-            if len(schedule_valuations.get(val)) > 1:
-                schedule_valuations[val] = sorted(schedule_valuations.get(val), key=lambda x: sum(x), reverse=True)
-
-        # Collect sorted schedules
-        sorted_schedules = []
-
-        for val in sorted_valuations:
-            for schedule in schedule_valuations.get(val):
-                sorted_schedules.append(schedule)
-
-        preferred_schedules[agent] = sorted_schedules
+        preferred_schedules[agent] = ScheduleRanking(
+            items=valuations[agent].keys(),
+            valuation=valuations[agent],
+            capacity=agent_capacities[agent],
+            item_conflicts=item_conflicts,
+            forbidden_items=agent_conflicts.get(agent, []))
     return preferred_schedules
 
 
@@ -248,17 +259,9 @@ def compute_surplus_demand_for_each_course(price_vector: dict ,alloc: Allocation
     >>> compute_surplus_demand_for_each_course(price_vector,allocation , budget, preferred_schedule)
     {'c1': 2, 'c2': -1, 'c3': 0}
     """
-    best_schedules = find_best_schedule(price_vector, budget, preferred_schedule)
-    sol = np.sum(np.array(best_schedules), axis=0)
-    # Convert item capacities to a list
-    item_capacities_list = [alloc.instance.item_capacity(name_item) for name_item in alloc.instance.items]
-
-    # Convert item capacities list to a numpy array
-    item_capacities_array = np.array(item_capacities_list)
-
-    # Perform the subtraction
-    result = {name_item: int(sol[i] - item_capacities_array[i]) for i, name_item in enumerate(alloc.instance.items)}
-    return result
+    oracle = demand_oracle_for(alloc, budget, preferred_schedule)
+    excess_demand = oracle.excess_demand(oracle.price_array(price_vector))
+    return {name_item: int(excess_demand[i]) for i, name_item in enumerate(oracle.items)}
        
 
 def find_best_schedule(price_vector: dict, budget : dict, preferred_schedule: dict):    
@@ -292,19 +295,33 @@ def find_best_schedule(price_vector: dict, budget : dict, preferred_schedule: di
     [[1, 0, 1], [0, 1, 0], [0, 0, 1]]
 
     """
-    best_schedule = []
-    cuont = 0
-    price_array = np.array([price_vector[key] for key in price_vector.keys()])
-    for student, schedule in preferred_schedule.items():
-        best_schedule.append(np.zeros(len(price_vector)))
-        sum_of_courses = [i for i in np.sum(schedule * price_array[:, np.newaxis].T, axis=1)]
-        for i in range(len(sum_of_courses)):
-            if sum_of_courses[i] <= budget[student]:
-                best_schedule[cuont] = schedule[i]
-                break
-        cuont += 1
-    return best_schedule
-               
+    if isinstance(preferred_schedule, (DemandOracle, KnapsackDemandOracle)):
+        oracle = preferred_schedule
+        if oracle.budget is not budget:
+            oracle.set_budget(budget)
+    else:
+        oracle = DemandOracle(list(price_vector.keys()), [0]*len(price_vector), budget, preferred_schedule)
+    return oracle.best_schedules(oracle.price_array(price_vector))
+
+
+def demand_oracle_for(alloc: AllocationBuilder, budget: dict, preferred_schedule: dict)->DemandOracle:
+    """
+    Return a DemandOracle for the given allocation, budget and preferences.
+    If `preferred_schedule` is already a DemandOracle (or a KnapsackDemandOracle), it is reused (with the given budget);
+    otherwise, a new oracle is packed (so callers that probe many price vectors should pass an oracle).
+
+    >>> instance = Instance(valuations={"Alice": {"c1": 50, "c2": 20}}, agent_capacities=1, item_capacities=1)
+    >>> allocation = AllocationBuilder(instance)
+    >>> oracle = demand_oracle_for(allocation, {"Alice": 1.0}, {"Alice": [[1, 0], [0, 1]]})
+    >>> demand_oracle_for(allocation, {"Alice": 2.0}, oracle) is oracle
+    True
+    """
+    if isinstance(preferred_schedule, (DemandOracle, KnapsackDemandOracle)):
+        if preferred_schedule.budget is not budget:
+            preferred_schedule.set_budget(budget)
+        return preferred_schedule
+    return DemandOracle.for_allocation(alloc, budget, preferred_schedule)
+
         
 def alpha(demands: dict):
     """
@@ -329,13 +346,14 @@ def alpha(demands: dict):
     return result
 
 
-def find_neighbors(price_vector: dict ,alloc: AllocationBuilder, budget : dict, steps: list, preferred_schedule: dict):    
+def find_neighbors(price_vector: dict ,alloc: AllocationBuilder, budget : dict, steps: list, preferred_schedule: dict, exact: bool = False):    
     """
     :param price_vector: List of prices.
     :param allocation: Allocation object.
     :param budget: Dictionary of budgets.
     :param steps: List of steps.
     :param preferred_schedule: Dictionary of preferred schedules.
+    :param exact: passed to generate_individual_adjustment_neighbors.
 
     :return (list of list) List of neighbors.
 
@@ -360,16 +378,20 @@ def find_neighbors(price_vector: dict ,alloc: AllocationBuilder, budget : dict,
     [{'c1': 1.2, 'c2': 0.9, 'c3': 1.0}, {'c1': 1.4, 'c2': 0.8, 'c3': 1.0}, {'c1': 1.1, 'c2': 1.0, 'c3': 1.0}, {'c1': 1.0, 'c2': 0.0, 'c3': 1.0}]
 
     """
+    preferred_schedule = demand_oracle_for(alloc, budget, preferred_schedule)
     demands = compute_surplus_demand_for_each_course(price_vector, alloc, budget, preferred_schedule)
     list_of_neighbors = generate_gradient_neighbors(price_vector, demands, steps)
-    list_of_neighbors.extend(generate_individual_adjustment_neighbors(price_vector, alloc, demands, budget, preferred_schedule))
+    list_of_neighbors.extend(generate_individual_adjustment_neighbors(price_vector, alloc, demands, budget, preferred_schedule, exact))
 
-    #sort list_of_neighbors dict values by alpha
-    sorted_neighbors = sorted(list_of_neighbors, key=lambda neighbor: alpha(compute_surplus_demand_for_each_course(neighbor, alloc, budget, preferred_schedule)))
-    return sorted_neighbors
+    #sort list_of_neighbors dict values by alpha; all the neighbors are evaluated in one batch, and memoized by the oracle.
+    if not list_of_neighbors:
+        return []
+    price_matrix = np.array([preferred_schedule.price_array(neighbor) for neighbor in list_of_neighbors])
+    _, alphas = preferred_schedule.excess_demand_batch(price_matrix)
+    return [list_of_neighbors[index] for index in np.argsort(alphas, kind="stable")]
 
 
-def generate_individual_adjustment_neighbors(price_vector: dict, alloc: AllocationBuilder, demands: dict, budget : dict , preferred_schedule: dict):
+def generate_individual_adjustment_neighbors(price_vector: dict, alloc: AllocationBuilder, demands: dict, budget : dict , preferred_schedule: dict, exact: bool = False):
     """
     Generate individual adjustment neighbors.
 
@@ -378,6 +400,8 @@ def generate_individual_adjustment_neighbors(price_vector: dict, alloc: Allocati
     :param demands: Dictionary of course demands.
     :param budget: Dictionary of budgets.
     :param preferred_schedule: Dictionary of preferred schedules.
+    :param exact: if True, the price of an oversubscribed course is raised directly to the next price at which its demand changes,
+                  instead of in steps of 0.1.
 
     :return (list of list) List of individual adjustment neighbors.
 
@@ -400,9 +424,13 @@ def generate_individual_adjustment_neighbors(price_vector: dict, alloc: Allocati
     >>> demands = {'c1': 2, 'c2': -1, 'c3': 0}
     >>> generate_individual_adjustment_neighbors(price_vector, allocation, demands, budget, preferred_schedule)
     [{'c1': 1.1, 'c2': 1.0, 'c3': 1.0}, {'c1': 1.0, 'c2': 0.0, 'c3': 1.0}]
+    >>> generate_individual_adjustment_neighbors(price_vector, allocation, demands, budget, preferred_schedule, exact=True)
+    [{'c1': 1.0000000000000004, 'c2': 1.0, 'c3': 1.0}, {'c1': 1.0, 'c2': 0.0, 'c3': 1.0}]
 
     """
     step=0.1
+    if exact:
+        preferred_schedule = demand_oracle_for(alloc, budget, preferred_schedule)
     neighbors = []
     for k in demands.keys():
         if demands[k] == 0:
@@ -410,7 +438,16 @@ def generate_individual_adjustment_neighbors(price_vector: dict, alloc: Allocati
         new_price_vector = price_vector.copy()
         new_demands = demands.copy()
         count=0
-        if demands[k] > 0:
+        if demands[k] > 0 and exact:
+            course = preferred_schedule.items.index(k)
+            while (demands == new_demands) :
+                switch_price = preferred_schedule.switch_price(preferred_schedule.price_array(new_price_vector), course)
+                if switch_price == float('inf'):
+                    break
+                new_price_vector.update({k: switch_price})
+                new_demands = compute_surplus_demand_for_each_course(new_price_vector, alloc, budget, preferred_schedule)
+                count+=1
+        elif demands[k] > 0:
             while (demands == new_demands) :
                 new_price_vector.update({k: new_price_vector[k] + step})
                 new_demands = compute_surplus_demand_for_each_course(new_price_vector, alloc, budget, preferred_schedule)
@@ -484,7 +521,7 @@ def find_preferred_schedule_adapter(alloc: AllocationBuilder):
     ...         "Tom": {"c1": 0, "c2": 0, "c3": 100}
     ... })
     >>> allocation = AllocationBuilder(instance)
-    >>> find_preferred_schedule_adapter(allocation)
+    >>> {agent: list(schedules) for agent, schedules in find_preferred_schedule_adapter(allocation).items()}
     {'Alice': [[1, 1, 0], [1, 0, 1], [1, 0, 0], [0, 1, 1], [0, 1, 0], [0, 0, 1]], 'Bob': [[1, 1, 0], [0, 1, 1], [0, 1, 0], [1, 0, 1], [1, 0, 0], [0, 0, 1]], 'Tom': [[0, 0, 1], [1, 0, 0], [0, 1, 0]]}
     '''
     item_conflicts={item:  alloc.instance.item_conflicts(item) for item in alloc.instance.items}
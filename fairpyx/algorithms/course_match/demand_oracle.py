@@ -0,0 +1,472 @@
+"""
+A compiled demand oracle for Course Match.
+
+The price search of Course Match (A-CEEI, remove-oversubscription and reduce-undersubscription)
+asks thousands of times for the excess demand at a price vector.
+The DemandOracle packs the ranked schedules of all students once, and answers each such query
+with a few batched numpy operations.
+
+Since: 2026-10
+"""
+
+import numpy as np
+from collections.abc import Mapping
+from fairpyx import AllocationBuilder
+from fairpyx.algorithms.course_match.schedule_ranking import ScheduleRanking
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class DemandOracle(Mapping):
+    """
+    Packs the ranked schedules of all students into one contiguous int8 matrix,
+    in which the rows of each student are consecutive and ordered by the student's preference.
+
+    Only a prefix of each student's ranking is packed. When all packed schedules of a student are too expensive,
+    the prefix of this student is doubled (so a lazy ScheduleRanking is generated only as far as needed).
+
+    The oracle is also a read-only mapping from each student to its preferred schedules,
+    so it can be passed wherever a `preferred_schedule` dict is expected.
+
+    >>> preferred_schedule = {"Alice": [[1, 0, 1], [0, 1, 1], [1, 1, 0]], "Bob": [[1, 1, 0], [1, 0, 1], [0, 1, 1]], "Tom": [[1, 0, 1], [1, 1, 0], [0, 1, 1]]}
+    >>> oracle = DemandOracle(["c1", "c2", "c3"], [1, 2, 2], {"Alice": 2.0, "Bob": 2.1, "Tom": 2.3}, preferred_schedule)
+    >>> oracle.excess_demand(np.array([1.0, 1.0, 1.0]))
+    array([ 2, -1,  0])
+    >>> oracle.excess_demand(np.array([1.2, 0.9, 1.0]))
+    array([1, 0, 0])
+    >>> oracle.best_schedules(np.array([1.2, 0.9, 1.0]))
+    [[0, 1, 1], [1, 1, 0], [1, 0, 1]]
+    >>> oracle.best_schedules(np.array([3.0, 3.0, 3.0]))
+    [[0, 0, 0], [0, 0, 0], [0, 0, 0]]
+    """
+
+    def __init__(self, items:list, item_capacities:list, budget:dict, preferred_schedule:dict, initial_rows_per_student:int=16, max_memo_size:int=100000):
+        """
+        :param items: the courses, in the order of the price vectors that will be sent to the oracle.
+        :param item_capacities: the capacity of each course, in the same order.
+        :param budget: maps each student to its budget.
+        :param preferred_schedule: maps each student to its schedules in descending order of preference
+                (a list of 0/1 lists over `items`, or a ScheduleRanking).
+        :param initial_rows_per_student: how many schedules of each student to pack in advance.
+        :param max_memo_size: how many evaluated price vectors to remember (the memo is cleared when it is full).
+        """
+        self.items = list(items)
+        self.num_of_items = len(self.items)
+        self.item_capacities = np.asarray(item_capacities, dtype=int)
+        self.preferred_schedule = preferred_schedule
+        self.students = list(preferred_schedule.keys())
+        self.num_of_students = len(self.students)
+        self.max_memo_size = max_memo_size
+        self.set_budget(budget)
+
+        map_item_to_column = {item: column for column, item in enumerate(self.items)}
+        self._student_columns = [
+            [map_item_to_column[item] for item in schedules.items] if isinstance(schedules, ScheduleRanking) else None
+            for schedules in preferred_schedule.values()
+        ]
+        self.initial_rows_per_student = initial_rows_per_student
+        self.price_lower_bounds = self.price_upper_bounds = None
+        self._reset_blocks()
+
+    def _reset_blocks(self):
+        """
+        Drop all packed schedules, and pack the first schedules of every student again.
+        """
+        self._blocks = [[] for _ in self.students]      # each block is a list of schedules of a single student; each schedule is a tuple of columns.
+        self._next_position = np.zeros(self.num_of_students, dtype=int)     # the position in each student's ranking that will be read next.
+        self._min_upper_cost = np.full(self.num_of_students, np.inf)       # used by pruning: the lowest upper bound on the cost of a packed schedule.
+        self._exhausted = np.zeros(self.num_of_students, dtype=bool)
+        self._incremental = None
+        for student_index in range(self.num_of_students):
+            self._read_schedules(student_index, self.initial_rows_per_student)
+        self._pack()
+
+    @staticmethod
+    def for_allocation(alloc:AllocationBuilder, budget:dict, preferred_schedule:dict, **kwargs):
+        """
+        Construct an oracle for the courses and course capacities of the given allocation.
+        """
+        items = list(alloc.instance.items)
+        item_capacities = [alloc.instance.item_capacity(item) for item in items]
+        return DemandOracle(items, item_capacities, budget, preferred_schedule, **kwargs)
+
+    def set_budget(self, budget:dict):
+        self.budget = budget
+        self._memo = {}         # maps the bytes of a price vector to its excess demand vector.
+        self._incremental = None    # the IncrementalDemand of the last single price vector that was evaluated.
+        self.budget_array = np.array([budget[student] for student in self.students], dtype=float)
+        if getattr(self, "price_lower_bounds", None) is not None:
+            self._reset_blocks()    # pruning depends on the budgets
+        elif hasattr(self, "row_student"):
+            self._row_budget = self.budget_array[self.row_student]
+
+    def set_price_bounds(self, lower_bounds:np.ndarray=None, upper_bounds:np.ndarray=None):
+        """
+        Promise that all the price vectors that will be sent to the oracle (until the next call) are between the given bounds,
+        and prune the schedules that can never be chosen under such prices:
+        * a schedule whose cost under the lower bounds exceeds the student's budget is never affordable;
+        * a schedule whose cost under the lower bounds is at least the cost of a preferred packed schedule under the upper bounds
+          is never chosen, since whenever it is affordable, the preferred schedule is affordable too;
+        * in particular, once a schedule that is affordable under the upper bounds is packed, no later schedule is read.
+        The pruning is conservative (up to float tolerance), so the demand at any price vector within the bounds does not change.
+        Call with no arguments to stop pruning.
+
+        >>> preferred_schedule = {"Alice": [[1, 1, 0], [1, 0, 1], [0, 1, 1], [1, 0, 0], [0, 1, 0], [0, 0, 1]]}
+        >>> oracle = DemandOracle(["c1", "c2", "c3"], [1, 1, 1], {"Alice": 2.5}, preferred_schedule)
+        >>> oracle.num_of_rows
+        6
+        >>> oracle.set_price_bounds(np.array([2.6, 0.1, 0.1]), np.array([3.0, 1.0, 1.0]))
+        >>> oracle.schedules.tolist()    # c1+c2 and c1+c3 are never affordable; c2+c3 is always affordable.
+        [[0, 1, 1]]
+        >>> oracle.excess_demand(np.array([2.8, 0.5, 0.5]))
+        array([-1,  0,  0])
+        """
+        if lower_bounds is None and upper_bounds is None:
+            self.price_lower_bounds = self.price_upper_bounds = None
+        else:
+            self.price_lower_bounds = np.zeros(self.num_of_items) if lower_bounds is None else np.asarray(lower_bounds, dtype=float)
+            self.price_upper_bounds = np.full(self.num_of_items, np.inf) if upper_bounds is None else np.asarray(upper_bounds, dtype=float)
+        self._memo = {}
+        self._reset_blocks()
+
+    def price_array(self, price_vector:dict)->np.ndarray:
+        return np.array([price_vector[item] for item in self.items], dtype=float)
+
+
+    ### Packing
+
+    def _read_schedules(self, student_index:int, count:int):
+        """
+        Read more schedules of the given student from its ranking, until its block has `count` schedules or the ranking ends.
+        """
+        schedules = self.preferred_schedule[self.students[student_index]]
+        block = self._blocks[student_index]
+        columns = self._student_columns[student_index]
+        position = self._next_position[student_index]
+        while len(block) < count and not self._exhausted[student_index]:
+            if columns is not None:     # a ScheduleRanking
+                try:
+                    schedule = tuple(sorted(columns[index] for index in schedules.indices(position)))
+                except IndexError:
+                    self._exhausted[student_index] = True
+                    break
+            else:                       # a list of 0/1 vectors over self.items
+                if position >= len(schedules):
+                    self._exhausted[student_index] = True
+                    break
+                schedule = tuple(np.flatnonzero(schedules[position]))
+            position += 1
+            if self.price_lower_bounds is None:
+                block.append(schedule)
+            else:
+                self._append_unless_pruned(student_index, schedule)
+        self._next_position[student_index] = position
+
+    def _append_unless_pruned(self, student_index:int, schedule:tuple):
+        budget = self.budget_array[student_index]
+        tolerance = 1e-9 * max(1.0, abs(budget))
+        lower_cost = self.price_lower_bounds[list(schedule)].sum()
+        upper_cost = self.price_upper_bounds[list(schedule)].sum()
+        if lower_cost > budget + tolerance:                                     # never affordable
+            return
+        if lower_cost >= self._min_upper_cost[student_index] + tolerance:      # dominated by a preferred schedule
+            return
+        self._blocks[student_index].append(schedule)
+        self._min_upper_cost[student_index] = min(self._min_upper_cost[student_index], upper_cost)
+        if upper_cost <= budget - tolerance:                                    # always affordable: no later schedule can be chosen
+            self._exhausted[student_index] = True
+
+    def _pack(self):
+        """
+        Rebuild the contiguous arrays from the per-student blocks:
+        * schedules:   int8 matrix; row r is the 0/1 vector of the r-th packed schedule.
+        * row_items:   the course indices of each row, padded with the index num_of_items (a dummy course with price 0).
+        * row_student: the index of the student of each row.
+        * offsets:     the rows of student s are offsets[s] .. offsets[s+1]-1.
+        """
+        rows_per_student = np.array([len(block) for block in self._blocks], dtype=int)
+        self.offsets = np.concatenate(([0], np.cumsum(rows_per_student)))
+        self.num_of_rows = int(self.offsets[-1])
+        self.row_student = np.repeat(np.arange(self.num_of_students), rows_per_student)
+        max_schedule_size = max([len(schedule) for block in self._blocks for schedule in block], default=0)
+        self.row_items = np.full((self.num_of_rows, max(max_schedule_size, 1)), self.num_of_items, dtype=np.int32)
+        row = 0
+        for block in self._blocks:
+            for schedule in block:
+                self.row_items[row, :len(schedule)] = schedule
+                row += 1
+        schedules_with_dummy_course = np.zeros((self.num_of_rows, self.num_of_items + 1), dtype=np.int8)
+        schedules_with_dummy_course[np.arange(self.num_of_rows)[:, np.newaxis], self.row_items] = 1
+        self.schedules = np.ascontiguousarray(schedules_with_dummy_course[:, :self.num_of_items])
+        self._float_schedules = self.schedules.astype(float)
+        self._nonempty_students = np.flatnonzero(rows_per_student > 0)
+        self._row_budget = self.budget_array[self.row_student]
+        self._column_cumsums = {}
+        logger.debug("Packed %d schedules of %d students", self.num_of_rows, self.num_of_students)
+
+    def _grow(self, student_indices):
+        """
+        Double the packed prefix of each of the given students, and re-pack.
+        """
+        for student_index in student_indices:
+            self._read_schedules(student_index, 2 * len(self._blocks[student_index]) + 1)
+        self._pack()
+
+
+    ### Queries
+
+    def schedule_costs(self, price_matrix:np.ndarray)->np.ndarray:
+        """
+        The cost of every packed schedule under each of the given price vectors:
+        a (num_of_rows x K) matrix, computed by a single matrix multiplication.
+        """
+        return self._float_schedules @ price_matrix.T
+
+    def best_rows_batch(self, price_matrix:np.ndarray)->np.ndarray:
+        """
+        For each price vector (row of price_matrix) and each student, the packed row of the first affordable schedule
+        in the student's ranking, or -1 if there is none. Returns a (K x num_of_students) matrix.
+        """
+        num_of_vectors = len(price_matrix)
+        while True:
+            best = np.full((num_of_vectors, self.num_of_students), -1, dtype=int)
+            if self.num_of_rows > 0:
+                affordable = self.schedule_costs(price_matrix) <= self._row_budget[:, np.newaxis]
+                candidate_rows = np.where(affordable, np.arange(self.num_of_rows)[:, np.newaxis], self.num_of_rows)
+                first_rows = np.minimum.reduceat(candidate_rows, self.offsets[self._nonempty_students], axis=0).T
+                best[:, self._nonempty_students] = np.where(first_rows < self.num_of_rows, first_rows, -1)
+            students_to_grow = np.flatnonzero((best < 0).any(axis=0) & ~self._exhausted)
+            if len(students_to_grow) == 0:
+                return best
+            self._grow(students_to_grow)
+
+    def best_rows(self, prices:np.ndarray)->np.ndarray:
+        """
+        For each student, the packed row of the first affordable schedule in the student's ranking, or -1 if there is none.
+        """
+        return self.best_rows_batch(np.asarray(prices, dtype=float)[np.newaxis, :])[0]
+
+    def excess_demand_batch(self, price_matrix:np.ndarray)->tuple:
+        """
+        Evaluate K candidate price vectors at once.
+
+        :param price_matrix: a (K x num_of_items) matrix; each row is a price vector.
+        :return: a tuple (excess_demands, alphas): a (K x num_of_items) matrix of excess demands,
+                 and the clearing error (alpha) of each price vector.
+
+        The results are memoized by the exact price vector, so evaluating the same vector again
+        (e.g. the neighbor chosen by the tabu search) costs a single dictionary lookup.
+
+        >>> oracle = DemandOracle(["c1", "c2"], [1, 1], {"Alice": 1.0, "Bob": 1.0}, {"Alice": [[1, 0], [0, 1]], "Bob": [[1, 0], [0, 1]]})
+        >>> excess_demands, alphas = oracle.excess_demand_batch(np.array([[0.5, 0.5], [1.5, 0.5], [1.5, 1.5]]))
+        >>> excess_demands
+        array([[ 1, -1],
+               [-1,  1],
+               [-1, -1]])
+        >>> alphas
+        array([1.41421356, 1.41421356, 1.41421356])
+        >>> oracle.num_of_memoized
+        3
+        """
+        price_matrix = np.atleast_2d(np.asarray(price_matrix, dtype=float))
+        keys = [prices.tobytes() for prices in price_matrix]
+        results = {key: self._memo[key] for key in keys if key in self._memo}
+        missing = [index for index, key in enumerate(keys) if key not in results]
+        if missing:
+            best = self.best_rows_batch(price_matrix[missing])
+            if len(self._memo) + len(missing) > self.max_memo_size:
+                self._memo.clear()
+            for best_rows, index in zip(best, missing):
+                demand = self.schedules[best_rows[best_rows >= 0]].sum(axis=0, dtype=int)
+                results[keys[index]] = self._memo[keys[index]] = demand - self.item_capacities
+        excess_demands = np.array([results[key] for key in keys], dtype=int).reshape(len(keys), self.num_of_items)
+        alphas = np.sqrt(np.sum(excess_demands ** 2, axis=1))
+        return excess_demands, alphas
+
+    @property
+    def num_of_memoized(self)->int:
+        return len(self._memo)
+
+    def demand(self, prices:np.ndarray)->np.ndarray:
+        """
+        The number of students who demand each course under the given prices.
+        """
+        return self.excess_demand(prices) + self.item_capacities
+
+    def excess_demand(self, prices:np.ndarray)->np.ndarray:
+        """
+        The demand of each course minus its capacity, under the given prices.
+
+        When the prices differ from the previously evaluated prices in a single course
+        (as in the binary search of remove-oversubscription), only the students affected by this course are re-solved.
+        """
+        prices = np.asarray(prices, dtype=float)
+        key = prices.tobytes()
+        if key in self._memo:
+            return self._memo[key]
+        changed_courses = np.flatnonzero(self._incremental.prices != prices) if self._incremental is not None else []
+        if self._incremental is not None and len(changed_courses) == 1:
+            self._incremental.set_price(changed_courses[0], prices[changed_courses[0]])
+        else:
+            self._incremental = IncrementalDemand(self, prices)
+        excess_demand = self._incremental.demand - self.item_capacities
+        if len(self._memo) >= self.max_memo_size:
+            self._memo.clear()
+        self._memo[key] = excess_demand
+        return excess_demand
+
+    def switch_price(self, prices:np.ndarray, course:int)->float:
+        """
+        The smallest price of the given course, above its current price, at which some student who currently demands it
+        can no longer afford the chosen schedule (so the demand changes). Returns inf if no student demands the course.
+
+        For each such student, the breakpoint is the current price plus the student's remaining budget;
+        it is then moved up by the smallest float steps until the chosen schedule is really unaffordable.
+
+        >>> preferred_schedule = {"Alice": [[1, 0, 1], [0, 1, 1]], "Bob": [[1, 1, 0], [0, 1, 1]], "Tom": [[0, 1, 1]]}
+        >>> oracle = DemandOracle(["c1", "c2", "c3"], [1, 2, 2], {"Alice": 2.0, "Bob": 2.5, "Tom": 2.3}, preferred_schedule)
+        >>> oracle.switch_price(np.array([1.0, 1.0, 1.0]), 0)     # Alice has no remaining budget
+        1.0000000000000004
+        >>> oracle.switch_price(np.array([0.5, 1.0, 1.0]), 0)     # Alice has 0.5 left and Bob 1.0
+        1.0000000000000004
+        >>> oracle.switch_price(np.array([1.0, 1.0, 1.0]), 1) > 1.3     # Tom has 0.3 left
+        True
+        """
+        prices = np.array(prices, dtype=float)
+        best = self.best_rows(prices)
+        demanders = np.flatnonzero((best >= 0) & (self.schedules[np.maximum(best, 0), course] == 1))
+        switch_price = np.inf
+        for student in demanders:
+            row = best[student]
+            budget = self._row_budget[row]
+            remaining_budget = budget - self._float_schedules[row] @ prices
+            new_prices = prices.copy()
+            new_prices[course] = max(prices[course] + remaining_budget, prices[course])
+            while self._float_schedules[row] @ new_prices <= budget:
+                new_prices[course] = np.nextafter(new_prices[course], np.inf)
+            switch_price = min(switch_price, new_prices[course])
+        return float(switch_price)
+
+    def incremental(self, prices:np.ndarray)->"IncrementalDemand":
+        """
+        Start an incremental demand computation at the given prices.
+        """
+        return IncrementalDemand(self, np.asarray(prices, dtype=float))
+
+    def _first_affordable_ranks(self, prices:np.ndarray, students:np.ndarray)->np.ndarray:
+        """
+        For each of the given students, the rank (in the student's own ranking) of the first affordable schedule, or -1 if there is none.
+        Ranks, unlike packed rows, do not change when the oracle is re-packed.
+        """
+        ranks = np.full(len(students), -1, dtype=int)
+        pending = np.arange(len(students))
+        while len(pending) > 0:
+            pending_students = students[pending]
+            starts = self.offsets[pending_students]
+            lengths = self.offsets[pending_students + 1] - starts
+            block_starts = np.cumsum(lengths) - lengths
+            local_ranks = np.arange(lengths.sum()) - np.repeat(block_starts, lengths)
+            rows = np.repeat(starts, lengths) + local_ranks
+            affordable = self._float_schedules[rows] @ prices <= self._row_budget[rows]
+            nonempty = lengths > 0
+            found = np.zeros(len(pending), dtype=bool)
+            if nonempty.any():
+                candidate_ranks = np.where(affordable, local_ranks, np.iinfo(int).max)
+                first_ranks = np.minimum.reduceat(candidate_ranks, block_starts[nonempty])
+                found[nonempty] = first_ranks < np.iinfo(int).max
+                ranks[pending[nonempty]] = np.where(found[nonempty], first_ranks, -1)
+            pending = pending[~found & ~self._exhausted[pending_students]]
+            if len(pending) > 0:
+                self._grow(students[pending])
+        return ranks
+
+    def _column_cumsum(self, column:int)->np.ndarray:
+        """
+        The running count of packed rows that contain the given course: element r is the number of such rows before row r.
+        """
+        if column not in self._column_cumsums:
+            self._column_cumsums[column] = np.concatenate(([0], np.cumsum(self.schedules[:, column], dtype=int)))
+        return self._column_cumsums[column]
+
+    def best_schedules(self, prices:np.ndarray)->list:
+        """
+        For each student, the first affordable schedule (a 0/1 list), or all-zeros if there is none.
+        """
+        best = self.best_rows(prices)
+        return [self.schedules[row].tolist() if row >= 0 else [0] * self.num_of_items for row in best]
+
+
+    ### Mapping interface: student -> preferred schedules
+
+    def __getitem__(self, student):
+        return self.preferred_schedule[student]
+
+    def __iter__(self):
+        return iter(self.preferred_schedule)
+
+    def __len__(self):
+        return len(self.preferred_schedule)
+
+    def __repr__(self):
+        return f"DemandOracle({self.num_of_students} students, {self.num_of_items} courses, {self.num_of_rows} packed schedules)"
+
+
+class IncrementalDemand:
+    """
+    The demand at a price vector, updated incrementally when the price of a single course changes.
+
+    A change in the price of course j can change only the choice of students who rank some schedule with course j
+    at or above their current choice: their current choice may become unaffordable, or a schedule they rejected may become affordable.
+    Only these students are re-solved, and the aggregate demand is updated by the difference.
+
+    >>> preferred_schedule = {"Alice": [[1, 0, 1], [0, 1, 1], [1, 1, 0]], "Bob": [[1, 1, 0], [1, 0, 1], [0, 1, 1]], "Tom": [[0, 1, 1]]}
+    >>> oracle = DemandOracle(["c1", "c2", "c3"], [1, 2, 2], {"Alice": 2.0, "Bob": 2.1, "Tom": 2.3}, preferred_schedule)
+    >>> demand = oracle.incremental(np.array([1.0, 1.0, 1.0]))
+    >>> demand.demand
+    array([2, 2, 2])
+    >>> demand.affected_students(0)    # Tom never takes c1
+    array([0, 1])
+    >>> demand.set_price(0, 1.5)
+    >>> demand.demand
+    array([0, 3, 3])
+    """
+
+    def __init__(self, oracle:DemandOracle, prices:np.ndarray):
+        self.oracle = oracle
+        self.prices = np.array(prices, dtype=float)
+        self.ranks = oracle._first_affordable_ranks(self.prices, np.arange(oracle.num_of_students))
+        self.demand = self._demand_of(np.arange(oracle.num_of_students))
+
+    def _demand_of(self, students:np.ndarray)->np.ndarray:
+        ranks = self.ranks[students]
+        chosen = ranks >= 0
+        rows = self.oracle.offsets[students[chosen]] + ranks[chosen]
+        return self.oracle.schedules[rows].sum(axis=0, dtype=int)
+
+    def affected_students(self, course:int)->np.ndarray:
+        """
+        The students whose packed schedules, up to and including the current choice, contain the given course
+        (all packed schedules, for students who can afford none; their ranking is then fully packed).
+        """
+        offsets = self.oracle.offsets
+        column_cumsum = self.oracle._column_cumsum(course)
+        ends = np.where(self.ranks >= 0, offsets[:-1] + self.ranks + 1, offsets[1:])
+        return np.flatnonzero(column_cumsum[ends] > column_cumsum[offsets[:-1]])
+
+    def set_price(self, course:int, price:float):
+        """
+        Change the price of a single course, and re-solve only the affected students.
+        """
+        affected = self.affected_students(course)
+        self.prices[course] = price
+        if len(affected) > 0:
+            self.demand = self.demand - self._demand_of(affected)
+            self.ranks[affected] = self.oracle._first_affordable_ranks(self.prices, affected)
+            self.demand = self.demand + self._demand_of(affected)
+        logger.debug("Price of course %d set to %g: re-solved %d students", course, price, len(affected))
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
@@ -0,0 +1,141 @@
+"""
+A fairness audit of a Course Match allocation, to run on every allocation before it is published.
+
+Given the students' valuations, their bundles and (optionally) their budgets, the audit finds all the violations of:
+* envy-freeness: student i envies student k if u_i(X_k) > u_i(X_i);
+* EF1 (envy-freeness up to one item): u_i(X_k) - max_{j in X_k} u_i(j) > u_i(X_i), i.e., i envies k even after removing the item of k's bundle that i values most;
+* EF-TB (envy-freeness but for tie-breaks, Budish 2011): i envies k although i has a larger budget than k;
+* budget-weighted envy: u_i(X_k) * b_i / b_k > u_i(X_i), i.e., i envies k after scaling k's bundle by the ratio of their budgets.
+
+Everything is computed with matrix operations, block by block over the students, so the memory is bounded even for large cohorts.
+
+Since: 2026-10
+"""
+
+import numpy as np
+from fairpyx import Instance
+from fairpyx.satisfaction import valuation_and_allocation_matrices, bundle_item_indices, DEFAULT_TILE_SIZE
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+CRITERIA = ("envy", "ef1", "eftb", "budget_weighted_envy")
+
+
+class FairnessAudit:
+    """
+    The violations of the fairness criteria in an allocation.
+    Each violation is a pair of students (i,k) with a positive magnitude: the envy of i in k (for "envy" and "eftb"),
+    the envy of i in k minus the value of the best item in k's bundle (for "ef1"), or u_i(X_k) * b_i / b_k - u_i(X_i) (for "budget_weighted_envy").
+
+    >>> instance = Instance(
+    ...   valuations = {"Alice": {"c1": 50, "c2": 40, "c3": 10}, "Bob": {"c1": 50, "c2": 40, "c3": 10}, "Chana": {"c1": 10, "c2": 20, "c3": 30}},
+    ...   agent_capacities = 2)
+    >>> audit = FairnessAudit(instance, {"Alice": ["c1", "c2"], "Bob": [], "Chana": ["c3"]}, budget={"Alice": 1.1, "Bob": 1.2, "Chana": 1.0})
+    >>> audit.violations("envy")
+    [('Bob', 'Alice', 90.0), ('Bob', 'Chana', 10.0)]
+    >>> audit.violations("ef1")
+    [('Bob', 'Alice', 40.0)]
+    >>> audit.violations("eftb")
+    [('Bob', 'Alice', 90.0), ('Bob', 'Chana', 10.0)]
+    >>> audit.violations("budget_weighted_envy")
+    [('Bob', 'Alice', 98.18181818181817), ('Bob', 'Chana', 12.0)]
+    >>> audit.is_fair("ef1"), audit.is_fair("eftb")
+    (False, False)
+    >>> audit.summary()["max_ef1_violation"]
+    40.0
+    """
+
+    def __init__(self, instance:Instance, allocation:dict, budget:dict=None, tolerance:float=1e-9, tile_size:int=DEFAULT_TILE_SIZE):
+        """
+        :param instance: the Course Match instance.
+        :param allocation: a dict mapping each student to its bundle (a list of courses).
+        :param budget: a dict mapping each student to its budget; required for the "eftb" and "budget_weighted_envy" criteria.
+        :param tolerance: differences of at most this size are not considered violations.
+        :param tile_size: the maximum number of entries in the temporary arrays of a block of students (at least one student is processed at a time).
+        """
+        self.agents = list(instance.agents)
+        self.budget = budget
+        self.tolerance = tolerance
+        valuation_matrix, allocation_matrix = valuation_and_allocation_matrices(instance, allocation)
+        valuation_matrix = valuation_matrix.astype(float)
+        num_of_agents = len(self.agents)
+        budgets = np.array([budget[agent] for agent in self.agents], dtype=float) if budget is not None else None
+
+        bundle_items = bundle_item_indices(allocation_matrix)      # padded with the index of an extra column of -inf values
+        block_size = max(1, tile_size // (num_of_agents * bundle_items.shape[1] or 1))
+        bundles_transposed = allocation_matrix.T.astype(float)
+        found = {criterion: [] for criterion in CRITERIA}       # lists of (agent indices, other-agent indices, magnitudes) of each block
+        for start in range(0, num_of_agents, block_size):
+            rows = np.arange(start, min(start + block_size, num_of_agents))
+            block_values = valuation_matrix[rows]
+            bundle_values = block_values @ bundles_transposed       # [i,k] = the value of agent rows[i] to the bundle of agent k
+            own_values = bundle_values[np.arange(len(rows)), rows]
+            envy = bundle_values - own_values[:, None]
+            envious, envied = np.nonzero(envy > tolerance)
+            magnitudes = envy[envious, envied]
+            found["envy"].append((rows[envious], envied, magnitudes))
+
+            extended_values = np.concatenate((block_values, np.full((len(rows), 1), -np.inf)), axis=1)
+            ef1_magnitudes = magnitudes - extended_values[envious[:, None], bundle_items[envied]].max(axis=1)
+            violating = ef1_magnitudes > tolerance
+            found["ef1"].append((rows[envious[violating]], envied[violating], ef1_magnitudes[violating]))
+
+            if budgets is not None:
+                violating = budgets[rows[envious]] > budgets[envied]
+                found["eftb"].append((rows[envious[violating]], envied[violating], magnitudes[violating]))
+                weighted_envy = bundle_values * (budgets[rows, None] / budgets[None, :]) - own_values[:, None]
+                envious_by_budget, envied_by_budget = np.nonzero(weighted_envy > tolerance)
+                found["budget_weighted_envy"].append((rows[envious_by_budget], envied_by_budget, weighted_envy[envious_by_budget, envied_by_budget]))
+
+        self._violations = {}
+        for criterion, blocks in found.items():
+            if budgets is None and criterion in ("eftb", "budget_weighted_envy"):
+                continue
+            agent_indices, other_indices, magnitudes = (np.concatenate(arrays) for arrays in zip(*blocks)) if blocks else (np.zeros(0, dtype=int),)*2 + (np.zeros(0),)
+            order = np.lexsort((other_indices, agent_indices, -magnitudes))       # by descending magnitude
+            self._violations[criterion] = (agent_indices[order], other_indices[order], magnitudes[order])
+        logger.info("Fairness audit: %s", self.summary())
+
+    def _check_criterion(self, criterion:str):
+        if criterion not in CRITERIA:
+            raise ValueError(f"criterion should be one of {CRITERIA}, not {criterion!r}")
+        if criterion not in self._violations:
+            raise ValueError(f"The criterion {criterion!r} requires the budgets of the students")
+
+    def violations(self, criterion:str)->list:
+        """
+        All the violations of the given criterion, as (agent, other_agent, magnitude) tuples, sorted by descending magnitude.
+        """
+        self._check_criterion(criterion)
+        agent_indices, other_indices, magnitudes = self._violations[criterion]
+        return [(self.agents[agent], self.agents[other], magnitude) for agent, other, magnitude in zip(agent_indices.tolist(), other_indices.tolist(), magnitudes.tolist())]
+
+    def num_of_violations(self, criterion:str)->int:
+        self._check_criterion(criterion)
+        return len(self._violations[criterion][2])
+
+    def max_violation(self, criterion:str)->float:
+        """ The largest magnitude of a violation of the given criterion (0 if there are none). """
+        self._check_criterion(criterion)
+        return self._violations[criterion][2].max(initial=0).item()
+
+    def is_fair(self, criterion:str)->bool:
+        return self.num_of_violations(criterion) == 0
+
+    def summary(self)->dict:
+        """ The number of violations, and the maximum violation, of each criterion that was checked. """
+        summary = {}
+        for criterion in self._violations:
+            summary[f"num_of_{criterion}_violations"] = self.num_of_violations(criterion)
+            summary[f"max_{criterion}_violation"] = self.max_violation(criterion)
+        return summary
+
+    def __repr__(self)->str:
+        return f"FairnessAudit({len(self.agents)} students, {self.summary()})"
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
@@ -0,0 +1,230 @@
+"""
+A demand backend for Course Match that does not enumerate schedules.
+
+When students have a high capacity and many acceptable courses, the number of schedules of a single student is astronomical,
+and even the lazy ScheduleRanking may have to generate millions of schedules before it reaches an affordable one.
+The KnapsackDemandOracle instead solves, for each student and each price vector, the problem
+"find the best schedule whose cost is within the budget" directly, as a knapsack with conflict constraints,
+by branch-and-bound. The best schedule at the previous price vector is used as a warm start.
+
+Since: 2026-10
+"""
+
+import numpy as np
+from math import comb
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def estimate_num_of_schedules(num_of_items:int, capacity:int)->int:
+    """
+    An upper bound on the number of schedules of a student (ignoring conflicts).
+
+    >>> estimate_num_of_schedules(5, 2)
+    15
+    >>> estimate_num_of_schedules(100, 6) > 10**9
+    True
+    """
+    return sum(comb(num_of_items, size) for size in range(1, min(capacity, num_of_items) + 1))
+
+
+def best_affordable_schedule(values:list, capacity:int, prices:np.ndarray, budget:float, forbidden_items:set=frozenset(), conflicting_items:dict={}, incumbent:tuple=None)->tuple:
+    """
+    Find the first affordable schedule in the preference order of `iterate_schedules_in_preference_order`:
+    the affordable schedule with the highest value; ties are broken by a larger number of items, and then by the lexicographically smallest item indices.
+
+    :param values: the student's value for each item.
+    :param capacity: maximum number of items in a schedule.
+    :param prices: the price of each item.
+    :param budget: the student's budget.
+    :param forbidden_items: indices of items that the student cannot take.
+    :param conflicting_items: maps an item index to a set of item indices that cannot be taken together with it.
+    :param incumbent: a schedule that is known to be feasible (e.g. the student's choice at the previous prices); used as a warm start if it is still affordable.
+
+    :return: a tuple of the (ascending) item indices in the schedule, or an empty tuple if no schedule is affordable.
+
+    >>> best_affordable_schedule([90, 60, 50], 2, np.array([1.0, 1.0, 1.0]), 2.0)
+    (0, 1)
+    >>> best_affordable_schedule([90, 60, 50], 2, np.array([1.5, 1.0, 1.0]), 2.0)
+    (1, 2)
+    >>> best_affordable_schedule([90, 60, 50], 2, np.array([1.5, 1.0, 1.0]), 2.0, conflicting_items={1: {2}, 2: {1}})
+    (0,)
+    >>> best_affordable_schedule([90, 60, 50], 2, np.array([3.0, 3.0, 3.0]), 2.0)
+    ()
+    >>> best_affordable_schedule([90, 60, 50], 2, np.array([3.0, 3.0, -1.5]), 2.0)
+    (0, 2)
+    """
+    allowed_items = [item for item in range(len(values)) if item not in forbidden_items]
+    max_refund = -sum(min(prices[item], 0) for item in allowed_items)     # negative prices (e.g. in gradient steps) can make room in the budget
+    positions = sorted((item for item in allowed_items if prices[item] <= budget + max_refund), key=lambda item: (-values[item], item))
+    num_of_positions = len(positions)
+    sorted_values = [values[item] for item in positions]
+    prefix_values = np.concatenate(([0], np.cumsum(sorted_values))) if num_of_positions > 0 else [0]
+    suffix_refunds = np.concatenate((np.cumsum([-min(prices[item], 0) for item in reversed(positions)])[::-1], [0])) if num_of_positions > 0 else [0]
+
+    best_value, best_size, best_schedule = -np.inf, 0, ()
+    def consider(value, schedule:tuple):
+        nonlocal best_value, best_size, best_schedule
+        if (value, len(schedule)) > (best_value, best_size) or ((value, len(schedule)) == (best_value, best_size) and schedule < best_schedule):
+            best_value, best_size, best_schedule = value, len(schedule), schedule
+
+    if incumbent and sum(prices[item] for item in incumbent) <= budget:
+        consider(sum(values[item] for item in incumbent), tuple(sorted(incumbent)))
+
+    # The budget relaxation: the fractional knapsack on the undecided items, taken by descending value-to-price ratio.
+    positions_by_ratio = sorted(range(num_of_positions), key=lambda position: -sorted_values[position] / prices[positions[position]] if prices[positions[position]] > 0 else -np.inf)
+    tolerance = 1e-9 * max(1.0, float(prefix_values[-1]))
+    def fractional_bound(position:int, remaining_budget:float)->float:
+        bound = 0.0
+        for other in positions_by_ratio:
+            if other < position:
+                continue
+            price = prices[positions[other]]
+            if price <= 0:      # items with non-positive prices come first in the ratio order
+                bound += sorted_values[other]
+                remaining_budget -= price
+            elif remaining_budget < 0:
+                return -np.inf
+            elif price <= remaining_budget:
+                bound += sorted_values[other]
+                remaining_budget -= price
+            else:
+                return bound + sorted_values[other] * remaining_budget / price
+        return bound if remaining_budget >= 0 else -np.inf
+
+    # Depth-first search over positions (items sorted by value); each node decides whether to take the item at `position`.
+    # A node is pruned by the cardinality relaxation (the most valuable undecided items that fit in the capacity) and by the budget relaxation.
+    stack = [(0, (), 0, 0.0)]      # (position, chosen items, value, cost)
+    while stack:
+        position, chosen, value, cost = stack.pop()
+        remaining_capacity = capacity - len(chosen)
+        if position >= num_of_positions or remaining_capacity <= 0:
+            continue
+        last = min(position + remaining_capacity, num_of_positions)
+        bound = value + prefix_values[last] - prefix_values[position]
+        if bound < best_value or (bound == best_value and len(chosen) + last - position < best_size):
+            continue
+        if value + fractional_bound(position, budget - cost) < best_value - tolerance:
+            continue
+        stack.append((position + 1, chosen, value, cost))          # skip the item
+        item = positions[position]
+        new_cost = cost + prices[item]
+        if new_cost <= budget + suffix_refunds[position + 1] and not any(other in conflicting_items.get(item, ()) for other in chosen):
+            new_chosen = chosen + (item,)
+            new_value = value + values[item]
+            if new_cost <= budget:
+                consider(new_value, tuple(sorted(new_chosen)))
+            stack.append((position + 1, new_chosen, new_value, new_cost))    # take the item (explored first)
+    return best_schedule
+
+
+class KnapsackDemandOracle:
+    """
+    A demand oracle with the same query interface as DemandOracle, that solves each student's demand by branch-and-bound.
+
+    >>> from fairpyx.algorithms.course_match.schedule_ranking import ScheduleRanking
+    >>> rankings = {"Alice": ScheduleRanking(["c1", "c2", "c3"], {"c1": 90, "c2": 60, "c3": 50}, capacity=2),
+    ...             "Bob":   ScheduleRanking(["c1", "c2", "c3"], {"c1": 50, "c2": 81, "c3": 60}, capacity=2, item_conflicts={"c2": ["c3"]})}
+    >>> oracle = KnapsackDemandOracle(["c1", "c2", "c3"], [1, 1, 1], {"Alice": 2.0, "Bob": 2.1}, rankings)
+    >>> oracle.best_schedules(np.array([1.0, 1.0, 1.0]))
+    [[1, 1, 0], [1, 1, 0]]
+    >>> oracle.excess_demand(np.array([1.5, 1.0, 1.0]))
+    array([-1,  1,  0])
+    """
+
+    def __init__(self, items:list, item_capacities:list, budget:dict, preferred_schedule:dict, max_memo_size:int=100000):
+        """
+        :param items: the courses, in the order of the price vectors that will be sent to the oracle.
+        :param item_capacities: the capacity of each course, in the same order.
+        :param budget: maps each student to its budget.
+        :param preferred_schedule: maps each student to a ScheduleRanking; only its values, capacity and conflicts are used (nothing is enumerated).
+        :param max_memo_size: how many evaluated price vectors to remember.
+        """
+        self.items = list(items)
+        self.num_of_items = len(self.items)
+        self.item_capacities = np.asarray(item_capacities, dtype=int)
+        self.preferred_schedule = preferred_schedule
+        self.students = list(preferred_schedule.keys())
+        self.num_of_students = len(self.students)
+        self.max_memo_size = max_memo_size
+        map_item_to_column = {item: column for column, item in enumerate(self.items)}
+        self._student_columns = [np.array([map_item_to_column[item] for item in ranking.items], dtype=int) for ranking in preferred_schedule.values()]
+        self._previous_choice = [None] * self.num_of_students     # warm starts: the last choice of each student.
+        self.set_budget(budget)
+
+    def set_budget(self, budget:dict):
+        self.budget = budget
+        self.budget_array = np.array([budget[student] for student in self.students], dtype=float)
+        self._memo = {}
+
+    def set_price_bounds(self, lower_bounds:np.ndarray=None, upper_bounds:np.ndarray=None):
+        pass    # nothing is enumerated, so there is nothing to prune.
+
+    def price_array(self, price_vector:dict)->np.ndarray:
+        return np.array([price_vector[item] for item in self.items], dtype=float)
+
+    def choices(self, prices:np.ndarray)->list:
+        """
+        For each student, the columns of the best affordable schedule (an empty tuple if none).
+        """
+        prices = np.asarray(prices, dtype=float)
+        choices = []
+        for student_index, ranking in enumerate(self.preferred_schedule.values()):
+            columns = self._student_columns[student_index]
+            schedule = best_affordable_schedule(
+                ranking._values, ranking.capacity, prices[columns], self.budget_array[student_index],
+                ranking._forbidden_indices, ranking._conflicting_items, self._previous_choice[student_index])
+            self._previous_choice[student_index] = schedule
+            choices.append(tuple(sorted(columns[index] for index in schedule)))
+        return choices
+
+    def best_schedules(self, prices:np.ndarray)->list:
+        result = []
+        for choice in self.choices(prices):
+            vector = [0] * self.num_of_items
+            for column in choice:
+                vector[column] = 1
+            result.append(vector)
+        return result
+
+    def excess_demand(self, prices:np.ndarray)->np.ndarray:
+        prices = np.asarray(prices, dtype=float)
+        key = prices.tobytes()
+        if key not in self._memo:
+            demand = np.zeros(self.num_of_items, dtype=int)
+            for choice in self.choices(prices):
+                demand[list(choice)] += 1
+            if len(self._memo) >= self.max_memo_size:
+                self._memo.clear()
+            self._memo[key] = demand - self.item_capacities
+        return self._memo[key]
+
+    def excess_demand_batch(self, price_matrix:np.ndarray)->tuple:
+        excess_demands = np.array([self.excess_demand(prices) for prices in np.atleast_2d(price_matrix)], dtype=int).reshape(-1, self.num_of_items)
+        return excess_demands, np.sqrt(np.sum(excess_demands ** 2, axis=1))
+
+    def switch_price(self, prices:np.ndarray, course:int)->float:
+        """
+        The smallest price of the given course at which some student who currently demands it can no longer afford the chosen schedule.
+        """
+        prices = np.array(prices, dtype=float)
+        switch_price = np.inf
+        for student_index, choice in enumerate(self.choices(prices)):
+            if course not in choice:
+                continue
+            budget = self.budget_array[student_index]
+            new_prices = prices.copy()
+            new_prices[course] = max(prices[course] + budget - prices[list(choice)].sum(), prices[course])
+            while new_prices[list(choice)].sum() <= budget:
+                new_prices[course] = np.nextafter(new_prices[course], np.inf)
+            switch_price = min(switch_price, new_prices[course])
+        return float(switch_price)
+
+    def __repr__(self):
+        return f"KnapsackDemandOracle({self.num_of_students} students, {self.num_of_items} courses)"
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
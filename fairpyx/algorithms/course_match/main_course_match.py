@@ -13,48 +13,56 @@ from fairpyx.allocations import AllocationBuilder
 from fairpyx.algorithms.course_match import A_CEEI
 from fairpyx.algorithms.course_match import remove_oversubscription
 from fairpyx.algorithms.course_match import reduce_undersubscription
+from fairpyx.algorithms.course_match.preference_cache import PreferenceCache
+from fairpyx.algorithms.course_match.schedule_store import ScheduleStore
+from fairpyx.algorithms.course_match.fairness_audit import FairnessAudit
 import logging
+logger = logging.getLogger(__name__)
 # logging.basicConfig(level=logging.INFO)
 
-def course_match_algorithm(alloc: AllocationBuilder, budget: dict, priorities_student_list: list = [], time : int = 60):
+def course_match_algorithm(alloc: AllocationBuilder, budget: dict, priorities_student_list: list = [], time : int = 60, schedule_store: ScheduleStore = None):
     """
     Perform the Course Match algorithm to find the best course allocations.
     
     :param alloc: (AllocationBuilder) an allocation builder object
+    :param schedule_store: (ScheduleStore) an optional on-disk cache of the students' schedule rankings, reused across runs
 
     :return: (dict) course allocations
 
     """
-    price_vector = A_CEEI.A_CEEI(alloc,budget,time)
-    price_vector = remove_oversubscription.remove_oversubscription(alloc, price_vector, budget)
-    reduce_undersubscription.reduce_undersubscription(alloc, price_vector, budget, priorities_student_list)
+    preference_cache = PreferenceCache(alloc.instance, schedule_store)   # the schedule rankings are computed once, and shared by all stages
+    price_vector = A_CEEI.A_CEEI(alloc,budget,time, preference_cache=preference_cache)
+    preference_cache.save()
+    price_vector = remove_oversubscription.remove_oversubscription(alloc, price_vector, budget, preference_cache=preference_cache)
+    reduce_undersubscription.reduce_undersubscription(alloc, price_vector, budget, priorities_student_list, preference_cache=preference_cache)
+    preference_cache.save()
     return alloc
    
-def check_envy(res, instance : Instance):
-    alloc = AllocationBuilder(instance)
-    my_valuations = {agent: sum([alloc.instance._valuations[agent][item] for item in res[agent]]) for agent in res.keys()}
-    # print(my_valuations)
-    envy_agent = {agent : {} for agent in res.keys()}
-    for agent in res.keys():
-        for agent2 in res.keys():
-            if agent != agent2:
-                agent_val_sum_for_agent2_baskets = sum([alloc.instance._valuations[agent][item] for item in res[agent2]])
-                if agent_val_sum_for_agent2_baskets > my_valuations[agent]:
-                    envy_agent[agent][agent2] = agent_val_sum_for_agent2_baskets - my_valuations[agent]
+def check_envy(res, instance : Instance, budget: dict = None) -> FairnessAudit:
+    """
+    Check that the allocation is envy-free up to one item (EF1), using a FairnessAudit.
+
+    :param res: (dict) the allocation: maps each student to its courses
+    :param instance: (Instance) the Course Match instance
+    :param budget: (dict) optional budgets of the students; if given, the audit also checks EF-TB and budget-weighted envy
 
-    for agent in envy_agent.keys():
-        for agent2 in envy_agent[agent].keys():
-            agent_val_for_agent2_baskets= [alloc.instance._valuations[agent][item] for item in res[agent2]]
-            sum_val = sum(agent_val_for_agent2_baskets)
-            boolian_check_envy = False
-            for val in agent_val_for_agent2_baskets:
-                if  sum_val - val <= my_valuations[agent]:
-                    boolian_check_envy=True
-                    break
-            if not boolian_check_envy:
-                raise Exception(f"EF?!?! agent1 {agent} envies agent2 {agent2} by {envy_agent[agent][agent2]}")
-    print("check_envy done")
+    :return: (FairnessAudit) the audit of the allocation, with the full lists of violations
+    :raises Exception: if some student envies another student by more than one item; the message lists all the EF1 violations
 
+    >>> instance = Instance(valuations={"A": {"c1": 50, "c2": 40}, "B": {"c1": 50, "c2": 40}}, agent_capacities=2)
+    >>> check_envy({"A": ["c1"], "B": ["c2"]}, instance)
+    FairnessAudit(2 students, {'num_of_envy_violations': 1, 'max_envy_violation': 10.0, 'num_of_ef1_violations': 0, 'max_ef1_violation': 0.0})
+    >>> check_envy({"A": ["c1", "c2"], "B": []}, instance)
+    Traceback (most recent call last):
+    ...
+    Exception: EF1 is violated by 1 pairs of students: B envies A by 40.0 after removing one course
+    """
+    audit = FairnessAudit(instance, res, budget)
+    if not audit.is_fair("ef1"):
+        violations = ", ".join(f"{agent} envies {other} by {magnitude} after removing one course" for agent, other, magnitude in audit.violations("ef1"))
+        raise Exception(f"EF1 is violated by {audit.num_of_violations('ef1')} pairs of students: {violations}")
+    logger.info("check_envy done: %s", audit.summary())
+    return audit
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,115 @@
+"""
+A cache of the students' schedule rankings, shared by all the stages of Course Match.
+
+A-CEEI, remove-oversubscription and reduce-undersubscription all need the preference order of every student on schedules.
+The PreferenceCache of an instance computes these rankings once (lazily); course_match_algorithm passes it to every stage,
+together with restricted views (a student limited to a subset of the courses) for the aftermarket of reduce-undersubscription.
+
+Since: 2026-10
+"""
+
+from fairpyx import Instance
+from fairpyx.algorithms.course_match.schedule_ranking import ScheduleRanking
+from fairpyx.algorithms.course_match.demand_oracle import DemandOracle
+from fairpyx.algorithms.course_match.knapsack_demand import KnapsackDemandOracle, estimate_num_of_schedules
+from fairpyx.algorithms.course_match.schedule_store import ScheduleStore
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PreferenceCache:
+    """
+    The schedule rankings of all the students of an instance.
+
+    >>> instance = Instance(
+    ...   item_conflicts = {"c1": ["c2"], "c2": ["c1"], "c3": []},
+    ...   agent_capacities = {"Alice": 2, "Bob": 2},
+    ...   item_capacities  = {"c1": 1, "c2": 1, "c3": 1},
+    ...   valuations = {"Alice": {"c1": 90, "c2": 60, "c3": 50}, "Bob": {"c1": 50, "c2": 81, "c3": 60}})
+    >>> cache = PreferenceCache(instance)
+    >>> list(cache["Bob"])
+    [[0, 1, 1], [1, 0, 1], [0, 1, 0], [0, 0, 1], [1, 0, 0]]
+    >>> list(cache.restricted("Bob", ["c1", "c3"]))
+    [[1, 1], [0, 1], [1, 0]]
+    >>> cache.restricted("Bob", ["c3", "c1"]) is cache.restricted("Bob", ["c1", "c3"])
+    True
+    """
+
+    def __init__(self, instance:Instance, schedule_store:ScheduleStore=None, backend:str="auto", max_schedules_for_ranking:int=10**6):
+        """
+        :param instance: the Course Match instance.
+        :param schedule_store: an optional persistent store; rankings start from the stored schedules, and `save` extends the store.
+        :param backend: the demand backend: "ranking" (DemandOracle over the ranked schedules), "knapsack" (KnapsackDemandOracle),
+                        or "auto": "knapsack" if some student may have more than `max_schedules_for_ranking` schedules, otherwise "ranking".
+        """
+        if backend not in ("auto", "ranking", "knapsack"):
+            raise ValueError(f"backend should be 'auto', 'ranking' or 'knapsack', not {backend!r}")
+        self.instance = instance
+        self.schedule_store = schedule_store
+        new_ranking = schedule_store.ranking if schedule_store is not None else ScheduleRanking
+        self.item_conflicts = {item: instance.item_conflicts(item) for item in instance.items}
+        self.agent_conflicts = {agent: instance.agent_conflicts(agent) for agent in instance.agents}
+        self.valuations = {agent: {item: instance.agent_item_value(agent, item) for item in instance.items} for agent in instance.agents}
+        self.rankings = {
+            agent: new_ranking(
+                items=instance.items,
+                valuation=self.valuations[agent],
+                capacity=instance.agent_capacity(agent),
+                item_conflicts=self.item_conflicts,
+                forbidden_items=self.agent_conflicts.get(agent, []))
+            for agent in instance.agents
+        }
+        self._restricted = {}
+        self._oracle = None
+        if backend == "auto":
+            max_num_of_schedules = max([estimate_num_of_schedules(len(ranking.items) - len(ranking._forbidden_indices), ranking.capacity) for ranking in self.rankings.values()], default=0)
+            backend = "knapsack" if max_num_of_schedules > max_schedules_for_ranking else "ranking"
+            logger.info("At most %d schedules per student: using the %s backend", max_num_of_schedules, backend)
+        self.backend = backend
+
+    def __getitem__(self, student)->ScheduleRanking:
+        return self.rankings[student]
+
+    def restricted(self, student, courses)->ScheduleRanking:
+        """
+        The ranking of the given student on the schedules that use only the given courses.
+        Its items are the given courses, in the order of the instance items (the order of the full ranking).
+        Restricted rankings are cached by the set of courses, so repeated aftermarket passes reuse them.
+        """
+        key = (student, frozenset(courses))
+        if key not in self._restricted:
+            self._restricted[key] = ScheduleRanking(
+                items=[item for item in self.instance.items if item in key[1]],
+                valuation=self.valuations[student],
+                capacity=self.instance.agent_capacity(student),
+                item_conflicts=self.item_conflicts,
+                forbidden_items=self.agent_conflicts.get(student, []))
+        return self._restricted[key]
+
+    def save(self):
+        """
+        Write the schedules generated so far to the schedule store (if there is one).
+        """
+        if self.schedule_store is None:
+            return
+        num_of_saved = sum(self.schedule_store.save(ranking) for ranking in self.rankings.values())
+        logger.info("Saved the rankings of %d students", num_of_saved)
+
+    def demand_oracle(self, budget:dict)->DemandOracle:
+        """
+        A DemandOracle (or KnapsackDemandOracle, by the backend) over the cached rankings.
+        The same oracle (with its packed schedules and memo) is returned to all the stages; it is re-budgeted if a stage uses a different budget.
+        """
+        if self._oracle is None:
+            items = list(self.instance.items)
+            oracle_class = KnapsackDemandOracle if self.backend == "knapsack" else DemandOracle
+            self._oracle = oracle_class(items, [self.instance.item_capacity(item) for item in items], budget, self.rankings)
+        elif self._oracle.budget is not budget:
+            self._oracle.set_budget(budget)
+        return self._oracle
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
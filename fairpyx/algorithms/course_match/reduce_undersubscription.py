@@ -8,6 +8,7 @@ Naama Shiponi and Ben Dabush
 1/6/2024
 """
 
+import numpy as np
 import logging
 logger = logging.getLogger(__name__)
 from fairpyx.algorithms.course_match.A_CEEI import (
@@ -15,6 +16,8 @@ from fairpyx.algorithms.course_match.A_CEEI import (
     find_best_schedule,
     find_preference_order_for_each_student,
 )
+from fairpyx.algorithms.course_match.knapsack_demand import best_affordable_schedule
+from fairpyx.algorithms.course_match.preference_cache import PreferenceCache
 from fairpyx.instances import Instance
 from fairpyx.allocations import AllocationBuilder
 
@@ -23,7 +26,7 @@ Algorithm 3: The algorithm is designed to refill all the courses that, following
 """
 
 
-def reduce_undersubscription(allocation: AllocationBuilder, price_vector: dict, student_budgets: dict, priorities_student_list: list) -> AllocationBuilder:
+def reduce_undersubscription(allocation: AllocationBuilder, price_vector: dict, student_budgets: dict, priorities_student_list: list, preference_cache: PreferenceCache = None) -> AllocationBuilder:
     """
     Perform automated aftermarket allocations with increased budget and restricted allocations.
 
@@ -31,11 +34,13 @@ def reduce_undersubscription(allocation: AllocationBuilder, price_vector: dict,
     :param price_vector: (dict) price vector for courses
     :param student_list: List of students ordered by their class year descending and budget surplus ascending
     :param student_budgets: Budget for each student
+    :param preference_cache: the schedule rankings of the students, shared with the other stages of Course Match (computed if not given).
 
     :return: Updated course allocations
     """
-    item_conflicts, agent_conflicts = calculate_conflicts(allocation)
-    preferred_schedule = find_preference_order_for_each_student(allocation.instance._valuations, allocation.instance._agent_capacities, item_conflicts, agent_conflicts)
+    if preference_cache is None:
+        preference_cache = PreferenceCache(allocation.instance)
+    preferred_schedule = preference_cache.demand_oracle(student_budgets)
     logger.debug('Preferred schedule calculated: %s', preferred_schedule)
 
     # Calculate the demand for each course based on the price vector and student budgets
@@ -54,7 +59,7 @@ def reduce_undersubscription(allocation: AllocationBuilder, price_vector: dict,
     logger.debug('Student list with remaining budgets: %s', student_list)
 
     # Reoptimize student schedules to fill undersubscribed courses
-    student_schedule_dict = reoptimize_student_schedules(allocation, price_vector, student_list, student_budgets, student_schedule_dict, capacity_undersubscribed_courses)
+    student_schedule_dict = reoptimize_student_schedules(allocation, price_vector, student_list, student_budgets, student_schedule_dict, capacity_undersubscribed_courses, preference_cache)
 
     # Update the allocation with the new student schedules
     for student, schedule in student_schedule_dict.items():
@@ -170,7 +175,7 @@ def calculate_remaining_budgets(price_vector: dict, student_budgets: dict, stude
     return remaining_budgets
 
 
-def reoptimize_student_schedules(allocation, price_vector, student_list, student_budgets, student_schedule_dict, capacity_undersubscribed_courses) -> dict:
+def reoptimize_student_schedules(allocation, price_vector, student_list, student_budgets, student_schedule_dict, capacity_undersubscribed_courses, preference_cache: PreferenceCache = None) -> dict:
     """
     Reoptimize student schedules to fill undersubscribed courses.
 
@@ -180,9 +185,12 @@ def reoptimize_student_schedules(allocation, price_vector, student_list, student
     :param student_budgets: (dict) budget for each student
     :param student_schedule_dict: (dict) current schedules of students
     :param capacity_undersubscribed_courses: (dict) courses that are undersubscribed
+    :param preference_cache: (PreferenceCache) the schedule rankings of the students (computed if not given)
 
     :return: Updated student schedules
     """
+    if preference_cache is None:
+        preference_cache = PreferenceCache(allocation.instance)
     not_done = True
     while not_done and len(capacity_undersubscribed_courses) != 0:
         not_done = False
@@ -191,7 +199,7 @@ def reoptimize_student_schedules(allocation, price_vector, student_list, student
             current_bundle.extend(x for x in list(capacity_undersubscribed_courses.keys()) if x not in current_bundle)
             current_bundle.sort()
             student_budget = {student[0]: 1.1 * student_budgets[student[0]]}
-            new_bundle = allocation_function(allocation, student[0], current_bundle, price_vector, student_budget)
+            new_bundle = allocation_function(allocation, student[0], current_bundle, price_vector, student_budget, preference_cache)
             if is_new_bundle_better(allocation, student[0], student_schedule_dict[student[0]], new_bundle.get(student[0], {})):
                 not_done = True
                 update_student_schedule_dict(student, student_schedule_dict, new_bundle, capacity_undersubscribed_courses)
@@ -221,7 +229,7 @@ def update_student_schedule_dict(student, student_schedule_dict, new_bundle, cap
     student_schedule_dict.update({student[0]: new_bundle.get(student[0])})
     logger.debug('Updated undersubscribed course capacities: %s', capacity_undersubscribed_courses)
 
-def allocation_function(allocation: AllocationBuilder, student: str, student_allocation: dict, price_vector: dict, student_budget: dict) -> dict:
+def allocation_function(allocation: AllocationBuilder, student: str, student_allocation: dict, price_vector: dict, student_budget: dict, preference_cache: PreferenceCache = None) -> dict:
     """
     Function to reoptimize student's schedule.
 
@@ -230,16 +238,22 @@ def allocation_function(allocation: AllocationBuilder, student: str, student_all
     :param student_allocation: (dict) Schedule of student to reoptimize
     :param price_vector: (dict) price vector for courses
     :param student_budget: (dict) New student's budget
+    :param preference_cache: (PreferenceCache) the schedule rankings of the students (computed if not given)
 
     :return: (dict) new course allocations
     """
-    limited_student_valuations = filter_valuations_for_courses(allocation, student, student_allocation)
-    item_conflicts, agent_conflicts = calculate_conflicts(allocation)
-    agent_capacities = {student: allocation.instance._agent_capacities[student]}
-    preferred_schedule = find_preference_order_for_each_student(limited_student_valuations, agent_capacities, item_conflicts, agent_conflicts)
-    limited_price_vector = {course: price for course, price in price_vector.items() if course in student_allocation}
-    new_allocation = find_best_schedule(limited_price_vector, student_budget, preferred_schedule)
-    new_allocation_dict = create_dictionary_of_schedules(new_allocation, student_allocation, agent_capacities.keys())
+    if preference_cache is None:
+        preference_cache = PreferenceCache(allocation.instance)
+    limited_ranking = preference_cache.restricted(student, student_allocation)
+    limited_price_vector = {course: price_vector[course] for course in limited_ranking.items}
+    if preference_cache.backend == "knapsack":   # solve the restricted demand directly, without enumerating the restricted ranking
+        schedule = best_affordable_schedule(
+            limited_ranking._values, limited_ranking.capacity, np.array(list(limited_price_vector.values()), dtype=float), student_budget[student],
+            limited_ranking._forbidden_indices, limited_ranking._conflicting_items)
+        new_allocation = [[1 if index in schedule else 0 for index in range(len(limited_ranking.items))]]
+    else:
+        new_allocation = find_best_schedule(limited_price_vector, student_budget, {student: limited_ranking})
+    new_allocation_dict = create_dictionary_of_schedules(new_allocation, limited_ranking.items, [student])
     logger.debug('Reoptimized schedule for student %s: %s', student, new_allocation_dict)
     return new_allocation_dict
 
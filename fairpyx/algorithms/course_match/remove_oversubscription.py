@@ -8,6 +8,7 @@ Naama Shiponi and Ben Dabush
 1/6/2024
 """
 import logging
+import numpy as np
 logger = logging.getLogger(__name__)
 from fairpyx.instances import Instance
 from fairpyx.allocations import AllocationBuilder
@@ -16,6 +17,7 @@ from fairpyx.algorithms.course_match.A_CEEI import (
     find_best_schedule,
     find_preference_order_for_each_student,
 )
+from fairpyx.algorithms.course_match.preference_cache import PreferenceCache
 
 """
 Algorithm 2 : The algorithm makes sure that there are no courses that have more students registered than their capacity.
@@ -28,6 +30,8 @@ def remove_oversubscription(
     student_budgets: dict,
     epsilon: float = 0.1,
     compute_surplus_demand_for_each_course: callable = compute_surplus_demand_for_each_course,
+    preference_cache: PreferenceCache = None,
+    prune_schedules: bool = False,
 ):
     """
     Perform oversubscription elimination to adjust course prices.
@@ -37,6 +41,9 @@ def remove_oversubscription(
     :param student_budgets: dict of student budgets (dict of floats)
     :param epsilon: Small value to determine when to stop binary search
     :param demand_function: Function that takes price vector and returns excess demand vector
+    :param preference_cache: the schedule rankings of the students, shared with the other stages of Course Match (computed if not given).
+    :param prune_schedules: if True, the demand oracle drops schedules that cannot be chosen at any price in this stage
+            (prices only rise, from the given price vector up to the max budget). This saves memory and time, and does not change the result.
 
     :return: Adjusted price vector (dict of floats)
 
@@ -109,21 +116,12 @@ def remove_oversubscription(
     """
     max_budget = max(student_budgets.values()) + epsilon
     logger.debug('Max budget set to %g', max_budget)
-    item_conflicts = {
-        item: allocation.instance.item_conflicts(item)
-        for item in allocation.instance.items
-    }
-    agent_conflicts = {
-        agent: allocation.instance.agent_conflicts(agent)
-        for agent in allocation.instance.agents
-    }
-
-    preferred_schedule = find_preference_order_for_each_student(
-        allocation.instance._valuations,
-        allocation.instance._agent_capacities,
-        item_conflicts,
-        agent_conflicts,
-    )
+    if preference_cache is None:
+        preference_cache = PreferenceCache(allocation.instance)
+    preferred_schedule = preference_cache.demand_oracle(student_budgets)
+    if prune_schedules:
+        lower_bounds = preferred_schedule.price_array(price_vector)
+        preferred_schedule.set_price_bounds(lower_bounds, np.maximum(lower_bounds, max_budget))
     while True:
         excess_demands = compute_surplus_demand_for_each_course(price_vector, allocation, student_budgets, preferred_schedule)
         highest_demand_course = max(excess_demands, key=excess_demands.get)
@@ -152,6 +150,8 @@ def remove_oversubscription(
         price_vector[highest_demand_course] = high_price
         logger.info('Final price for course %s set to %g', highest_demand_course, high_price)
     logger.info('Final price vector after remove_oversubscription %s', price_vector, )
+    if prune_schedules:
+        preferred_schedule.set_price_bounds()
 
     return price_vector
 
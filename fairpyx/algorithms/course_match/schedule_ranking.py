@@ -0,0 +1,245 @@
+"""
+Lazy enumeration of the feasible schedules of a student, in descending order of valuation.
+
+Course Match needs, for every student, the preference order on all the schedules the student may take.
+The number of such schedules grows as (num of courses choose capacity), so we never build the full list:
+the schedules are generated best-first, and only as many as the callers actually ask for are kept in memory.
+
+Since: 2026-10
+"""
+
+import hashlib
+from heapq import heappush, heappop
+from itertools import islice
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def iterate_schedules_in_preference_order(values:list, capacity:int, forbidden_items:set=frozenset(), conflicting_items:dict={}):
+    """
+    Generate all feasible schedules of a single student, best first.
+
+    A schedule is a non-empty set of at most `capacity` items, that contains no forbidden item and no pair of conflicting items.
+    The schedules are ordered by descending total value; ties are broken by descending number of items,
+    and then lexicographically by item index (this is the order used by `find_preference_order_for_each_student`).
+
+    The search is a best-first search in a tree: the items are sorted by value, a schedule of size k is a set of k positions in this order,
+    and each schedule has a unique parent (obtained by moving its leftmost movable position one step to the left),
+    whose value is at least as high. Hence, only the frontier of the generated schedules is kept in memory.
+
+    :param values: the student's value for each item (a list indexed by item index).
+    :param capacity: maximum number of items in a schedule.
+    :param forbidden_items: indices of items that the student cannot take (agent conflicts).
+    :param conflicting_items: maps an item index to a set of item indices that cannot be taken together with it.
+
+    :return: a generator of tuples; each tuple contains the (ascending) indices of the items in one schedule.
+
+    >>> list(iterate_schedules_in_preference_order([90, 60, 50], 2))
+    [(0, 1), (0, 2), (1, 2), (0,), (1,), (2,)]
+    >>> list(iterate_schedules_in_preference_order([90, 60, 50], 2, forbidden_items={1}))
+    [(0, 2), (0,), (2,)]
+    >>> list(iterate_schedules_in_preference_order([50, 81, 60], 2, conflicting_items={0: {1}, 1: {0}}))
+    [(1, 2), (0, 2), (1,), (2,), (0,)]
+    >>> list(iterate_schedules_in_preference_order([100, 0, 0], 2))
+    [(0, 1), (0, 2), (0,), (1, 2), (1,), (2,)]
+    >>> list(iterate_schedules_in_preference_order([1, 2, 3], 0))
+    []
+    """
+    allowed_items = [item for item in range(len(values)) if item not in forbidden_items]
+    item_at_position = sorted(allowed_items, key=lambda item: (-values[item], item))
+    num_of_positions = len(item_at_position)
+
+    frontier = []
+    def push(positions:tuple):
+        schedule = tuple(sorted(item_at_position[position] for position in positions))
+        value = sum(values[item] for item in schedule)
+        heappush(frontier, (-value, -len(schedule), schedule, positions))
+
+    for size in range(1, min(capacity, num_of_positions) + 1):
+        push(tuple(range(size)))
+
+    while frontier:
+        _, _, schedule, positions = heappop(frontier)
+        if is_conflict_free(schedule, conflicting_items):
+            yield schedule
+
+        # The children of a schedule are obtained by moving one position a single step to the right.
+        # To give each schedule a unique parent, only the last position of the leading run 0,1,...,r-1 and the position right after it may move.
+        size = len(positions)
+        run_length = 0
+        while run_length < size and positions[run_length] == run_length:
+            run_length += 1
+        for index in (run_length - 1, run_length):
+            if index < 0 or index >= size:
+                continue
+            next_position = positions[index] + 1
+            upper_limit = positions[index + 1] if index + 1 < size else num_of_positions
+            if next_position < upper_limit:
+                push(positions[:index] + (next_position,) + positions[index + 1:])
+
+
+def is_conflict_free(schedule:tuple, conflicting_items:dict)->bool:
+    """
+    Check that no two items of the given schedule conflict.
+
+    >>> is_conflict_free((0, 2), {0: {1}, 1: {0}})
+    True
+    >>> is_conflict_free((0, 1, 2), {0: {1}, 1: {0}})
+    False
+    """
+    if not conflicting_items:
+        return True
+    for index, item in enumerate(schedule):
+        conflicts = conflicting_items.get(item)
+        if conflicts and any(other in conflicts for other in schedule[index + 1:]):
+            return False
+    return True
+
+
+class ScheduleRanking:
+    """
+    The feasible schedules of a single student, in descending order of valuation, generated lazily.
+
+    Behaves like a read-only list of schedules, where each schedule is a 0/1 list over `items`.
+    Schedules are generated only when they are accessed, and are kept once generated,
+    so iterating twice over the same prefix does not repeat the search.
+
+    >>> ranking = ScheduleRanking(["c1", "c2", "c3"], {"c1": 90, "c2": 60, "c3": 50}, capacity=2, item_conflicts={"c1": ["c2"]})
+    >>> ranking[0]
+    [1, 0, 1]
+    >>> ranking
+    ScheduleRanking([[1, 0, 1], ...])
+    >>> list(ranking)
+    [[1, 0, 1], [0, 1, 1], [1, 0, 0], [0, 1, 0], [0, 0, 1]]
+    >>> len(ranking)
+    5
+    >>> ranking.bundle(1)
+    ['c2', 'c3']
+    """
+
+    def __init__(self, items:list, valuation:dict, capacity:int, item_conflicts:dict={}, forbidden_items:list=(), stored_schedules=None, stored_exhausted:bool=False):
+        """
+        :param items: the items on which the schedules are defined; each schedule is a 0/1 list in this order.
+        :param valuation: maps each item to the student's value.
+        :param capacity: maximum number of items in a schedule.
+        :param item_conflicts: maps an item to the items that cannot be taken together with it.
+        :param forbidden_items: items that the student cannot take.
+        :param stored_schedules: a prefix of this ranking that was computed before (see ScheduleStore):
+                an integer array whose rows are the item indices of the schedules, padded with -1.
+        :param stored_exhausted: True if stored_schedules is the entire ranking.
+        """
+        self.items = list(items)
+        map_item_to_index = {item: index for index, item in enumerate(self.items)}
+        self.capacity = capacity
+        self._values = [valuation.get(item, 0) for item in self.items]
+        self._conflicting_items = {}
+        for item, conflicts in item_conflicts.items():
+            if item not in map_item_to_index:
+                continue
+            for other in conflicts:
+                if other in map_item_to_index and other != item:
+                    self._conflicting_items.setdefault(map_item_to_index[item], set()).add(map_item_to_index[other])
+                    self._conflicting_items.setdefault(map_item_to_index[other], set()).add(map_item_to_index[item])
+        self._forbidden_indices = {map_item_to_index[item] for item in forbidden_items if item in map_item_to_index}
+        self._stored = stored_schedules if stored_schedules is not None else ()
+        self._stored_exhausted = stored_exhausted
+        self._generator = None    # created only when schedules beyond the stored prefix are needed.
+        self._schedules = []      # the generated prefix; each schedule is a tuple of item indices.
+        self.exhausted = False
+
+    def fingerprint(self)->str:
+        """
+        A digest of everything that determines this ranking: the items, the student's values, capacity, forbidden items,
+        and the conflicts between the items that the student may take. Budgets and course capacities do not affect it.
+
+        >>> first = ScheduleRanking(["c1", "c2"], {"c1": 90, "c2": 60}, capacity=2)
+        >>> first.fingerprint() == ScheduleRanking(["c1", "c2"], {"c1": 90, "c2": 60}, capacity=2).fingerprint()
+        True
+        >>> first.fingerprint() == ScheduleRanking(["c1", "c2"], {"c1": 90, "c2": 61}, capacity=2).fingerprint()
+        False
+        """
+        allowed_conflicts = sorted(
+            (item, other) for item, conflicts in self._conflicting_items.items() for other in conflicts
+            if item < other and item not in self._forbidden_indices and other not in self._forbidden_indices)
+        description = repr((
+            [str(item) for item in self.items], [float(value) for value in self._values], int(self.capacity),
+            sorted(self._forbidden_indices), allowed_conflicts))
+        return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+    def _generate(self, count:int)->int:
+        """
+        Make sure that the first `count` schedules are generated (or all schedules, if there are fewer).
+        Schedules are taken from the stored prefix first, and only then generated.
+        Returns the number of generated schedules.
+        """
+        if count > len(self._schedules) and not self.exhausted:
+            for row in self._stored[len(self._schedules):count]:
+                self._schedules.append(tuple(int(index) for index in row if index >= 0))
+            if count > len(self._schedules):
+                if self._stored_exhausted:
+                    self.exhausted = True
+                    return len(self._schedules)
+                if self._generator is None:
+                    self._generator = iterate_schedules_in_preference_order(self._values, self.capacity, self._forbidden_indices, self._conflicting_items)
+                    for _ in islice(self._generator, len(self._schedules)):  # skip the stored prefix
+                        pass
+                self._schedules.extend(islice(self._generator, count - len(self._schedules)))
+                if len(self._schedules) < count:
+                    self.exhausted = True
+        return len(self._schedules)
+
+    @property
+    def num_of_generated(self)->int:
+        return len(self._schedules)
+
+    @property
+    def num_of_stored(self)->int:
+        return len(self._stored)
+
+    def indices(self, position:int)->tuple:
+        """
+        Return the indices of the items in the schedule at the given position.
+        """
+        if self._generate(position + 1) <= position:
+            raise IndexError(f"schedule index {position} out of range")
+        return self._schedules[position]
+
+    def bundle(self, position:int)->list:
+        """
+        Return the items in the schedule at the given position.
+        """
+        return [self.items[index] for index in self.indices(position)]
+
+    def _as_vector(self, schedule:tuple)->list:
+        vector = [0] * len(self.items)
+        for index in schedule:
+            vector[index] = 1
+        return vector
+
+    def __getitem__(self, position:int)->list:
+        if position < 0:
+            position += len(self)
+        return self._as_vector(self.indices(position))
+
+    def __iter__(self):
+        position = 0
+        while position < self._generate(position + 1):
+            yield self._as_vector(self._schedules[position])
+            position += 1
+
+    def __len__(self)->int:
+        while not self.exhausted:
+            self._generate(2 * len(self._schedules) + 1)
+        return len(self._schedules)
+
+    def __repr__(self)->str:
+        shown = [str(self._as_vector(schedule)) for schedule in self._schedules]
+        if not self.exhausted:
+            shown.append("...")
+        return f"ScheduleRanking([{', '.join(shown)}])"
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
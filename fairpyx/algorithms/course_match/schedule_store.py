@@ -0,0 +1,99 @@
+"""
+A persistent, memory-mappable cache of the students' schedule rankings.
+
+Course Match is often re-run with the same preferences (different budgets, different course capacities, or after a crash).
+The ScheduleStore keeps the ranked schedules of each student in a .npy file in a directory,
+named by the fingerprint of the student's valuations, capacity and conflicts (see ScheduleRanking.fingerprint).
+Hence, budgets and course capacities do not affect the cache, and changing the bids of one student invalidates only that student's file.
+
+Since: 2026-10
+"""
+
+import os
+import numpy as np
+from fairpyx.algorithms.course_match.schedule_ranking import ScheduleRanking
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ScheduleStore:
+    """
+    A directory of stored rankings. Each file holds an int32 matrix: row r contains the item indices of the r-th schedule, padded with -1.
+    A file named <fingerprint>.npy holds a prefix of the ranking; a file named <fingerprint>.all.npy holds the entire ranking.
+    Files are opened with mmap_mode="r", so only the rows that are actually read are loaded.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> store = ScheduleStore(directory)
+    >>> ranking = store.ranking(["c1", "c2", "c3"], {"c1": 90, "c2": 60, "c3": 50}, capacity=2)
+    >>> ranking[0]
+    [1, 1, 0]
+    >>> store.save(ranking)
+    True
+    >>> restored = ScheduleStore(directory).ranking(["c1", "c2", "c3"], {"c1": 90, "c2": 60, "c3": 50}, capacity=2)
+    >>> restored.num_of_stored
+    1
+    >>> list(restored)
+    [[1, 1, 0], [1, 0, 1], [0, 1, 1], [1, 0, 0], [0, 1, 0], [0, 0, 1]]
+    >>> store.save(restored)
+    True
+    >>> ScheduleStore(directory).ranking(["c1", "c2", "c3"], {"c1": 90, "c2": 60, "c3": 50}, capacity=2).num_of_stored
+    6
+    >>> ScheduleStore(directory).ranking(["c1", "c2", "c3"], {"c1": 90, "c2": 60, "c3": 51}, capacity=2).num_of_stored
+    0
+    """
+
+    def __init__(self, directory:str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, fingerprint:str, exhausted:bool)->str:
+        return os.path.join(self.directory, f"{fingerprint}.all.npy" if exhausted else f"{fingerprint}.npy")
+
+    def load(self, fingerprint:str)->tuple:
+        """
+        Return (schedules, exhausted) for the given fingerprint, where schedules is a memory-mapped matrix; or (None, False) if nothing is stored.
+        """
+        for exhausted in (True, False):
+            path = self._path(fingerprint, exhausted)
+            if os.path.exists(path):
+                return np.load(path, mmap_mode="r"), exhausted
+        return None, False
+
+    def ranking(self, items:list, valuation:dict, capacity:int, item_conflicts:dict={}, forbidden_items:list=())->ScheduleRanking:
+        """
+        Construct a ScheduleRanking (with the same parameters), that starts from the stored prefix of this ranking, if there is one.
+        """
+        ranking = ScheduleRanking(items, valuation, capacity, item_conflicts, forbidden_items)
+        schedules, exhausted = self.load(ranking.fingerprint())
+        if schedules is not None:
+            ranking = ScheduleRanking(items, valuation, capacity, item_conflicts, forbidden_items, stored_schedules=schedules, stored_exhausted=exhausted)
+            logger.debug("Loaded %d stored schedules (exhausted=%s)", len(schedules), exhausted)
+        return ranking
+
+    def save(self, ranking:ScheduleRanking)->bool:
+        """
+        Store the schedules generated so far by the given ranking, if they extend what is already stored.
+        The file is written to a temporary name and then renamed, so an interrupted run never leaves a partial file.
+        Returns True if the file was written.
+        """
+        fingerprint = ranking.fingerprint()
+        if ranking.num_of_generated <= ranking.num_of_stored and (ranking._stored_exhausted or not ranking.exhausted):
+            return False
+        schedules = np.full((ranking.num_of_generated, max(ranking.capacity, 1)), -1, dtype=np.int32)
+        for row, schedule in enumerate(ranking._schedules):
+            schedules[row, :len(schedule)] = schedule
+        path = self._path(fingerprint, ranking.exhausted)
+        temporary_path = path + ".tmp.npy"
+        np.save(temporary_path, schedules)
+        os.replace(temporary_path, path)
+        if ranking.exhausted and os.path.exists(self._path(fingerprint, False)):
+            os.remove(self._path(fingerprint, False))
+        logger.debug("Stored %d schedules in %s", len(schedules), path)
+        return True
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
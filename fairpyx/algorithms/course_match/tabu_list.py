@@ -0,0 +1,95 @@
+"""
+A tabu list of excess-demand vectors, for the local search of A-CEEI.
+
+Since: 2026-10
+"""
+
+import numpy as np
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+INT16_INFO = np.iinfo(np.int16)
+
+
+def demand_key(demands)->bytes:
+    """
+    A compact, hashable key of an integer demand vector (a dict of demands, or a sequence of integers).
+    Demands are stored as int16 when they fit, and as int64 otherwise (the two forms have different lengths, so they never collide).
+
+    >>> demand_key({"c1": 2, "c2": -1, "c3": 0})
+    b'\\x02\\x00\\xff\\xff\\x00\\x00'
+    >>> demand_key([2, -1, 0]) == demand_key({"c1": 2, "c2": -1, "c3": 0})
+    True
+    >>> len(demand_key([40000, 0, 0]))
+    24
+    """
+    values = demands.values() if isinstance(demands, dict) else demands
+    array = np.fromiter(values, dtype=np.int64)
+    if len(array) == 0 or (array.min() >= INT16_INFO.min and array.max() <= INT16_INFO.max):
+        return array.astype(np.int16).tobytes()
+    return array.tobytes()
+
+
+class TabuList:
+    """
+    A set of visited demand vectors with O(1) membership tests.
+
+    :param max_size: the maximum number of remembered vectors (None = unbounded).
+    :param eviction: which vector to forget when the list is full: "fifo" (the oldest added) or "lru" (the least recently added or found).
+
+    >>> tabu_list = TabuList(max_size=2, eviction="lru")
+    >>> tabu_list.append({"c1": 2, "c2": -1})
+    >>> tabu_list.append({"c1": 1, "c2": 0})
+    >>> {"c1": 2, "c2": -1} in tabu_list
+    True
+    >>> tabu_list.append({"c1": 0, "c2": 0})     # evicts {"c1": 1, "c2": 0}, which was used least recently
+    >>> {"c1": 1, "c2": 0} in tabu_list
+    False
+    >>> tabu_list
+    TabuList(size=2, max_size=2, eviction='lru', hits=1, misses=1)
+    """
+
+    def __init__(self, max_size:int=None, eviction:str="fifo"):
+        if eviction not in ("fifo", "lru"):
+            raise ValueError(f"eviction should be 'fifo' or 'lru', not {eviction!r}")
+        if max_size is not None and max_size < 1:
+            raise ValueError(f"max_size should be positive, not {max_size}")
+        self.max_size = max_size
+        self.eviction = eviction
+        self._keys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, demands)->bool:
+        key = demand_key(demands)
+        if key in self._keys:
+            self.hits += 1
+            if self.eviction == "lru":
+                self._keys.move_to_end(key)
+            return True
+        self.misses += 1
+        return False
+
+    def append(self, demands):
+        key = demand_key(demands)
+        if key in self._keys:
+            if self.eviction == "lru":
+                self._keys.move_to_end(key)
+            return
+        self._keys[key] = None
+        if self.max_size is not None and len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+    def __len__(self)->int:
+        return len(self._keys)
+
+    def __repr__(self)->str:
+        return f"TabuList(size={len(self)}, max_size={self.max_size}, eviction={self.eviction!r}, hits={self.hits}, misses={self.misses})"
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
@@ -6,10 +6,10 @@ Programmer: Erel Segal-Halevi.
 Since: 2023-07
 """
 
-import cvxpy
+import cvxpy, numpy as np
 
 from fairpyx import Instance
-from fairpyx.utils.linear_programming_utils import allocation_variables, allocation_constraints
+from fairpyx.utils.linear_programming_utils import allocation_matrix_variable, allocation_matrix_constraints, valuation_matrices
 from fairpyx.utils.solve import solve
 
 
@@ -18,6 +18,67 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+class EgalitarianUtilitarianProgram:
+    """
+    The linear programs of fractional_egalitarian_utilitarian_allocation, in matrix form: a single (agents x items) variable,
+    and vectorized capacity constraints.
+    Both phases (maximize the minimum utility; then maximize the sum of utilities subject to a lower bound on every utility)
+    are solved on the same cvxpy problem, and differ only in the values of its parameters;
+    hence cvxpy canonicalizes the problem once, and the second solve only re-applies the parameters.
+
+    >>> program = EgalitarianUtilitarianProgram(Instance(valuations=[[3,0],[5,5]]), normalize_utilities=False)
+    >>> np.round(program.egalitarian_value(), 3)
+    3.0
+    >>> np.round(program.utilitarian_value(threshold_utility=3), 3)
+    8.0
+    >>> program.allocation_matrix()
+    {0: {0: 1.0, 1: 0.0}, 1: {0: 0.0, 1: 1.0}}
+    """
+
+    def __init__(self, instance: Instance, normalize_utilities=True, **solver_options):
+        self.instance = instance
+        self.allocation_variable = allocation_matrix_variable(instance)
+        raw_values, normalized_values = valuation_matrices(instance)
+        values = normalized_values if normalize_utilities else raw_values
+        self.utilities = cvxpy.sum(cvxpy.multiply(values, self.allocation_variable), axis=1)
+        self.min_utility = cvxpy.Variable()
+        self.egalitarian_weight = cvxpy.Parameter(nonneg=True)
+        self.utilitarian_weight = cvxpy.Parameter(nonneg=True)
+        self.threshold_utility = cvxpy.Parameter()
+        self._lowest_utility = float(np.minimum(values, 0).sum(axis=1).min(initial=0)) - 1      # a threshold that no feasible allocation violates
+        self.problem = cvxpy.Problem(
+            cvxpy.Maximize(self.egalitarian_weight*self.min_utility + self.utilitarian_weight*cvxpy.sum(self.utilities)),
+            constraints=allocation_matrix_constraints(instance, self.allocation_variable) + [self.min_utility <= self.utilities, self.min_utility >= self.threshold_utility],
+            **solver_options
+        )
+
+    def egalitarian_value(self)->float:
+        """
+        Solve phase 1: maximize the minimum utility. Returns the maximum.
+        """
+        self.egalitarian_weight.value, self.utilitarian_weight.value, self.threshold_utility.value = 1, 0, self._lowest_utility
+        solve(self.problem, solvers = [(cvxpy.SCIPY, {'method':'highs-ds'})])  # highs-ds is a variant of simplex (guaranteed to return a corner solution)
+        return self.min_utility.value.item()
+
+    def utilitarian_value(self, threshold_utility:float)->float:
+        """
+        Solve phase 2: maximize the sum of utilities, subject to every utility being at least threshold_utility. Returns the maximum.
+        """
+        self.egalitarian_weight.value, self.utilitarian_weight.value, self.threshold_utility.value = 0, 1, threshold_utility
+        solve(self.problem, solvers = [(cvxpy.SCIPY, {'method':'highs-ds'})])
+        return self.problem.value
+
+    def allocation_matrix(self)->dict:
+        """
+        The allocation of the last solve, as a dict of dicts.
+        """
+        values = self.allocation_variable.value
+        return {agent: {item: values[agent_index, item_index]+0 for item_index,item in enumerate(self.instance.items)} for agent_index,agent in enumerate(self.instance.agents)}
+
+    def utilities_of_agents(self)->dict:
+        return {agent: self.utilities.value[agent_index]+0 for agent_index,agent in enumerate(self.instance.agents)}
+
+
 def fractional_egalitarian_allocation(instance: Instance, normalize_utilities=True, **solver_options):
     """
     Find an egalitarian allocation - an allocation that maximizes the minimum utility.
@@ -41,22 +102,12 @@ def fractional_egalitarian_allocation(instance: Instance, normalize_utilities=Tr
     {0: {0: 0.75, 1: 0.0}, 1: {0: 0.25, 1: 1.0}}
     """
 
-    allocation_vars, raw_utilities, normalized_utilities = allocation_variables(instance)
-    utilities = normalized_utilities if normalize_utilities else raw_utilities
-    basic_constraints = allocation_constraints(instance, allocation_vars)
+    program = EgalitarianUtilitarianProgram(instance, normalize_utilities, **solver_options)
+    program.egalitarian_value()
 
-    # 1. Find the egalitarian value:
-    min_utility = cvxpy.Variable()
-    problem = cvxpy.Problem(
-        cvxpy.Maximize(min_utility),
-        constraints=basic_constraints + [min_utility <= utilities[agent] for agent in instance.agents],
-        **solver_options
-    )
-    solve(problem, solvers = [(cvxpy.SCIPY, {'method':'highs-ds'})])  # highs-ds is a variant of simplex (guaranteed to return a corner solution)
-
-    allocation_matrix = {agent: {item: allocation_vars[agent][item].value+0 for item in instance.items} for agent in instance.agents}
+    allocation_matrix = program.allocation_matrix()
     logger.debug("\nAllocation_matrix:\n%s", allocation_matrix)
-    logger.debug("\nUtilities:\n%s", {agent: utilities[agent].value+0 for agent in instance.agents})
+    logger.debug("\nUtilities:\n%s", program.utilities_of_agents())
     # logger.debug("\nRaw utilities:\n%s", {agent: raw_utilities[agent].value+0 for agent in instance.agents})
     # logger.debug("\nMax utilities:\n%s", {agent: instance.agent_maximum_value(agent) for agent in instance.agents})
     # logger.debug("\nNormalized utilities:\n%s", {agent: normalized_utilities[agent].value+0 for agent in instance.agents})
@@ -116,35 +167,20 @@ def fractional_egalitarian_utilitarian_allocation(instance: Instance, normalize_
     {0: {0: 1.0, 1: 0.0, 2: 1.0, 3: 1.0}, 1: {0: 0.0, 1: 1.0, 2: 0.0, 3: 0.0}}
     """
 
-    allocation_vars, raw_utilities, normalized_utilities = allocation_variables(instance)
-    utilities = normalized_utilities if normalize_utilities else raw_utilities
-    basic_constraints = allocation_constraints(instance, allocation_vars)
+    program = EgalitarianUtilitarianProgram(instance, normalize_utilities, **solver_options)
 
     # 1. Find the egalitarian value:
-    min_utility = cvxpy.Variable()
-    problem = cvxpy.Problem(
-        cvxpy.Maximize(min_utility),
-        constraints=basic_constraints + [min_utility <= utilities[agent] for agent in instance.agents],
-        **solver_options
-    )
-    solve(problem, solvers = [(cvxpy.SCIPY, {'method':'highs-ds'})])  # highs-ds is a variant of simplex (guaranteed to return a corner solution)
-
-    # 2. Find the utilitarian-subject-to-egalitarian value:
-    min_utility_value = min_utility.value
+    min_utility_value = program.egalitarian_value()
+
+    # 2. Find the utilitarian-subject-to-egalitarian value (on the same problem, with other parameter values):
     logger.debug("\nEgalitarian utility:\n%s", min_utility_value)
     threshold_utility = (1-tolerance_factor)*min_utility_value
     logger.debug("\nThreshold for utilitarian allocation:\n%s", threshold_utility)
+    program.utilitarian_value(threshold_utility)
 
-    problem = cvxpy.Problem(
-        cvxpy.Maximize(sum(utilities.values())),
-        constraints=basic_constraints + [utilities[agent] >= threshold_utility for agent in instance.agents],
-        **solver_options
-    )
-    solve(problem, solvers = [(cvxpy.SCIPY, {'method':'highs-ds'})])
-
-    allocation_matrix = {agent: {item: allocation_vars[agent][item].value+0 for item in instance.items} for agent in instance.agents}
+    allocation_matrix = program.allocation_matrix()
     logger.debug("\nAllocation_matrix:\n%s", allocation_matrix)
-    logger.debug("\nUtilities:\n%s", {agent: utilities[agent].value+0 for agent in instance.agents})
+    logger.debug("\nUtilities:\n%s", program.utilities_of_agents())
     # logger.debug("\nRaw utilities:\n%s", {agent: raw_utilities[agent].value+0 for agent in instance.agents})
     # logger.debug("\nMax utilities:\n%s", {agent: instance.agent_maximum_value(agent) for agent in instance.agents})
     # logger.debug("\nNormalized utilities:\n%s", {agent: normalized_utilities[agent].value+0 for agent in instance.agents})
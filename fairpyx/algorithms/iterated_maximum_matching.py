@@ -12,8 +12,9 @@ Since : 2021-05
 """
 
 
+import numpy as np
 from fairpyx import Instance, AllocationBuilder, ExplanationLogger
-from fairpyx.utils.graph_utils import many_to_many_matching_using_network_flow
+from fairpyx.utils.graph_utils import IncrementalMatchingNetwork
 from collections import defaultdict
 
 
@@ -96,15 +97,35 @@ def iterated_maximum_matching(alloc:AllocationBuilder, adjust_utilities:bool=Fal
     agent_item_value_bonus = defaultdict(lambda: defaultdict(lambda: 0))
     agent_item_value_with_bonus = lambda agent,item: alloc.effective_value(agent,item) + agent_item_value_bonus[agent][item]
 
+    # The values with bonus are kept in a matrix (-inf for conflicting items), and the matching network is built once;
+    # after each round, only the rows of agents who received an item and the cells that got a bonus are updated.
+    # Items with a negative value are not edges of the network (as in many_to_many_matching).
+    agents = list(alloc.remaining_agents())
+    items = list(alloc.instance.items)
+    agent_index = {agent: index for index, agent in enumerate(agents)}
+    item_index = {item: index for index, item in enumerate(items)}
+    values = np.array([[agent_item_value_with_bonus(agent,item) for item in items] for agent in agents], dtype=float).reshape(len(agents), len(items))
+    edge_weights = lambda values: np.where(values >= 0, values, -np.inf)
+    network = IncrementalMatchingNetwork(edge_weights(values))
+    def update_agent_values(agent):
+        values[agent_index[agent], alloc.remaining_conflicts.mask(agent, len(items))] = -np.inf
+        network.set_agent_weights(agent_index[agent], edge_weights(values[agent_index[agent]]))
+    def update_value(agent, item):
+        values[agent_index[agent], item_index[item]] = agent_item_value_with_bonus(agent,item)
+        network.set_weight(agent_index[agent], item_index[item], edge_weights(values[agent_index[agent], item_index[item]]))
+    def remaining_items_mask():
+        return np.array([item in alloc.remaining_item_capacities for item in items], dtype=bool)
+
     while len(alloc.remaining_item_capacities)>0 and len(alloc.remaining_agent_capacities)>0:
         explanation_logger.info("\n== "+_("iteration_number")+" ==", iteration, agents=alloc.remaining_agents())
         explanation_logger.info(_("remaining_seats")+"\n", alloc.remaining_item_capacities, agents=alloc.remaining_agents())
-        map_agent_to_bundle = many_to_many_matching_using_network_flow(
-            items=alloc.remaining_items(), 
-            item_capacity=alloc.remaining_item_capacities.__getitem__, 
-            agents=alloc.remaining_agents(),
-            agent_capacity=lambda _:1,
-            agent_item_value=agent_item_value_with_bonus)
+        assigned_items = network.assignment(*network.match(
+            agent_capacities=np.array([agent in alloc.remaining_agent_capacities for agent in agents], dtype=int),
+            item_capacities=np.array([alloc.remaining_item_capacities.get(item,0) for item in items])))
+        map_agent_to_bundle = {
+            agent: [items[assigned_items[agent_index[agent]]]] if assigned_items[agent_index[agent]] >= 0 else []
+            for agent in alloc.remaining_agents()
+        }
 
         explanation_logger.debug("map_agent_to_bundle: %s", map_agent_to_bundle)
 
@@ -121,25 +142,30 @@ def iterated_maximum_matching(alloc:AllocationBuilder, adjust_utilities:bool=Fal
                 agent: agent_item_value_with_bonus(agent, map_agent_to_item[agent])
                 for agent in map_agent_to_item.keys()
             }
+            remaining = remaining_items_mask()
             map_agent_to_max_possible_value = {
-                agent: max([agent_item_value_with_bonus(agent,item) for item in alloc.remaining_items()])
+                agent: values[agent_index[agent], remaining].max()
                 for agent in map_agent_to_item.keys()
             }
             for agent,item in map_agent_to_item.items():
-                if (agent,item) not in alloc.remaining_conflicts:
+                if not alloc.remaining_conflicts.contains(agent,item):
                     alloc.give(agent,item)
+                    update_agent_values(agent)
             if alloc.remaining_items():
+                remaining = remaining_items_mask()
                 for agent,item in map_agent_to_item.items():
                     explanation_logger.info(_("your_course_this_iteration"), map_agent_to_max_possible_value[agent], item, map_agent_to_value[agent], agents=agent)
                     if len(alloc.bundles[agent])==alloc.instance.agent_capacity(agent):
                         explanation_logger.info("\n"+_("you_have_your_capacity"), alloc.instance.agent_capacity(agent), agents=agent)
                     else:
-                        next_best_item = max(alloc.remaining_items(), key=lambda item:agent_item_value_with_bonus(agent,item))
-                        current_value_of_next_best_item = agent_item_value_with_bonus(agent,next_best_item)
+                        agent_values = np.where(remaining, values[agent_index[agent]], np.nan)
+                        next_best_item = items[np.nanargmax(agent_values)]
+                        current_value_of_next_best_item = values[agent_index[agent], item_index[next_best_item]]
                         if current_value_of_next_best_item>=0:
                             utility_difference = map_agent_to_max_possible_value[agent] - map_agent_to_value[agent]
                             if utility_difference>0:
                                 agent_item_value_bonus[agent][item] += utility_difference
+                                update_value(agent, item)
                                 explanation_logger.info("    "+_("as_compensation"),  utility_difference, next_best_item, agents=agent)
                             else:
                                 pass
@@ -152,6 +178,7 @@ def iterated_maximum_matching(alloc:AllocationBuilder, adjust_utilities:bool=Fal
             for agent,item in map_agent_to_item.items():
                 explanation_logger.info("You get course %s", item, agents=agent)
                 alloc.give(agent,item)
+                update_agent_values(agent)
         iteration += 1
 
 
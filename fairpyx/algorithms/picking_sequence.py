@@ -7,8 +7,9 @@ Programmer: Erel Segal-Halevi
 Since: 2023-06
 """
 
+import numpy as np
 from itertools import cycle
-from fairpyx import Instance, AllocationBuilder
+from fairpyx import Instance, ArrayInstance, AllocationBuilder
 
 import logging
 logger = logging.getLogger(__name__)
@@ -20,6 +21,10 @@ def picking_sequence(alloc: AllocationBuilder, agent_order:list):
     :param alloc: an allocation builder, which tracks the allocation and the remaining capacity for items and agents.
     :param agent_order: a list of indices of agents, representing the picking sequence. The agents will pick items in this order.
 
+    In each turn, the agent picks its most valuable available item; ties are broken in favor of the item that comes first in instance.items.
+    Each agent's items are sorted by value once (when it first picks), and a pointer skips the items that became unavailable to it
+    (items only become unavailable during the sequence), so a pick does not scan all the items.
+
     >>> from fairpyx.adaptors import divide
     >>> agent_capacities = {"Alice": 2, "Bob": 3, "Chana": 2, "Dana": 3}      # 10 seats required
     >>> course_capacities = {"c1": 2, "c2": 3, "c3": 4}                       # 9 seats available
@@ -29,18 +34,56 @@ def picking_sequence(alloc: AllocationBuilder, agent_order:list):
     {'Alice': ['c1', 'c3'], 'Bob': ['c1', 'c2', 'c3'], 'Chana': ['c2', 'c3'], 'Dana': ['c2', 'c3']}
     """
     logger.info("\nPicking-sequence with items %s , agents %s, and agent-order %s", alloc.remaining_item_capacities, alloc.remaining_agent_capacities, agent_order)
+    preference_orders = {}    # maps an agent to its items, from best to worst
+    pointers = {}             # maps an agent to the position, in its preference order, of the first item that may still be available to it
+    num_of_skipped_turns = 0
     for agent in cycle(agent_order):
         if alloc.isdone():
             break 
         if not agent in alloc.remaining_agent_capacities:
+            num_of_skipped_turns += 1
+            if num_of_skipped_turns >= len(agent_order):   # no agent in the sequence can pick anymore
+                break
             continue
-        potential_items_for_agent = set(alloc.remaining_items_for_agent(agent))
-        if len(potential_items_for_agent)==0:
+        num_of_skipped_turns = 0
+        if agent not in preference_orders:
+            preference_orders[agent] = agent_preference_order(alloc.instance, agent)
+            pointers[agent] = 0
+        preference_order = preference_orders[agent]
+        position = pointers[agent]
+        while position < len(preference_order) and not is_available(alloc, agent, preference_order[position]):
+            position += 1
+        pointers[agent] = position
+        if position == len(preference_order):
             logger.info("Agent %s cannot pick any more items: remaining=%s, bundle=%s", agent, alloc.remaining_item_capacities, alloc.bundles[agent])
             alloc.remove_agent_from_loop(agent)
             continue
-        best_item_for_agent = max(potential_items_for_agent, key=lambda item: alloc.effective_value(agent,item))
-        alloc.give(agent, best_item_for_agent, logger)
+        alloc.give(agent, preference_order[position], logger)
+
+
+def agent_preference_order(instance:Instance, agent:any)->list:
+    """
+    The items of the instance, sorted from the agent's most valuable to its least valuable; ties are kept in the order of instance.items.
+
+    >>> instance = Instance(valuations={"Alice": {"c1": 6, "c2": 10, "c3": 6, "c4": 8}})
+    >>> agent_preference_order(instance, "Alice")
+    ['c2', 'c4', 'c1', 'c3']
+    >>> agent_preference_order(instance.compile(), "Alice")
+    ['c2', 'c4', 'c1', 'c3']
+    """
+    items = list(instance.items)
+    if isinstance(instance, ArrayInstance):
+        values = instance.agent_values(agent)
+    else:
+        values = np.array([instance.agent_item_value(agent,item) for item in items])
+    return [items[index] for index in np.argsort(-values, kind="stable")]
+
+
+def is_available(alloc:AllocationBuilder, agent:any, item:any)->bool:
+    """
+    Whether the item has remaining capacity and the agent may take it (the same test as alloc.remaining_items_for_agent).
+    """
+    return item in alloc.remaining_item_capacities and not alloc.remaining_conflicts.contains(agent, item)
 
 
 def serial_dictatorship(alloc: AllocationBuilder, agent_order:list=None):
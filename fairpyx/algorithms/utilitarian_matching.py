@@ -7,17 +7,22 @@ Since : 2023-07
 """
 
 
-from fairpyx.utils.graph_utils import many_to_many_matching_using_network_flow
+from fairpyx.utils.graph_utils import MATCHING_BACKENDS
 from fairpyx import Instance, AllocationBuilder
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def utilitarian_matching(alloc: AllocationBuilder):
+def utilitarian_matching(alloc: AllocationBuilder, backend:str="arrays", sparse:bool=False):
     """
     Finds an allocation maximizing the sum of utilities for the given instance, using max-weight many-to-many matching.
 
+    :param backend: the matching backend (see graph_utils.MATCHING_BACKENDS): "arrays", or "networkx" (the reference implementation).
+    :param sparse: if True, only the pairs with a positive value are edges of the matching network (they are taken from
+                   instance.agent_positive_items, which is fast for a compiled instance). The sum of utilities is the same,
+                   but items with zero value are not given (whereas the default mode gives as many items as possible).
+
     >>> from fairpyx.utils.test_utils import stringify
     >>> from fairpyx.adaptors import divide
 
@@ -40,14 +45,24 @@ def utilitarian_matching(alloc: AllocationBuilder):
     >>> map_agent_name_to_bundle = divide(utilitarian_matching, instance=instance)
     >>> stringify(map_agent_name_to_bundle)
     "{avi:['w', 'x', 'y', 'z'], beni:['w', 'x', 'y', 'z']}"
+
+    >>> stringify(divide(utilitarian_matching, instance=instance, backend="networkx"))
+    "{avi:['w', 'x', 'y', 'z'], beni:['w', 'x', 'y', 'z']}"
+
+    >>> instance = Instance(valuations={"avi": {"x":5, "y":0}, "beni": {"x":2, "y":0}}, agent_capacities=1, item_capacities=1)
+    >>> stringify(divide(utilitarian_matching, instance=instance))
+    "{avi:['x'], beni:['y']}"
+    >>> stringify(divide(utilitarian_matching, instance=instance.compile(), sparse=True))
+    "{avi:['x'], beni:[]}"
     """
     instance = alloc.remaining_instance()
-    alloc.give_bundles(many_to_many_matching_using_network_flow(
+    alloc.give_bundles(MATCHING_BACKENDS[backend](
         items=instance.items,
         item_capacity=instance.item_capacity,
         agents=instance.agents,
         agent_capacity=instance.agent_capacity,
-        agent_item_value=instance.agent_item_value))
+        agent_item_value=instance.agent_item_value,
+        agent_positive_items=alloc.instance.agent_positive_items if sparse else None))
 
 
 utilitarian_matching.logger = logger
@@ -4,7 +4,7 @@ Utils for post-processing allocations.
 
 import numpy as np
 from collections import defaultdict
-from fairpyx import Instance 
+from fairpyx import Instance, ArrayInstance
 
 # The following constant is used as an item value, to indicate that this item must not be allocated to the agent.
 FORBIDDEN_ALLOCATION = -np.inf
@@ -99,6 +99,81 @@ def allocation_is_fractional(allocation:dict)->bool:
     raise ValueError(f"Bundle format is unknown: {arbitrary_bundle}")
 
 
+class ConflictIndex:
+    """
+    The agent-item conflicts of an AllocationBuilder, stored as one bitset per agent (a Python int, where bit j stands for the j-th item of the instance).
+    It behaves like a set of (agent,item) pairs, but adding all the conflicts of a received item is a single OR operation.
+    Pairs whose item is not an item of the instance are kept in an ordinary set.
+
+    >>> conflicts = ConflictIndex({"c1": 0, "c2": 1, "c3": 2})
+    >>> conflicts.add(("Alice", "c2"))
+    >>> conflicts.forbid("Bob", 0b101)
+    >>> ("Bob", "c3") in conflicts, ("Bob", "c2") in conflicts
+    (True, False)
+    >>> conflicts.bits("Bob"), conflicts.mask("Bob", 3)
+    (5, array([ True, False,  True]))
+    >>> sorted(conflicts)
+    [('Alice', 'c2'), ('Bob', 'c1'), ('Bob', 'c3')]
+    >>> len(conflicts)
+    3
+    """
+
+    def __init__(self, item_index:dict):
+        self.item_index = item_index
+        self.items = list(item_index.keys())
+        self._bits = defaultdict(int)
+        self._other_pairs = set()
+
+    def bits(self, agent:any)->int:
+        return self._bits.get(agent, 0)
+
+    def mask(self, agent:any, num_of_items:int)->np.ndarray:
+        """
+        The conflicts of the agent as a boolean array over the items of the instance.
+        """
+        return bits_to_mask(self.bits(agent), num_of_items)
+
+    def forbid(self, agent:any, bits:int):
+        self._bits[agent] |= bits
+
+    def add(self, pair:tuple):
+        agent, item = pair
+        if item in self.item_index:
+            self._bits[agent] |= 1 << self.item_index[item]
+        else:
+            self._other_pairs.add(pair)
+
+    def contains(self, agent:any, item:any)->bool:
+        index = self.item_index.get(item)
+        if index is None:
+            return (agent, item) in self._other_pairs
+        return (self._bits.get(agent, 0) >> index) & 1 == 1
+
+    def __contains__(self, pair:tuple)->bool:
+        return self.contains(*pair)
+
+    def __iter__(self):
+        for agent, bits in self._bits.items():
+            for index, item in enumerate(self.items):
+                if (bits >> index) & 1:
+                    yield (agent, item)
+        yield from self._other_pairs
+
+    def __len__(self)->int:
+        return sum(bin(bits).count("1") for bits in self._bits.values()) + len(self._other_pairs)
+
+    def __repr__(self)->str:
+        return repr(set(self))
+
+
+def bits_to_mask(bits:int, num_of_items:int)->np.ndarray:
+    """
+    >>> bits_to_mask(0b1010, 5)
+    array([False,  True, False,  True, False])
+    """
+    return np.unpackbits(np.frombuffer(bits.to_bytes((num_of_items + 7) // 8, "little"), dtype=np.uint8), bitorder="little")[:num_of_items].astype(bool)
+
+
 class AllocationBuilder:
     """
     A class for incrementally constructing an allocation.
@@ -106,6 +181,7 @@ class AllocationBuilder:
     Whenever an item is given to an agent (via the 'give' method),
     the class automatically updates the 'remaining_item_capacities' and the 'remaining_agent_capacities'.
     It also updates the 'remaining_conflicts' by adding a conflict between the agent and the item, so that it is not assigned to it anymore.
+    The conflicts are kept in a ConflictIndex (a bitset of forbidden items per agent), so giving an item and listing the available items do not hash (agent,item) pairs.
 
     Once you finish adding items, use "sorted" to get the final allocation (where each bundle is sorted alphabetically).
 
@@ -134,14 +210,32 @@ class AllocationBuilder:
     >>> alloc.give('Alice', 'c1')    
     >>> sorted(alloc.remaining_conflicts)
     [('Alice', 'c1'), ('Alice', 'c2'), ('Bob', 'c2')]
+    >>> alloc.remaining_items_for_agent("Alice"), alloc.remaining_items_mask("Bob")
+    ([], array([ True, False]))
+    >>> alloc.give_bundles({"Bob": ["c1"]})
+    >>> alloc.remaining_items_mask("Bob")
+    array([False, False])
     """
     def __init__(self, instance:Instance):
         self.instance = instance
         self.remaining_agent_capacities = {agent: instance.agent_capacity(agent) for agent in instance.agents if instance.agent_capacity(agent) > 0}
         self.remaining_item_capacities = {item: instance.item_capacity(item) for item in instance.items if instance.item_capacity(item) > 0}
-        self.remaining_conflicts = {(agent,item) for agent in self.remaining_agents() for item in self.instance.agent_conflicts(agent)}
         self.bundles = {agent: set() for agent in instance.agents}    # Each bundle is a set, since each agent can get at most one seat in each course
 
+        # The conflict index: items are interned to bit positions; each item's conflicts are precomputed as a bitset.
+        if isinstance(instance, ArrayInstance):
+            self._item_index = instance.item_index
+            self._item_conflict_bits = instance.item_conflict_bits
+        else:
+            self._item_index = {item: index for index, item in enumerate(instance.items)}
+            self._item_conflict_bits = [sum({1 << self._item_index[other] for other in instance.item_conflicts(item) if other in self._item_index}) for item in instance.items]
+        self._other_item_conflicts = {}     # conflicting "items" that are not items of the instance (kept as pairs in the ConflictIndex)
+        self.remaining_conflicts = ConflictIndex(self._item_index)
+        for agent in self.remaining_agents():
+            for item in self.instance.agent_conflicts(agent):
+                self.remaining_conflicts.add((agent,item))
+        self._remaining_item_bits = None    # computed lazily from remaining_item_capacities
+
     def isdone(self)->bool:
         """
         Return True if either all items or all agents have exhausted their capacity - so we are done.
@@ -159,7 +253,20 @@ class AllocationBuilder:
         Return the items with positive remaining capacity, that are available for the agent
         (== the agent does not already have them, and there are no item-conflicts or agent-conflicts)
         """
-        return [item for item in self.remaining_items() if (agent,item) not in self.remaining_conflicts]
+        forbidden = self.remaining_conflicts.bits(agent)
+        item_index = self._item_index
+        return [item for item in self.remaining_items() if not (forbidden >> item_index[item]) & 1]
+
+    def remaining_items_mask(self, agent)->np.ndarray:
+        """
+        A boolean array over the items of the instance (in the order of instance.items), which is True for the items returned by remaining_items_for_agent.
+        """
+        return bits_to_mask(self._remaining_bits() & ~self.remaining_conflicts.bits(agent), len(self._item_index))
+
+    def _remaining_bits(self)->int:
+        if self._remaining_item_bits is None or bin(self._remaining_item_bits).count("1") != len(self.remaining_item_capacities):
+            self._remaining_item_bits = sum(1 << self._item_index[item] for item in self.remaining_items())
+        return self._remaining_item_bits
 
     def remaining_agents(self)->list: 
         """
@@ -186,7 +293,12 @@ class AllocationBuilder:
         Return the agent's value for the item, if there is no conflict;
         otherwise, returns -infinity.
         """
-        if (agent,item) in self.remaining_conflicts:
+        index = self._item_index.get(item)
+        if index is None:
+            forbidden = (agent,item) in self.remaining_conflicts
+        else:   # ConflictIndex.contains, inlined since this is called in the inner loops of most algorithms
+            forbidden = (self.remaining_conflicts._bits.get(agent, 0) >> index) & 1
+        if forbidden:
             return FORBIDDEN_ALLOCATION
         else:
             return self.instance.agent_item_value(agent,item)
@@ -196,6 +308,8 @@ class AllocationBuilder:
         Remove the given item from further consideration by the allocation algorithm.
         """
         del self.remaining_item_capacities[item]
+        if self._remaining_item_bits is not None and item in self._item_index:
+            self._remaining_item_bits &= ~(1 << self._item_index[item])
 
     def remove_agent_from_loop(self, agent:any):
         """
@@ -208,7 +322,7 @@ class AllocationBuilder:
             raise ValueError(f"Agent {agent} has no remaining capacity for item {item}")
         if item not in self.remaining_item_capacities:
             raise ValueError(f"Item {item} has no remaining capacity for agent {agent}")
-        if (agent,item) in self.remaining_conflicts:
+        if self.remaining_conflicts.contains(agent,item):
             raise ValueError(f"Agent {agent} is not allowed to take item {item} due to a conflict")
         self.bundles[agent].add(item)
         if logger is not None:
@@ -257,7 +371,7 @@ class AllocationBuilder:
 
         for agent,bundle in new_bundles.items():
             self.bundles[agent].update(bundle)
-            self._update_conflicts(agent,item)
+            self._update_conflicts_with_bundle(agent,bundle)
 
 
     def _update_conflicts(self, receiving_agent:any, received_item:any):
@@ -266,9 +380,24 @@ class AllocationBuilder:
         * `receiving_agent` has a new conflict with `received_item`, as cannot get the same item twice.
         * `receiving_agent` has a new conflict with any item in conflict with `received_item`, as cannot get both of them at the same time.
         """
-        self.remaining_conflicts.add( (receiving_agent,received_item) )
-        for conflicting_item in self.instance.item_conflicts(received_item):
-            self.remaining_conflicts.add( (receiving_agent,conflicting_item) )
+        self._update_conflicts_with_bundle(receiving_agent, [received_item])
+
+    def _update_conflicts_with_bundle(self, receiving_agent:any, received_items:list):
+        """
+        Update the conflicts after giving all the `received_items` to `receiving_agent`, with a single update of the agent's bitset.
+        """
+        new_bits = 0
+        for received_item in received_items:
+            index = self._item_index[received_item]
+            new_bits |= (1 << index) | self._item_conflict_bits[index]
+            for conflicting_item in self._other_conflicts(received_item):
+                self.remaining_conflicts.add( (receiving_agent,conflicting_item) )
+        self.remaining_conflicts.forbid(receiving_agent, new_bits)
+
+    def _other_conflicts(self, item:any)->list:
+        if item not in self._other_item_conflicts:
+            self._other_item_conflicts[item] = [other for other in self.instance.item_conflicts(item) if other not in self._item_index]
+        return self._other_item_conflicts[item]
 
 
     def sorted(self):
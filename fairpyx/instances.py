@@ -7,6 +7,7 @@ Since: 2023-07
 
 from numbers import Number
 import numpy as np
+import scipy.sparse
 from functools import cache
 
 import logging
@@ -194,6 +195,13 @@ class Instance:
         return maxvalue
 
 
+    def agent_positive_items(self, agent:any)->list:
+        """
+        Return the items to which the agent assigns a positive value (in the order of self.items).
+        ArrayInstance answers this from an index built once, so it takes time proportional to the number of such items.
+        """
+        return [item for item in self.items if self.agent_item_value(agent,item) > 0]
+
     def agent_normalized_item_value(self, agent:any, item:any):
         value = self.agent_item_value(agent,item)
         maxvalue = self.agent_maximum_value(agent)
@@ -207,6 +215,15 @@ class Instance:
                 raise ValueError(f"Normalized value of {agent} to {item} is nan! value={value}, maxvalue={maxvalue}")
             return normalized_value
 
+    def compile(self, sparse:bool=None, max_sparse_density:float=0.1)->"ArrayInstance":
+        """
+        Return an ArrayInstance with the same agents, items, values, capacities and conflicts,
+        for algorithms that want to work with arrays of integer indices instead of names.
+
+        :param sparse: whether to store the valuations in a CSR sparse matrix. If None, a sparse matrix is used when at most max_sparse_density of the values are non-zero.
+        """
+        return ArrayInstance(self, sparse=sparse, max_sparse_density=max_sparse_density)
+
     @staticmethod
     def random_uniform(num_of_agents:int, num_of_items:int, 
                agent_capacity_bounds:tuple[int,int],
@@ -339,7 +356,184 @@ class Instance:
                         item_capacities=item_capacities, item_conflicts=item_conflicts)
 
 
-        
+
+
+class ArrayInstance(Instance):
+    """
+    An Instance whose data is stored in arrays: agents and items are interned to the indices 0,...,n-1 and 0,...,m-1
+    (in the order of instance.agents and instance.items), the valuations are a dense NumPy matrix or a CSR sparse matrix,
+    the capacities and entitlements are NumPy arrays, and the conflicts are bitsets (Python ints, where bit j stands for item j).
+    It supports the entire Instance interface, so it can be passed to any algorithm; algorithms can opt in to the array accessors.
+    Create it with Instance.compile().
+
+    >>> instance = Instance(
+    ...   agent_capacities = {"Alice": 2, "Bob": 3},
+    ...   item_capacities  = {"c1": 4, "c2": 5, "c3": 1},
+    ...   agent_conflicts  = {"Bob": {"c3"}},
+    ...   item_conflicts   = {"c1": {"c2"}, "c2": {"c1"}},
+    ...   valuations       = {"Alice": {"c1": 11, "c2": 22}, "Bob": {"c1": 33, "c2": 44, "c3": 55}})
+    >>> compiled = instance.compile()
+    >>> compiled
+    ArrayInstance(2 agents, 3 items, dense valuations)
+    >>> compiled.agent_item_value("Alice", "c3"), compiled.agent_item_value("Bob", "c3")
+    (0, 55)
+    >>> compiled.agent_bundle_value("Bob", ["c1","c2"])
+    77
+    >>> compiled.agent_maximum_value("Bob")
+    132
+    >>> compiled.item_index["c2"], compiled.item_capacity_array
+    (1, array([4, 5, 1]))
+    >>> compiled.agent_values("Alice")
+    array([11, 22,  0])
+    >>> compiled.agent_bundle_values("Bob", [["c1"], ["c1", "c3"], []])
+    array([33, 88,  0])
+    >>> compiled.agent_bundle_values("Bob", np.array([[1, 1, 0], [0, 0, 1]]))
+    array([77, 55])
+    >>> compiled.agent_conflict_bits[compiled.agent_index["Bob"]], compiled.agent_conflict_mask("Bob")
+    (4, array([False, False,  True]))
+    >>> compiled.item_conflict_mask("c1")
+    array([False,  True, False])
+    >>> compiled.agent_conflicts("Bob")
+    {'c3'}
+    >>> compiled.positive_item_indices[compiled.agent_index["Alice"]], compiled.agent_positive_items("Alice")
+    (array([0, 1]), ['c1', 'c2'])
+
+    ### sparse valuations:
+    >>> compiled = instance.compile(sparse=True)
+    >>> compiled
+    ArrayInstance(2 agents, 3 items, sparse valuations)
+    >>> compiled.agent_item_value("Alice", "c3"), compiled.agent_item_value("Bob", "c3")
+    (0, 55)
+    >>> compiled.agent_values("Alice")
+    array([11, 22,  0])
+    >>> compiled.agent_bundle_values("Bob", [["c1"], ["c1", "c3"], []])
+    array([33, 88,  0])
+    >>> compiled.compile() is compiled
+    True
+    """
+
+    def __init__(self, instance:Instance, sparse:bool=None, max_sparse_density:float=0.1):
+        self.agents = list(instance.agents)
+        self.items  = list(instance.items)
+        self.num_of_agents = len(self.agents)
+        self.num_of_items  = len(self.items)
+        self.agent_index = {agent: index for index, agent in enumerate(self.agents)}
+        self.item_index  = {item: index for index, item in enumerate(self.items)}
+
+        # Only the non-zero values are kept while reading, so that a sparse catalog never needs a dense matrix:
+        rows, columns, data = [], [], []
+        for agent_index, agent in enumerate(self.agents):
+            values = np.array([instance.agent_item_value(agent, item) for item in self.items])
+            nonzero = np.flatnonzero(values)
+            rows.append(np.full(len(nonzero), agent_index))
+            columns.append(nonzero)
+            data.append(values[nonzero])
+        rows, columns, data = np.concatenate(rows or [[]]).astype(int), np.concatenate(columns or [[]]).astype(int), np.concatenate(data or [[]])
+        shape = (self.num_of_agents, self.num_of_items)
+        positive = data > 0
+        self.positive_item_indices = np.split(columns[positive], np.cumsum(np.bincount(rows[positive], minlength=self.num_of_agents))[:-1])     # per agent, the indices of the items it values positively
+        if sparse is None:
+            sparse = len(data) <= max_sparse_density * self.num_of_agents * self.num_of_items
+        self.is_sparse = sparse
+        if sparse:
+            self.valuation_matrix = scipy.sparse.csr_matrix((data, (rows, columns)), shape=shape)
+        else:
+            self.valuation_matrix = np.zeros(shape, dtype=data.dtype)
+            self.valuation_matrix[rows, columns] = data
+
+        # The original values are kept in lists, so that the scalar accessors return exactly what the original instance returns:
+        self._agent_capacity_list = [instance.agent_capacity(agent) for agent in self.agents]
+        self._agent_entitlement_list = [instance.agent_entitlement(agent) for agent in self.agents]
+        self._item_capacity_list = [instance.item_capacity(item) for item in self.items]
+        self.agent_capacity_array = np.array(self._agent_capacity_list)
+        self.agent_entitlement_array = np.array(self._agent_entitlement_list)
+        self.item_capacity_array = np.array(self._item_capacity_list)
+
+        self._agent_conflict_list = [instance.agent_conflicts(agent) for agent in self.agents]
+        self._item_conflict_list = [instance.item_conflicts(item) for item in self.items]
+        self.agent_conflict_bits = [self.bits(conflicts) for conflicts in self._agent_conflict_list]
+        self.item_conflict_bits = [self.bits(conflicts) for conflicts in self._item_conflict_list]
+
+        self._agent_capacities = instance._agent_capacities
+        self._item_capacities  = instance._item_capacities
+        self._valuations       = instance._valuations
+
+    def compile(self, sparse:bool=None, max_sparse_density:float=0.1)->"ArrayInstance":
+        if sparse is None or sparse == self.is_sparse:
+            return self
+        return ArrayInstance(self, sparse=sparse, max_sparse_density=max_sparse_density)
+
+    def bits(self, items)->int:
+        """
+        The bitset of the given items (items that are not in the instance are ignored).
+        """
+        result = 0
+        for item in items:
+            if item in self.item_index:
+                result |= 1 << self.item_index[item]
+        return result
+
+    def mask(self, bits:int)->np.ndarray:
+        """
+        The boolean array (of length num_of_items) of the given bitset.
+        """
+        return np.unpackbits(np.frombuffer(bits.to_bytes((self.num_of_items + 7) // 8, "little"), dtype=np.uint8), bitorder="little")[:self.num_of_items].astype(bool)
+
+    def agent_capacity(self, agent:any):
+        return self._agent_capacity_list[self.agent_index[agent]]
+
+    def agent_entitlement(self, agent:any):
+        return self._agent_entitlement_list[self.agent_index[agent]]
+
+    def item_capacity(self, item:any):
+        return self._item_capacity_list[self.item_index[item]]
+
+    def agent_conflicts(self, agent:any):
+        return self._agent_conflict_list[self.agent_index[agent]]
+
+    def item_conflicts(self, item:any):
+        return self._item_conflict_list[self.item_index[item]]
+
+    def agent_conflict_mask(self, agent:any)->np.ndarray:
+        return self.mask(self.agent_conflict_bits[self.agent_index[agent]])
+
+    def item_conflict_mask(self, item:any)->np.ndarray:
+        return self.mask(self.item_conflict_bits[self.item_index[item]])
+
+    def agent_item_value(self, agent:any, item:any):
+        return self.valuation_matrix[self.agent_index[agent], self.item_index[item]].item()
+
+    def agent_positive_items(self, agent:any)->list:
+        return [self.items[index] for index in self.positive_item_indices[self.agent_index[agent]]]
+
+    def agent_values(self, agent:any)->np.ndarray:
+        """
+        The agent's values for all the items, as a dense array.
+        """
+        row = self.valuation_matrix[self.agent_index[agent]]
+        return row.toarray().ravel() if self.is_sparse else row
+
+    def agent_bundle_value(self, agent:any, bundle:list[any]):
+        return self.agent_values(agent)[[self.item_index[item] for item in bundle]].sum().item()
+
+    def agent_bundle_values(self, agent:any, bundles)->np.ndarray:
+        """
+        The agent's values for a batch of bundles, given as a list of lists of items, or as a 0/1 matrix with a row per bundle and a column per item.
+        """
+        if not isinstance(bundles, np.ndarray):
+            indicators = np.zeros((len(bundles), self.num_of_items), dtype=int)
+            for row, bundle in enumerate(bundles):
+                indicators[row, [self.item_index[item] for item in bundle]] = 1
+            bundles = indicators
+        return bundles @ self.agent_values(agent)
+
+    @cache
+    def agent_maximum_value(self, agent:any):
+        return np.sort(self.agent_values(agent))[::-1][:self.agent_capacity(agent)].sum().item()
+
+    def __repr__(self):
+        return f"ArrayInstance({self.num_of_agents} agents, {self.num_of_items} items, {'sparse' if self.is_sparse else 'dense'} valuations)"
+
 
 def random_valuation(numitems:int, item_value_bounds: tuple[float,float])->np.ndarray:
     """
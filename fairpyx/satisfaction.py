@@ -5,13 +5,71 @@ Author: Erel Segal-Halevi
 Since: 2023-07
 """
 
-from fairpyx import Instance
+from fairpyx import Instance, ArrayInstance
 import numpy as np
 
-from functools import cache
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TILE_SIZE = 10**7    # the default maximum number of entries in a temporary array of envy_statistics (80 MB of float64)
+
+
+class MatrixView(Mapping):
+    """
+    A read-only dict-of-dicts view of a matrix, whose rows and columns are labeled (e.g. by agents or items):
+    view[row][column] is the matrix entry, as a Python number.
+
+    >>> view = MatrixView(np.array([[1, 2], [3, 4]]), ["a", "b"], ["x", "y"])
+    >>> view["b"]["x"], len(view), list(view["a"].values())
+    (3, 2, [1, 2])
+    >>> view
+    {'a': {'x': 1, 'y': 2}, 'b': {'x': 3, 'y': 4}}
+    """
+
+    def __init__(self, matrix:np.ndarray, rows:list, columns:list):
+        self.array = matrix
+        self._row_index = {row: index for index, row in enumerate(rows)}
+        self._column_index = {column: index for index, column in enumerate(columns)}
+
+    def __getitem__(self, row):
+        return _MatrixRowView(self.array[self._row_index[row]], self._column_index)
+
+    def __iter__(self):
+        return iter(self._row_index)
+
+    def __len__(self):
+        return len(self._row_index)
+
+    def __repr__(self):
+        return repr({row: dict(self[row]) for row in self})
+
+
+class _MatrixRowView(Mapping):
+    def __init__(self, row:np.ndarray, column_index:dict):
+        self.array = row
+        self._column_index = column_index
+
+    def __getitem__(self, column):
+        return self.array[self._column_index[column]].item()
+
+    def __iter__(self):
+        return iter(self._column_index)
+
+    def __len__(self):
+        return len(self._column_index)
+
+    def __repr__(self):
+        return repr(dict(self))
 
 
 class AgentBundleValueMatrix:
+    """
+    The values of every agent to the bundle of every agent, and the measures of satisfaction derived from them.
+    All the data is kept in arrays: the agent*item valuation matrix V, the 0/1 agent*item allocation matrix X, and the agent*agent value matrix V X^T;
+    the attributes matrix, raw_matrix, normalized_matrix, envy_matrix, envy_vector and rankings are dict-like views of these arrays.
+    The agent*agent matrices are computed only when they are accessed: the utilitarian and egalitarian values use only the agents' own values,
+    and the envy measures are computed by envy_statistics, block by block.
+    """
 
     def __init__(self, instance:Instance, allocation:dict[any, list[any]], normalized=True):
         """
@@ -44,109 +102,152 @@ class AgentBundleValueMatrix:
         1
         >>> matrix.count_agents_with_top_rank(2)
         2
+        >>> matrix.rankings["Alice"]
+        {'c1': 2, 'c2': 1}
+        >>> matrix.max_deficit(), matrix.mean_deficit()
+        (2, 1.5)
         """
         self.instance = instance
-        self.agents = instance.agents
-        self.raw_matrix = {
-            agent1: {
-                agent2: instance.agent_bundle_value(agent1, allocation[agent2])
-                for agent2 in self.agents
-            }
-            for agent1 in self.agents
-        }
-        self.maximum_values = {
-            agent: instance.agent_maximum_value(agent)
-            for agent in instance.agents
-        }
-        self.rankings = {
-            agent: instance.agent_ranking(agent, allocation[agent])
-            for agent in instance.agents
-        }
+        agents, items = list(instance.agents), list(instance.items)
+        self.agents = agents
+        self._agent_index = {agent: index for index, agent in enumerate(agents)}
+        item_index = {item: index for index, item in enumerate(items)}
+        self.valuation_matrix, self.allocation_matrix = valuation_and_allocation_matrices(instance, allocation)
+        values, bundles = self.valuation_matrix, self.allocation_matrix
+
+        self.own_raw_values = (values * bundles).sum(axis=1)
+        capacities = np.array([instance.agent_capacity(agent) for agent in agents], dtype=int)
+        sorted_values = -np.sort(-values, axis=1)
+        cumulative_values = np.concatenate((np.zeros((len(agents), 1), dtype=sorted_values.dtype), np.cumsum(sorted_values, axis=1)), axis=1)
+        self.maximum_value_array = cumulative_values[np.arange(len(agents)), np.minimum(capacities, len(items))]      # the sum of the top <capacity> values, as in instance.agent_maximum_value
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.normalization_factors = 100 / self.maximum_value_array     # normalized values are raw values times these factors
+            self.own_normalized_values = self.own_raw_values * self.normalization_factors
+
+        # Rankings, as in instance.agent_ranking(agent, allocation[agent]): by descending value, where ties are broken
+        # first in favor of the agent's own items (in the order of its bundle), and then by the order of the items in the instance.
+        tie_breaker = bundles.shape[1] + np.cumsum(bundles == 0, axis=1)
+        for agent in agents:
+            for position, item in enumerate(allocation[agent]):
+                tie_breaker[self._agent_index[agent], item_index[item]] = position
+        order = np.lexsort((tie_breaker, -values))
+        self.ranking_array = np.empty_like(order)
+        np.put_along_axis(self.ranking_array, order, np.arange(1, len(items)+1)[None, :], axis=1)
+
+        self.maximum_values = dict(zip(agents, self.maximum_value_array.tolist()))
+        self.rankings = MatrixView(self.ranking_array, agents, items)
         self.allocation = {
             agent: sorted(allocation[agent], key=self.rankings[agent].__getitem__)
-            for agent in instance.agents
-        }
-        self.normalized_matrix = {
-            agent1: {
-                agent2: self.raw_matrix[agent1][agent2] / self.maximum_values[agent1] * 100
-                for agent2 in self.agents
-            }
-            for agent1 in self.agents
+            for agent in agents
         }
-        self.matrix = self.raw_matrix
+        self.deficit_array = capacities - bundles.sum(axis=1)
+        self.top_rank_array = np.where(bundles > 0, self.ranking_array, np.inf).min(axis=1, initial=np.inf)
+
+        self._raw_matrix = self._normalized_matrix = None
+        self.normalized = False
         self.envy_matrix = None  # maps each agent-pair to the envy between them.
-        self.envy_vector = None  # maps each agent to his maximum envy.
+        self._envy_statistics = None
         if normalized:
             self.use_normalized_values()
 
+    @property
+    def raw_matrix(self)->MatrixView:
+        """ [agent1][agent2] = the value of agent1 to the bundle of agent2. Computed (as an agents*agents array) on first access. """
+        if self._raw_matrix is None:
+            self._raw_matrix = MatrixView(self.valuation_matrix @ self.allocation_matrix.T, self.agents, self.agents)
+        return self._raw_matrix
+
+    @property
+    def normalized_matrix(self)->MatrixView:
+        if self._normalized_matrix is None:
+            with np.errstate(invalid="ignore"):
+                self._normalized_matrix = MatrixView(self.raw_matrix.array * self.normalization_factors[:, None], self.agents, self.agents)
+        return self._normalized_matrix
+
+    @property
+    def matrix(self)->MatrixView:
+        return self.normalized_matrix if self.normalized else self.raw_matrix
+
+    @property
+    def own_values(self)->np.ndarray:
+        return self.own_normalized_values if self.normalized else self.own_raw_values
+
     def use_raw_values(self)->float:
         """
         In the computations of utilitarian and egalitarian values, use the raw valuations of the agents.
         """
-        if self.matrix!=self.raw_matrix:
-           self.matrix = self.raw_matrix
-           self.envy_matrix = self.envy_vector = None
+        if self.normalized:
+           self.normalized = False
+           self.envy_matrix = self._envy_statistics = None
 
     def use_normalized_values(self)->float:
         """
         In the computations of utilitarian and egalitarian values, use the valuations of the agents normalized such that their maximum possible value is 100.
         """
-        if self.matrix!=self.normalized_matrix:
-           self.matrix = self.normalized_matrix
-           self.envy_matrix = self.envy_vector = None
+        if not self.normalized:
+           self.normalized = True
+           self.envy_matrix = self._envy_statistics = None
 
     def utilitarian_value(self)->float:
-        return sum([self.matrix[agent][agent] for agent in self.agents])/len(self.agents)
+        return (self.own_values.sum() / len(self.own_values)).item()
 
     def egalitarian_value(self)->float:
-        return min([self.matrix[agent][agent] for agent in self.agents])
+        return self.own_values.min().item()
 
     def make_envy_matrix(self):
+        """
+        Materialize the entire agents*agents envy matrix. For large numbers of agents, prefer envy_statistics.
+        """
         if self.envy_matrix is not None:
             return
-        self.envy_matrix = {
-            agent1: {
-                agent2: self.matrix[agent1][agent2] - self.matrix[agent1][agent1]
-                for agent2 in self.agents
-            }
-            for agent1 in self.agents
-        }
-        self.envy_vector = {
-            agent1: max(self.envy_matrix[agent1].values())
-            for agent1 in self.agents
-        }
+        value_array = self.matrix.array
+        self.envy_matrix = MatrixView(value_array - np.diagonal(value_array)[:, None], self.agents, self.agents)
+
+    def envy_statistics(self, tile_size:int=DEFAULT_TILE_SIZE, max_workers:int=1)->dict:
+        """
+        The envy measures of the allocation (in the current raw/normalized values), computed by envy_statistics in bounded memory.
+        The result of the first call is cached.
+
+        >>> instance = Instance(valuations={"Alice": {"c1": 11, "c2": 22}, "Bob": {"c1": 33, "c2": 44}}, agent_capacities=1)
+        >>> matrix = AgentBundleValueMatrix(instance, {"Alice": ["c1"], "Bob": ["c2"]}, normalized=False)
+        >>> statistics = matrix.envy_statistics(tile_size=1)
+        >>> statistics["max_envy"], statistics["mean_envy"], statistics["num_of_ef1_violations"]
+        (11, 5.5, 0)
+        """
+        if self._envy_statistics is None:
+            self._envy_statistics = envy_statistics(
+                self.valuation_matrix, self.allocation_matrix,
+                row_factors=self.normalization_factors if self.normalized else None,
+                tile_size=tile_size, max_workers=max_workers)
+        return self._envy_statistics
+
+    @property
+    def envy_vector(self)->dict:
+        """ maps each agent to his maximum envy. """
+        return dict(zip(self.agents, self.envy_statistics()["envy_vector"].tolist()))
 
     def max_envy(self):
-        self.make_envy_matrix()
-        return max(self.envy_vector.values())
+        return self.envy_statistics()["max_envy"]
 
     def mean_envy(self):
-        self.make_envy_matrix()
-        return sum([max(envy,0) for envy in self.envy_vector.values()]) / len(self.agents)
+        return self.envy_statistics()["mean_envy"]
 
-    def egalitarian_value(self):
-        return min([self.matrix[agent][agent] for agent in self.agents])
-
-    @cache
     def agent_deficit(self, agent):
         """ A "deficit" is the number of courses the agent received below its capacity. """
-        return self.instance.agent_capacity(agent) - len(self.allocation[agent])
+        return self.deficit_array[self._agent_index[agent]].item()
 
     def mean_deficit(self):
-        return sum([self.agent_deficit(agent) for agent in self.agents])/len(self.agents)
+        return (self.deficit_array.sum() / len(self.deficit_array)).item()
 
     def max_deficit(self):
-        return max([self.agent_deficit(agent) for agent in self.agents])
+        return self.deficit_array.max().item()
 
-    @cache
     def top_rank(self, agent):
-        if len(self.allocation[agent])>0:
-            return self.rankings[agent][self.allocation[agent][0]]
-        else:
-            return np.inf
+        top_rank = self.top_rank_array[self._agent_index[agent]]
+        return int(top_rank) if np.isfinite(top_rank) else np.inf
     
     def count_agents_with_top_rank(self, rank=1):
-        return sum([self.top_rank(agent)<=rank for agent in self.agents])
+        return int((self.top_rank_array <= rank).sum())
 
     def explain(self, explanation_logger, map_course_to_name:dict={}):
         """
@@ -157,8 +258,121 @@ class AgentBundleValueMatrix:
             for item in self.allocation[agent]:
                 explanation_logger.info(f" * Course {map_course_to_name.get(item,item)}: number {self.rankings[agent][item]} in your ranking, with value {self.instance.agent_item_value(agent,item)}", agents=agent)
             explanation_logger.info(f"The maximum possible value you could get for {self.instance.agent_capacity(agent)} courses is {self.maximum_values[agent]}.", agents=agent)
-            explanation_logger.info(f"Your total value is {self.raw_matrix[agent][agent]}, which is {np.round(self.normalized_matrix[agent][agent])}% of the maximum.", agents=agent)
+            agent_index = self._agent_index[agent]
+            explanation_logger.info(f"Your total value is {self.own_raw_values[agent_index].item()}, which is {np.round(self.own_normalized_values[agent_index].item())}% of the maximum.", agents=agent)
+
+
+
+def valuation_and_allocation_matrices(instance:Instance, allocation:dict)->tuple:
+    """
+    The valuation matrix V and the allocation matrix X of the given allocation, with a row per agent and a column per item
+    (in the order of instance.agents and instance.items). X[i,j] is the number of copies of item j in the bundle of agent i.
+
+    >>> instance = Instance(valuations={"Alice": {"c1": 11, "c2": 22}, "Bob": {"c1": 33, "c2": 44}})
+    >>> valuation_matrix, allocation_matrix = valuation_and_allocation_matrices(instance, {"Alice": ["c2"], "Bob": ["c1", "c2"]})
+    >>> valuation_matrix.tolist(), allocation_matrix.tolist()
+    ([[11, 22], [33, 44]], [[0, 1], [1, 1]])
+    """
+    agents, items = list(instance.agents), list(instance.items)
+    agent_index = {agent: index for index, agent in enumerate(agents)}
+    item_index = {item: index for index, item in enumerate(items)}
+    if isinstance(instance, ArrayInstance) and instance.agents == agents and instance.items == items:
+        valuation_matrix = instance.valuation_matrix.toarray() if instance.is_sparse else np.asarray(instance.valuation_matrix)
+    else:
+        valuation_matrix = np.array([[instance.agent_item_value(agent,item) for item in items] for agent in agents]).reshape(len(agents), len(items))
+    allocation_matrix = np.zeros((len(agents), len(items)), dtype=int)
+    for agent in agents:
+        for item in allocation[agent]:
+            allocation_matrix[agent_index[agent], item_index[item]] += 1
+    return valuation_matrix, allocation_matrix
+
+
+def bundle_item_indices(allocation_matrix:np.ndarray)->np.ndarray:
+    """
+    A matrix with a row per agent, containing the indices of the items in the agent's bundle,
+    padded with the number of items (an index one past the last item) up to the size of the largest bundle (and at least 1).
+
+    >>> bundle_item_indices(np.array([[0, 1, 1], [1, 0, 0], [0, 0, 0]])).tolist()
+    [[1, 2], [0, 3], [3, 3]]
+    """
+    num_of_agents, num_of_items = allocation_matrix.shape
+    bundle_sizes = (allocation_matrix > 0).sum(axis=1)
+    bundle_items = np.full((num_of_agents, max(int(bundle_sizes.max(initial=0)), 1)), num_of_items)
+    agent_indices, item_indices = np.nonzero(allocation_matrix > 0)
+    bundle_items[agent_indices, np.arange(len(agent_indices)) - np.repeat(np.cumsum(bundle_sizes) - bundle_sizes, bundle_sizes)] = item_indices
+    return bundle_items
+
+
+def envy_statistics(valuation_matrix:np.ndarray, allocation_matrix:np.ndarray, row_factors:np.ndarray=None, tile_size:int=DEFAULT_TILE_SIZE, max_workers:int=1)->dict:
+    """
+    Compute the envy measures of an allocation block by block over the agents (rows), without materializing the agents*agents envy matrix.
+    Each block of rows holds at most tile_size entries in its temporary arrays (at least one row is processed at a time);
+    with max_workers>1, several blocks are processed in parallel threads (so the memory is at most max_workers tiles).
+
+    :param valuation_matrix: V, with a row per agent and a column per item.
+    :param allocation_matrix: X, a 0/1 matrix with a row per agent and a column per item.
+    :param row_factors: optional factors by which the values of each agent are multiplied (e.g. for normalized values).
+
+    :return: a dict with:
+        "envy_vector": an array with the maximum envy of each agent (at least 0, the envy in itself);
+        "max_envy", "mean_envy" (the mean of envy_vector), "num_of_envious_agents";
+        "max_envy_up_to_one_item": the maximum, over all agent pairs (i,k), of value_i(X_k) - max_{j in X_k} value_i(j) - value_i(X_i),
+            or 0 if it is not positive (i.e., if the allocation is envy-free up to one item);
+        "num_of_ef1_violations": the number of pairs (i,k) with positive envy up to one item (as in main_course_match.check_envy).
+
+    >>> V = np.array([[5, 4, 3, 2], [2, 3, 4, 5], [1, 1, 1, 1]])
+    >>> X = np.array([[0, 0, 1, 1], [1, 0, 0, 0], [0, 1, 0, 0]])
+    >>> statistics = envy_statistics(V, X, tile_size=4)
+    >>> statistics["envy_vector"].tolist(), statistics["max_envy"], statistics["mean_envy"], statistics["num_of_envious_agents"]
+    ([0, 7, 1], 7, 2.6666666666666665, 2)
+    >>> statistics["max_envy_up_to_one_item"], statistics["num_of_ef1_violations"]
+    (2.0, 1)
+    >>> envy_statistics(V, X, tile_size=4, max_workers=2)["envy_vector"].tolist()
+    [0, 7, 1]
+    >>> envy_statistics(V, X, row_factors=np.array([1, 10, 100]))["envy_vector"].tolist()
+    [0, 70, 100]
+    """
+    valuation_matrix, allocation_matrix = np.asarray(valuation_matrix), np.asarray(allocation_matrix)
+    num_of_agents = len(valuation_matrix)
+    bundle_items = bundle_item_indices(allocation_matrix)      # padded with the index of an extra column of -inf values
+    block_size = max(1, tile_size // (num_of_agents * bundle_items.shape[1] or 1))
+    bundles_transposed = allocation_matrix.T.astype(float)      # float products use BLAS, integer products do not
+    result_type = np.result_type(valuation_matrix, allocation_matrix)
+
+    def process_block(start:int)->tuple:
+        rows = slice(start, min(start + block_size, num_of_agents))
+        block_values = valuation_matrix[rows]
+        bundle_values = (block_values @ bundles_transposed).astype(result_type, copy=False)   # [i,k] = the value of agent i to the bundle of agent k
+        if row_factors is not None:
+            with np.errstate(invalid="ignore"):
+                bundle_values = bundle_values * row_factors[rows, None]
+        own_values = bundle_values[np.arange(len(bundle_values)), np.arange(num_of_agents)[rows]]
+        envy = bundle_values - own_values[:, None]
+        # Only envious agents can violate EF1, so the best item of a bundle is looked up only for the envious pairs:
+        envious_rows, envied_agents = np.nonzero(envy > 0)
+        extended_values = np.concatenate((block_values, np.full((len(block_values), 1), -np.inf)), axis=1)
+        max_item_values = extended_values[envious_rows[:, None], bundle_items[envied_agents]].max(axis=1)   # the value of the best item in the envied bundle
+        if row_factors is not None:
+            max_item_values = max_item_values * row_factors[rows][envious_rows]
+        envy_up_to_one_item = envy[envious_rows, envied_agents] - max_item_values
+        return envy.max(axis=1), envy_up_to_one_item.max(initial=0), int((envy_up_to_one_item > 0).sum())
+
+    starts = range(0, num_of_agents, block_size)
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(process_block, starts))
+    else:
+        results = [process_block(start) for start in starts]
 
+    envy_vector = np.concatenate([result[0] for result in results]) if results else np.zeros(0)
+    return {
+        "envy_vector": envy_vector,
+        "max_envy": envy_vector.max().item(),
+        "mean_envy": (envy_vector.clip(min=0).sum() / num_of_agents).item(),
+        "num_of_envious_agents": int((envy_vector > 0).sum()),
+        "max_envy_up_to_one_item": max(result[1] for result in results).item() if results else 0,
+        "num_of_ef1_violations": sum(result[2] for result in results),
+    }
 
 
 
@@ -1,20 +1,25 @@
 """
 Utility functions using graph algorithms.
 
-Currently contains a single function: many_to_many_matching, which finds a maximum-weight many-to-many matching in a bipartite graph.
+Contains many_to_many_matching, which finds a maximum-weight many-to-many matching in a bipartite graph, with two backends:
+"networkx" (a reduction to max_flow_min_cost on a networkx graph; the reference implementation),
+and "arrays" (IncrementalMatchingNetwork, successive shortest paths on integer-indexed numpy arrays; much faster).
 
 Author: Erel Segal-Halevi
 Since : 2023-10
 """
 
 import networkz as nx
+import numpy as np
 from collections import defaultdict
 from itertools import product
 
-def many_to_many_matching(item_capacities: dict[any,int], agent_capacities:dict[any,int], valuations:dict[any,dict[any,int]], agent_entitlement:callable=lambda x:1)->nx.Graph:
+def many_to_many_matching(item_capacities: dict[any,int], agent_capacities:dict[any,int], valuations:dict[any,dict[any,int]], agent_entitlement:callable=lambda x:1, backend:str="arrays")->nx.Graph:
     """
     Computes a many-to-many matching of items to agents.
 
+    :param backend: "arrays" (many_to_many_matching_using_arrays) or "networkx" (many_to_many_matching_using_network_flow).
+
     >>> from fairpyx.utils.test_utils import stringify
 
     >>> valuations = {"a":{"x":11, "y":22}, "b":{"x":33,"y":55}}
@@ -33,9 +38,13 @@ def many_to_many_matching(item_capacities: dict[any,int], agent_capacities:dict[
     "{a:['y'], b:['x']}"
     >>> stringify(many_to_many_matching(item_capacities={0:1, 1:1, 2:1, 3:1}, agent_capacities={0:2, 1:2}, valuations=[[5,4,3,2],[2,3,4,5]]))
     '{0:[0, 1], 1:[2, 3]}'
+    >>> stringify(many_to_many_matching(item_capacities={0:1, 1:1, 2:1, 3:1}, agent_capacities={0:2, 1:2}, valuations=[[5,4,3,2],[2,3,4,5]], backend="networkx"))
+    '{0:[0, 1], 1:[2, 3]}'
     """
     # subroutine = many_to_many_matching_using_node_cloning
-    subroutine = many_to_many_matching_using_network_flow
+    if backend not in MATCHING_BACKENDS:
+        raise ValueError(f"backend should be one of {list(MATCHING_BACKENDS)}, not {backend!r}")
+    subroutine = MATCHING_BACKENDS[backend]
     return subroutine(
         items = item_capacities.keys(), 
         item_capacity = item_capacities.__getitem__,
@@ -50,23 +59,44 @@ def agent_str(agent):
 def item_str(item):
     return item if isinstance(item,str) else f"I{item}"
 
-def many_to_many_matching_using_network_flow(items:list, item_capacity: callable, agents:list, agent_capacity: callable, agent_item_value:callable, agent_entitlement:callable=lambda x:1, allow_negative_value_assignments=False)->nx.Graph:
+def many_to_many_matching_using_network_flow(items:list, item_capacity: callable, agents:list, agent_capacity: callable, agent_item_value:callable, agent_entitlement:callable=lambda x:1, allow_negative_value_assignments=False, agent_positive_items:callable=None)->nx.Graph:
     """
     Computes a many-to-many matching of items to agents. 
     
     Algorithm: reduction to min-cost-max-flow.  Based on answer by D.W. https://cs.stackexchange.com/a/161151/1342
+
+    :param agent_positive_items: if given, the matching is computed in sparse mode: a function mapping an agent to the items it values positively
+        (e.g. Instance.agent_positive_items, which ArrayInstance answers from a precomputed index); only these pairs become edges,
+        so the size of the network is proportional to the number of positive values rather than to agents*items.
+        Sparse mode maximizes the total value, rather than the number of assigned pairs and then the total value.
+        Guarantee: the maximum total value is the same as in the full network, since dropping the zero-value (and negative-value) pairs
+        from any matching gives a matching of the sparse network with at least the same value. Zero-value pairs are never assigned.
+
+    >>> values = {"a": {"x":0, "y":10}, "b": {"x":0, "y":0}}
+    >>> kwargs = dict(items=["x","y"], item_capacity=lambda item:1, agents=["a","b"], agent_capacity=lambda agent:1, agent_item_value=lambda agent,item: values[agent][item])
+    >>> many_to_many_matching_using_network_flow(**kwargs)
+    {'a': ['y'], 'b': ['x']}
+    >>> many_to_many_matching_using_network_flow(**kwargs, agent_positive_items=lambda agent: [item for item in ["x","y"] if values[agent][item]>0])
+    {'a': ['y'], 'b': []}
     """
+    sparse = agent_positive_items is not None
+    map_item_str_to_item = {item_str(item): item for item in items}
+
     ### a. Construct the flow network:
     graph = nx.DiGraph()
     graph.add_nodes_from(["s", "t"])
     for agent in agents:
         graph.add_edge("s", agent_str(agent), capacity=agent_capacity(agent), weight=0)
-    for agent,item in product(agents,items):
-        value =  agent_item_value(agent, item)
-        if value<0 and not allow_negative_value_assignments:
-            continue
-        weight = value * agent_entitlement(agent)
-        graph.add_edge(agent_str(agent), item_str(item), capacity=1, weight=-weight)
+        if sparse:   # the agent may leave some of its capacity unused, so the max flow does not force low-value edges
+            graph.add_edge(agent_str(agent), "t", capacity=agent_capacity(agent), weight=0)
+    for agent in agents:
+        agent_items = items if not sparse else [item for item in agent_positive_items(agent) if item_str(item) in map_item_str_to_item]
+        for item in agent_items:
+            value =  agent_item_value(agent, item)
+            if value<0 and not allow_negative_value_assignments:
+                continue
+            weight = value * agent_entitlement(agent)
+            graph.add_edge(agent_str(agent), item_str(item), capacity=1, weight=-weight)
     for item in items:
         graph.add_edge(item_str(item), "t", capacity=item_capacity(item), weight=0)
 
@@ -77,16 +107,76 @@ def many_to_many_matching_using_network_flow(items:list, item_capacity: callable
     map_agent_name_to_bundle = {}
     for agent in agents:
         map_agent_name_to_bundle[agent] = []
-        for item in items:
-            agent_item_flow =  flow[agent_str(agent)].get(item_str(item),0)
+        for node, agent_item_flow in flow[agent_str(agent)].items():
+            if node not in map_item_str_to_item:
+                continue    # the edge to "t" in sparse mode
+            item = map_item_str_to_item[node]
             if agent_item_flow==1:
                 map_agent_name_to_bundle[agent].append(item)
             elif agent_item_flow!=0:
-                raise ValueError(f"non-binary flow in network: agent={agent}, item={item}, flow={itemflow}.\n Entire flow: {flow}")
+                raise ValueError(f"non-binary flow in network: agent={agent}, item={item}, flow={agent_item_flow}.\n Entire flow: {flow}")
         map_agent_name_to_bundle[agent].sort()
     return map_agent_name_to_bundle
 
 
+def many_to_many_matching_using_arrays(items:list, item_capacity: callable, agents:list, agent_capacity: callable, agent_item_value:callable, agent_entitlement:callable=lambda x:1, allow_negative_value_assignments=False, agent_positive_items:callable=None)->dict:
+    """
+    Computes a many-to-many matching of items to agents, with the same input, output and objective as many_to_many_matching_using_network_flow
+    (including the sparse mode, when agent_positive_items is given).
+
+    Algorithm: the agents and items are converted to indices, and the matching is computed by IncrementalMatchingNetwork on a weight matrix.
+    In sparse mode, only the positive values are read.
+
+    >>> many_to_many_matching_using_arrays(items=["x","y"], item_capacity=lambda item:1, agents=["a","b"], agent_capacity=lambda agent:2,
+    ...    agent_item_value=lambda agent,item: {"a":{"x":2,"y":1}, "b":{"x":3,"y":-1}}[agent][item])
+    {'a': ['y'], 'b': ['x']}
+    >>> values = {"a": {"x":0, "y":10}, "b": {"x":0, "y":0}}
+    >>> many_to_many_matching_using_arrays(items=["x","y"], item_capacity=lambda item:1, agents=["a","b"], agent_capacity=lambda agent:1, agent_item_value=lambda agent,item: values[agent][item],
+    ...    agent_positive_items=lambda agent: [item for item in ["x","y"] if values[agent][item]>0])
+    {'a': ['y'], 'b': []}
+    """
+    agents, items = list(agents), list(items)
+    if agent_positive_items is None:
+        weights = np.array([[agent_item_value(agent, item) for item in items] for agent in agents], dtype=float).reshape(len(agents), len(items))
+        if not allow_negative_value_assignments:
+            weights[weights < 0] = -np.inf
+    else:
+        item_index = {item: index for index, item in enumerate(items)}
+        weights = np.full((len(agents), len(items)), -np.inf)
+        for agent_index, agent in enumerate(agents):
+            for item in agent_positive_items(agent):
+                if item in item_index:
+                    weights[agent_index, item_index[item]] = agent_item_value(agent, item)
+    weights *= np.array([agent_entitlement(agent) for agent in agents], dtype=float).reshape(-1, 1)
+    agent_indices, item_indices = max_weight_many_to_many_matching(
+        weights,
+        agent_capacities=np.array([agent_capacity(agent) for agent in agents], dtype=int),
+        item_capacities=np.array([item_capacity(item) for item in items], dtype=int),
+        max_cardinality=agent_positive_items is None)
+    map_agent_name_to_bundle = {agent: [] for agent in agents}
+    for agent_index, item_index in zip(agent_indices, item_indices):
+        map_agent_name_to_bundle[agents[agent_index]].append(items[item_index])
+    for bundle in map_agent_name_to_bundle.values():
+        bundle.sort()
+    return map_agent_name_to_bundle
+
+
+def max_weight_many_to_many_matching(weights:np.ndarray, agent_capacities:np.ndarray, item_capacities:np.ndarray, max_cardinality:bool=True)->tuple:
+    """
+    The integer-indexed core of the "arrays" backend: a maximum matching, and among them one of maximum weight
+    (or, if max_cardinality is False, a matching of maximum weight).
+
+    :param weights: a matrix with a row per agent and a column per item; -inf means that there is no edge.
+    :param agent_capacities, item_capacities: integer arrays.
+    :return: two index arrays (agents, items) with the matched pairs.
+
+    >>> agents, items = max_weight_many_to_many_matching(np.array([[5., 4, 3, 2], [2, 3, 4, 5]]), np.array([3, 3]), np.array([2, 2, 1, 1]))
+    >>> agents.tolist(), items.tolist()
+    ([0, 0, 0, 1, 1, 1], [0, 1, 2, 0, 1, 3])
+    """
+    return IncrementalMatchingNetwork(weights).match(agent_capacities, item_capacities, max_cardinality=max_cardinality)
+
+
 def many_to_many_matching_using_node_cloning(items:list, item_capacity: callable, agents:list, agent_capacity: callable, agent_item_value:callable, agent_entitlement:callable=lambda x:1)->nx.Graph:
     """
     Computes a many-to-many matching of items to agents. 
@@ -139,6 +229,166 @@ def many_to_many_matching_using_node_cloning(items:list, item_capacity: callable
 
 
 
+class IncrementalMatchingNetwork:
+    """
+    A flow network for repeated many-to-many matchings between the same agents and items
+    (as in every round of Iterated Maximum Matching, or a single call of many_to_many_matching_using_arrays).
+    Agents and items are indices into a weight matrix; the matrix is kept between calls to `match`,
+    so between rounds only the weights that changed are updated (`set_weight`, `set_agent_weights`), and the capacities are passed to `match`.
+
+    `match` computes a maximum matching, and among the maximum matchings one of maximum total weight
+    (the same objective as max_flow_min_cost in many_to_many_matching_using_network_flow),
+    by successive shortest paths on integer-indexed arrays. Every agent-item edge has a single unit, so the agents can be eliminated from the residual network:
+    a shortest path visits only items, and moving from item j to item k (by shifting one of j's agents, who does not hold k yet, to k) costs
+    min over these agents a of (weight[a,j] - weight[a,k]). These item-to-item costs are kept in an m*m matrix,
+    and only the rows of items on the augmenting path, or held by an agent on it, are updated.
+
+    >>> network = IncrementalMatchingNetwork(np.array([[5., 4, 3, 2], [2, 3, 4, 5]]))
+    >>> network.assignment(*network.match(np.array([1, 1]), np.array([1, 1, 1, 1]))).tolist()
+    [0, 3]
+    >>> network.set_weight(0, 0, -np.inf)     # the edge (0,0) is removed
+    >>> network.assignment(*network.match(np.array([1, 1]), np.array([1, 1, 1, 1]))).tolist()
+    [1, 3]
+    >>> network.assignment(*network.match(np.array([1, 1]), np.array([0, 1, 0, 0]))).tolist()     # only item 1 has capacity; agent 0 values it more
+    [1, -1]
+    >>> network.set_agent_weights(1, np.array([0., 0, 0, -1]))      # zero-weight and negative-weight edges are used, to maximize the size of the matching
+    >>> network.assignment(*network.match(np.array([1, 1]), np.array([1, 1, 0, 0]))).tolist()
+    [1, 0]
+
+    Agents with a higher capacity:
+    >>> network = IncrementalMatchingNetwork(np.array([[5., 4, 3, 2], [2, 3, 4, 5]]))
+    >>> agents, items = network.match(np.array([2, 2]), np.array([1, 1, 1, 1]))
+    >>> agents.tolist(), items.tolist()
+    ([0, 0, 1, 1], [0, 1, 2, 3])
+    >>> agents, items = network.match(np.array([3, 1]), np.array([2, 2, 2, 2]))
+    >>> agents.tolist(), items.tolist()
+    ([0, 0, 0, 1], [0, 1, 2, 3])
+    """
+
+    def __init__(self, weights:np.ndarray):
+        """
+        :param weights: a matrix with a row per agent and a column per item. The weight -inf means that there is no edge.
+        """
+        self.num_of_agents, self.num_of_items = weights.shape
+        self._costs = np.empty(weights.shape, dtype=float)
+        for agent in range(self.num_of_agents):
+            self.set_agent_weights(agent, weights[agent])
+
+    def set_agent_weights(self, agent:int, weights:np.ndarray):
+        weights = np.asarray(weights, dtype=float)
+        self._costs[agent] = np.where(weights > -np.inf, -weights, np.inf)
+
+    def set_weight(self, agent:int, item:int, weight:float):
+        self._costs[agent, item] = -weight if weight > -np.inf else np.inf
+
+    def assignment(self, agents:np.ndarray, items:np.ndarray)->np.ndarray:
+        """
+        Convert a matching returned by `match`, in which each agent has at most one item, to an array with the item of each agent (-1 for unmatched agents).
+        """
+        assigned = np.full(self.num_of_agents, -1)
+        assigned[agents] = items
+        return assigned
+
+    def match(self, agent_capacities:np.ndarray, item_capacities:np.ndarray, max_cardinality:bool=True)->tuple:
+        """
+        :param agent_capacities: an integer array: the number of items each agent may get in this matching (0 for agents who do not participate).
+        :param item_capacities: an integer array: the capacity of each item in this matching.
+        :param max_cardinality: if False, compute a matching of maximum weight (which may be smaller than the maximum matching):
+               the augmenting paths are found in order of increasing cost, so augmenting stops at the first path that would decrease the weight.
+        :return: two index arrays (agents, items) of the same length, with the matched pairs, sorted by agent and then by item.
+        """
+        costs = self._costs
+        num_of_items = self.num_of_items
+        held = np.zeros(costs.shape, dtype=bool)
+        remaining = np.where(np.isfinite(costs).any(axis=1), np.asarray(agent_capacities, dtype=int), 0)
+        item_capacities = np.asarray(item_capacities, dtype=int)
+        if num_of_items == 0 or not (remaining > 0).any():
+            return np.nonzero(held)
+        effective_costs = costs.copy()      # like costs, but an agent has no edge to the items it already holds
+        load = np.zeros(num_of_items, dtype=int)
+        members = [[] for _ in range(num_of_items)]                  # the agents matched to each item
+        shift_cost = np.full((num_of_items, num_of_items), np.inf)    # shift_cost[j,k]: the cheapest way to move an agent from item j to item k
+        shift_agent = np.full((num_of_items, num_of_items), -1)       # ... and the agent to move
+        source_cost = np.full(num_of_items, np.inf)                  # the cheapest edge from an agent with remaining capacity to each item
+        source_agent = np.full(num_of_items, -1)
+        tolerance = 1e-9 * max(1.0, float(np.abs(costs[np.isfinite(costs)]).max(initial=0)))
+
+        def update_shift_costs(item:int):
+            if len(members[item]) == 0:
+                shift_cost[item] = np.inf
+                return
+            candidates = effective_costs[members[item]] - costs[members[item], item][:, None]
+            best = candidates.argmin(axis=0)
+            shift_cost[item] = candidates[best, np.arange(num_of_items)]
+            shift_agent[item] = np.array(members[item])[best]
+
+        def update_source_costs(columns:np.ndarray):
+            spare = np.flatnonzero(remaining > 0)
+            if len(spare) == 0:
+                source_cost[columns] = np.inf
+                return
+            column_costs = effective_costs[np.ix_(spare, columns)]
+            best = column_costs.argmin(axis=0)
+            source_cost[columns] = column_costs[best, np.arange(len(columns))]
+            source_agent[columns] = spare[best]
+
+        update_source_costs(np.arange(num_of_items))
+        while True:
+            # Shortest paths from the agents with remaining capacity to all items (Bellman-Ford over the occupied items; there are no negative cycles).
+            distance = source_cost.copy()
+            previous = np.full(num_of_items, -1)         # -1 means: reached directly from an agent with remaining capacity
+            occupied = np.flatnonzero(load > 0)
+            for _ in range(len(occupied) + 1 if len(occupied) > 0 else 0):
+                candidates = distance[occupied, None] + shift_cost[occupied]
+                best = candidates.argmin(axis=0)
+                new_distance = candidates[best, np.arange(num_of_items)]
+                improved = new_distance < distance - tolerance
+                if not improved.any():
+                    break
+                distance[improved] = new_distance[improved]
+                previous[improved] = occupied[best[improved]]
+            end = np.where(load < item_capacities, distance, np.inf).argmin()
+            if not np.isfinite(distance[end]) or load[end] >= item_capacities[end]:
+                break       # no augmenting path: the matching is maximum
+            if not max_cardinality and distance[end] > tolerance:
+                break       # every augmenting path decreases the weight
+
+            # Augment along the path: shift agents backwards from the end item, then match an agent with remaining capacity to the first item.
+            touched = {end}
+            moved_agents = set()
+            item = end
+            while previous[item] >= 0:
+                from_item = previous[item]
+                agent = shift_agent[from_item, item]
+                members[from_item].remove(agent)
+                members[item].append(agent)
+                held[agent, from_item], held[agent, item] = False, True
+                effective_costs[agent, from_item], effective_costs[agent, item] = costs[agent, from_item], np.inf
+                touched.add(from_item)
+                moved_agents.add(agent)
+                item = from_item
+            agent = source_agent[item]
+            members[item].append(agent)
+            held[agent, item] = True
+            effective_costs[agent, item] = np.inf
+            remaining[agent] -= 1
+            moved_agents.add(agent)
+            load[end] += 1
+
+            for agent in moved_agents:
+                touched.update(np.flatnonzero(held[agent]).tolist())
+            for item in touched:
+                update_shift_costs(item)
+            update_source_costs(np.flatnonzero(np.isin(source_agent, list(moved_agents)) | np.isin(np.arange(num_of_items), list(touched))))
+        return np.nonzero(held)
+
+
+MATCHING_BACKENDS = {
+    "arrays": many_to_many_matching_using_arrays,
+    "networkx": many_to_many_matching_using_network_flow,
+}
+
+
 if __name__ == "__main__":
     import doctest
     print(doctest.testmod(report=True,optionflags=doctest.NORMALIZE_WHITESPACE))
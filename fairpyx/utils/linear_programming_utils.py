@@ -6,7 +6,7 @@ Since: 2023-07
 """
 
 from fairpyx import Instance
-import cvxpy
+import cvxpy, numpy as np
 
 def allocation_variables(instance: Instance)->tuple:
     """
@@ -52,6 +52,55 @@ def allocation_constraints(instance: Instance, allocation_vars:list):
 
 
 
+def allocation_matrix_variable(instance: Instance)->cvxpy.Variable:
+    """
+    Construct a single cvxpy matrix variable representing a fractional allocation: a row per agent and a column per item
+    (in the order of instance.agents and instance.items).
+    On large instances, cvxpy canonicalizes a problem over this variable much faster than over the scalar variables of allocation_variables.
+    """
+    return cvxpy.Variable((len(list(instance.agents)), len(list(instance.items))))
+
+def valuation_matrices(instance: Instance)->tuple:
+    """
+    Construct the matrices of raw and normalized values (a row per agent and a column per item), to be multiplied by an allocation matrix.
+
+    :return raw_values, normalized_values
+
+    >>> raw_values, normalized_values = valuation_matrices(Instance(valuations=[[5,0],[3,3]], agent_capacities=1))
+    >>> raw_values.tolist(), normalized_values.tolist()
+    ([[5.0, 0.0], [3.0, 3.0]], [[100.0, 0.0], [100.0, 100.0]])
+    """
+    agents, items = list(instance.agents), list(instance.items)
+    raw_values = np.array([[instance.agent_item_value(agent,item) for item in items] for agent in agents], dtype=float).reshape(len(agents), len(items))
+    max_values = np.array([instance.agent_maximum_value(agent) for agent in agents], dtype=float).reshape(-1, 1)
+    if ((max_values==0) & (raw_values>0)).any():
+        agent_index, item_index = np.argwhere((max_values==0) & (raw_values>0))[0]
+        raise ValueError(f"agent {agents[agent_index]} for item {items[item_index]} has value {raw_values[agent_index, item_index]}, but max value is 0")
+    normalized_values = np.divide(raw_values * 100, max_values, out=np.zeros_like(raw_values), where=max_values!=0)
+    return raw_values, normalized_values
+
+def allocation_matrix_constraints(instance: Instance, allocation_matrix:cvxpy.Variable):
+    """
+    Construct vectorized cvxpy constraints for a feasible fractional allocation, given as a matrix variable:
+    item capacities (column sums), agent capacities (row sums), positivity and uniqueness.
+
+    :return a list of all constraints
+
+    >>> instance = Instance(valuations=[[5,0],[3,3]], agent_capacities=1, item_capacities=[1,2])
+    >>> allocation_matrix = allocation_matrix_variable(instance)
+    >>> [constraint.shape for constraint in allocation_matrix_constraints(instance, allocation_matrix)]
+    [(2,), (2,), (2, 2), (2, 2)]
+    """
+    item_capacities = np.array([instance.item_capacity(item) for item in instance.items], dtype=float)
+    agent_capacities = np.array([instance.agent_capacity(agent) for agent in instance.agents], dtype=float)
+    return [
+        cvxpy.sum(allocation_matrix, axis=0) <= item_capacities,
+        cvxpy.sum(allocation_matrix, axis=1) <= agent_capacities,
+        allocation_matrix >= 0,
+        allocation_matrix <= 1,
+    ]
+
+
 if __name__ == "__main__":
     import doctest, sys
     print("\n",doctest.testmod(), "\n")
@@ -19,10 +19,14 @@ between courses for students given a list of preferences for each student.
 import logging
 import math
 import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import repeat
 from fairpyx.valuations import ValuationMatrix
 from fairpyx.allocation_utils import AllocationBuilder
 from queue import PriorityQueue
-import cvxpy as cp
+from fairpyx.algorithms.course_match.knapsack_demand import best_affordable_schedule
 
 
 logger = logging.getLogger(__name__)
@@ -33,7 +37,7 @@ Epsilon = 0.01
 
 def general_course_allocation(
         alloc:AllocationBuilder, 
-        bound: int = 0, effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None):
+        bound: int = 0, effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None, workers: int = 1):
     """
     This function finds the optimal course package for each student.
     The function inserts random values for the price of each course (between 0 and 1)
@@ -71,7 +75,7 @@ def general_course_allocation(
     agent_capacities = [alloc.remaining_agent_capacities[agent] for agent in remaining_agents]
     allocation_matrix = course_allocation(utilities, budgets, prices, 
         item_capacities, agent_capacities, 
-        bound, effect_variables, constraint)
+        bound, effect_variables, constraint, workers)
 
     for iagent,agent in enumerate(remaining_agents):
         for iitem,item in enumerate(remaining_items):
@@ -83,7 +87,7 @@ general_course_allocation.logger = logger
 
 def course_allocation(utilities:ValuationMatrix, budgets: list[float], prices: list[float], 
                       item_capacity: list[int], agent_capacity: list[int], 
-                      bound: int = 0, effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None) \
+                      bound: int = 0, effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None, workers: int = 1) \
         -> list[list[bool]]:
     """
     The main function.
@@ -94,6 +98,8 @@ def course_allocation(utilities:ValuationMatrix, budgets: list[float], prices: l
     The search continues as long as the SCORE is greater than the desired bound.
     At the end of the search, the vector will determine the optimal price, according to which the
     program will output the optimal course package for each student.
+    The placements of all evaluated price vectors are memoized, so a price vector that is generated again is not re-solved;
+    with workers > 1, the placements of new neighbors are computed in a process pool.
 
     Example 1: simple example.
     >>> course_allocation(ValuationMatrix([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[1.1,0.9,0.1,0.0],[1,1,1,1], [2,2])
@@ -115,44 +121,72 @@ def course_allocation(utilities:ValuationMatrix, budgets: list[float], prices: l
     logger.debug('course_allocation function')
 
     q = PriorityQueue()
-    tabu = []
-    curr_node: Course_Bundle = Course_Bundle(utilities, budgets, prices, item_capacity, agent_capacity)
+    tabu = set()        # the price vectors (as tuples) that were already visited
+    placements = {}     # memo: price vector (as a tuple) -> placement
+    curr_node: Course_Bundle = evaluate_price_vectors(utilities, budgets, [prices], item_capacity, agent_capacity, placements)[0]
     best_node = curr_node
 
     counter = 0
     max_iterations = 100
 
-    while best_node.score() > bound:
+    start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method)) if workers > 1 else nullcontext() as executor:
+        while best_node.score() > bound:
 
-        if counter == max_iterations:
-            break
+            if counter == max_iterations:
+                break
 
-        tabu.append(curr_node)
-        for p in curr_node.neighbors():
-            q.put(Course_Bundle(utilities, budgets, p, item_capacity, agent_capacity))
+            tabu.add(curr_node.key)
+            for neighbor in evaluate_price_vectors(utilities, budgets, curr_node.neighbors(), item_capacity, agent_capacity, placements, executor):
+                q.put(neighbor)
 
-        curr_node = q.get()
-        while tabu.__contains__(curr_node):
             curr_node = q.get()
+            while curr_node.key in tabu:
+                curr_node = q.get()
 
-        if curr_node.score() < best_node.score():
-            logger.info('The new best_node score is: %g', best_node.score())
-            best_node = curr_node
+            if curr_node.score() < best_node.score():
+                logger.info('The new best_node score is: %g', best_node.score())
+                best_node = curr_node
 
-        counter += 1
+            counter += 1
 
+    logger.debug('Solved %d distinct price vectors in %d iterations', len(placements), counter)
     return best_node.placement
 
 
+def evaluate_price_vectors(utilities: ValuationMatrix, budgets: list[float], price_vectors: list[list[float]],
+                           item_capacity: list[int], agent_capacity: list[int], placements: dict, executor: ProcessPoolExecutor = None) \
+        -> list:
+    """
+    Wrap each price vector in a Course_Bundle. The students' packages are computed only for price vectors that are not
+    already in `placements` (a memo from price tuples to placements, which is updated); if an executor is given, they are computed in parallel.
+
+    >>> placements = {}
+    >>> bundles = evaluate_price_vectors(ValuationMatrix([[60,30,6,4],[62,32,4,2]]), [1.1,1.0], [[1.1,0.9,0.1,0.0], [1.1,0.9,0.1,0.0]], [1,1,1,1], [2,2], placements)
+    >>> [bundle.placement for bundle in bundles]
+    [[[1, 0, 0, 1], [0, 1, 1, 0]], [[1, 0, 0, 1], [0, 1, 1, 0]]]
+    >>> len(placements)
+    1
+    """
+    new_keys = list(dict.fromkeys(tuple(prices) for prices in price_vectors if tuple(prices) not in placements))
+    if executor is None:
+        new_placements = [max_utilities(utilities, budgets, list(key), agent_capacity) for key in new_keys]
+    else:
+        new_placements = executor.map(max_utilities, repeat(utilities), repeat(budgets), map(list, new_keys), repeat(agent_capacity))
+    placements.update(zip(new_keys, new_placements))
+    return [Course_Bundle(utilities, budgets, prices, item_capacity, agent_capacity, placement=placements[tuple(prices)]) for prices in price_vectors]
+
+
 def neighbors(utilities, budgets: list[float], prices: list[float], 
               item_capacity: list[int], agent_capacity:list[int],
-              effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None) \
+              effect_variables: list[dict[set, int]] = None, constraint: list[dict[set, int]] = None, placement: list[list[bool]] = None) \
         -> list[list[float]]:
     """
     The neighbors function receives a current price vector, and produces for it a list of
     price vectors that are close to it according to the algorithm described in the article,
     where the goal is to produce a price vector that will reduce the gap between the demand
     and supply of the courses as much as possible.
+    If the placement at the given prices is already known, it can be passed to avoid re-solving it.
 
     Example 1:
     >>> neighbors(ValuationMatrix([[30, 70], [55, 45], [80, 20]]), [1.0, 1.1, 1.2], [1.2, 1.0], [1, 1], [1,1,1])
@@ -170,7 +204,8 @@ def neighbors(utilities, budgets: list[float], prices: list[float],
     logger.debug('neighbors function')
 
     neighbors_list = []
-    placement = max_utilities(utilities, budgets, prices, agent_capacity)
+    if placement is None:
+        placement = max_utilities(utilities, budgets, prices, agent_capacity)
     placement_sum = np.sum(placement, axis=0)
 
     # 1) find neighbor by gradiant:
@@ -198,34 +233,13 @@ def neighbors(utilities, budgets: list[float], prices: list[float],
                 if placement[agent][item] == 1:
 
                     # 2.1) Looking for the package with the maximum value that *does not* contain the current course:
-                    x1 = cp.Variable(shape=(courses_num, 1), boolean=True)
-                    x1_price = sum(np.array(prices) @ x1)
-                    x1_utility = np.array(utilities[agent]) @ x1
-                    # x1_utility = sum([utilities[student][item] * x1[item] for item in range(len(courses_num))])
-                    objective1 = cp.Maximize(x1_utility)
-                    constraints = [
-                        x1_price <= budgets[agent],
-                        x1[item] == 0,
-                        sum(x1) <= agent_capacity[agent]
-                    ]
-                    prob = cp.Problem(objective1, constraints)
-                    prob.solve()
+                    best_without_item = best_affordable_schedule(utilities[agent], agent_capacity[agent], np.asarray(prices, dtype=float), budgets[agent], forbidden_items={item})
                     # The maximum value of the package without the current course for the current student:
-                    O1 = prob.value
+                    O1 = sum(utilities[agent][other] for other in best_without_item)
                     logger.info('The maximum value without course %g for student %g is: %g', item, agent, O1)
 
                     # 2.2) Looking for the package with the minimum price whose value is greater than O1 and contains the current course:
-                    x2 = cp.Variable(shape=(courses_num, 1), boolean=True)
-                    objective2 = cp.Minimize(np.array(prices) @ x2)
-                    constraints = [
-                        sum(np.array(utilities[agent]) @ x2) >= O1 + Epsilon,
-                        # sum([utilities[student][item] * x2[item] for item in range(len(courses_num))]) >= O1 + Epsilon,
-                        x2[item] == 1,
-                        sum(x2) <= agent_capacity[agent]
-                    ]
-                    prob = cp.Problem(objective2, constraints)
-                    prob.solve()
-                    O2 = prob.value
+                    O2 = min_price_with_value(utilities[agent], agent_capacity[agent], prices, O1 + Epsilon, item)
                     logger.info('The minimum price with course %g for student %g is: %g', item, agent, O2)
 
                     if (budgets[agent] - O2 + Epsilon) < pi:
@@ -291,20 +305,45 @@ def max_utility(utility: list[float], budget: float, prices: list[float], capaci
     [0, 1, 0, 0, 0, 1]
     """
 
-    size = len(utility)
-    # Create binary variables
-    x = cp.Variable(shape=(size, 1), boolean=True)
-    # Define the objective function
-    objective = cp.Maximize(np.array(utility) @ x)
-    # Add constraints
-    constraints = [
-        sum([prices[item] * x[item] for item in range(len(prices))]) <= budget,
-        sum(x) <= capacity_of_agent
-    ]
-    # Form and solve the problem
-    prob = cp.Problem(objective, constraints)
-    prob.solve()
-    return x.value.ravel().astype(int).tolist()
+    schedule = best_affordable_schedule(utility, capacity_of_agent, np.asarray(prices, dtype=float), budget)
+    return [1 if item in schedule else 0 for item in range(len(utility))]
+
+
+def min_price_with_value(utility: list[float], capacity_of_agent: int, prices: list[float], min_value: float, required_item: int) -> float:
+    """
+    The minimum price of a package that contains the required course, has at most capacity_of_agent courses,
+    and whose value is at least min_value (ignoring the budget); math.inf if there is no such package.
+    Solved by branch-and-bound over the courses sorted by price: a branch is cut when even its cheapest completion costs at least the best package found,
+    or when even its most valuable completion does not reach min_value.
+
+    >>> min_price_with_value([60, 30, 6, 4], 2, [1.1, 0.9, 0.1, 0.0], 35, 1)
+    1.0
+    >>> min_price_with_value([60, 30, 6, 4], 2, [1.1, 0.9, 0.1, 0.0], 62, 3)
+    1.1
+    >>> min_price_with_value([60, 30, 6, 4], 2, [1.1, 0.9, 0.1, 0.0], 100, 0)
+    inf
+    >>> min_price_with_value([60, 30, 6, 4], 2, [1, -1, 0, 0], 10, 0)
+    0
+    """
+    order = sorted((item for item in range(len(utility)) if item != required_item), key=lambda item: (prices[item], item))
+    best_price = math.inf
+    stack = [(0, 1, utility[required_item], prices[required_item])]     # (position in order, number of courses, value, price)
+    while stack:
+        position, size, value, price = stack.pop()
+        remaining_capacity = capacity_of_agent - size
+        next_positions = order[position:position + max(remaining_capacity, 0)]
+        if price + sum(min(prices[item], 0) for item in next_positions) >= best_price:   # the cheapest completion adds the most negative prices
+            continue
+        if value >= min_value:
+            best_price = min(best_price, price)
+            if len(next_positions) == 0 or prices[next_positions[0]] >= 0:       # adding courses can only increase the price
+                continue
+        elif len(next_positions) == 0 or value + sum(sorted((utility[item] for item in order[position:]), reverse=True)[:remaining_capacity]) < min_value:
+            continue
+        item = order[position]
+        stack.append((position + 1, size, value, price))                                        # skip the course
+        stack.append((position + 1, size + 1, value + utility[item], price + prices[item]))     # take the course (explored first)
+    return best_price
 
 
 def max_utilities(utilities: ValuationMatrix, budgets: list[float], prices: list[float], agent_capacity: list[int],
@@ -334,16 +373,22 @@ def max_utilities(utilities: ValuationMatrix, budgets: list[float], prices: list
 
     logger.debug('max_utilities function')
 
-    placements = []
-
-    # print("utilities: ", utilities)
-    # print("budgets: ", budgets)
-    # print("prices: ", prices)
-    # print("agent_capacity: ", agent_capacity)
-    for agent in utilities.agents():
-        placement: list[bool] = max_utility(utilities[agent], budgets[agent], prices, agent_capacity[agent])
-        placements.append(placement)
+    # Fast path for all students at once: the most valuable package (ignoring the budget) is the optimum whenever it is affordable.
+    agents = list(utilities.agents())
+    utility_matrix = np.array([utilities[agent] for agent in agents], dtype=float)
+    order = np.argsort(-utility_matrix, axis=1, kind="stable")
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(utility_matrix.shape[1])[None, :], axis=1)
+    top_packages = (ranks < np.array([agent_capacity[agent] for agent in agents])[:, None]) & (utility_matrix >= 0)
+    affordable = np.where(top_packages, np.asarray(prices, dtype=float)[None, :], 0).sum(axis=1) <= np.array([budgets[agent] for agent in agents])
 
+    placements = []
+    for index, agent in enumerate(agents):
+        if affordable[index]:
+            placements.append(top_packages[index].astype(int).tolist())
+        else:
+            placements.append(max_utility(utilities[agent], budgets[agent], prices, agent_capacity[agent]))
+    logger.debug('%d of %d packages were found without search', np.sum(affordable), len(agents))
     return placements
 
 
@@ -353,6 +398,7 @@ class Course_Bundle:
     The structure is intended to be used by the main function,
     which contains a priority queue, which needs to implement for
     the queue a comparison function between price vectors of packages.
+    The score is computed once, when the bundle is created; bundles are equal (and hashed) by their price vector.
 
     >>> course_bundle1 = Course_Bundle(ValuationMatrix([[60,30,6,4],[62,32,4,2]]),[1.1,1.0],[1.1,0.9,0.1,0.0],[1,1,1,1], [2,2])
     >>> course_bundle2 = Course_Bundle(ValuationMatrix([[36, 35, 13, 10, 4, 2], [1, 3, 43, 37, 7, 9], [5, 13, 12, 17, 25, 28]]), [1.3, 1.1, 1.5], [0.9, 0.3, 0.9, 1.1, 1.0, 0.2], [1,1,1,1,1,1], [2,2,2])
@@ -371,25 +417,30 @@ class Course_Bundle:
     """
 
     def __init__(self, utilities: ValuationMatrix, budgets: list[float], prices: list[float], 
-                 item_capacity: list[int], agent_capacity: list[int]):
+                 item_capacity: list[int], agent_capacity: list[int], placement: list[list[bool]] = None):
         self.utilities = utilities
         self.budgets = budgets
         self.prices = prices
         self.item_capacity = item_capacity
         self.agent_capacity = agent_capacity
-        self.placement = max_utilities(self.utilities, self.budgets, self.prices, self.agent_capacity)
+        self.placement = placement if placement is not None else max_utilities(self.utilities, self.budgets, self.prices, self.agent_capacity)
+        self.key = tuple(prices)
+        self._score = score(self.placement, self.item_capacity)
 
     def score(self):
-        return score(self.placement, self.item_capacity)
+        return self._score
 
     def neighbors(self):
-        return neighbors(self.utilities, self.budgets, self.prices, self.item_capacity, self.agent_capacity)
+        return neighbors(self.utilities, self.budgets, self.prices, self.item_capacity, self.agent_capacity, placement=self.placement)
 
     def __lt__(self, other):
-        return self.score() < other.score()
+        return self._score < other._score
 
     def __eq__(self, other):
-        return np.array_equal(np.array(self.prices), np.array(other.prices))
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
 
 if __name__ == '__main__':
@@ -402,6 +453,7 @@ if __name__ == '__main__':
     doctest.run_docstring_examples(max_utility, globals())
     doctest.run_docstring_examples(max_utilities, globals())
     doctest.run_docstring_examples(Course_Bundle, globals())
+    doctest.run_docstring_examples(evaluate_price_vectors, globals())
 
     from fairpyx.adaptors import divide_random_instance
     divide_random_instance(algorithm=general_course_allocation, 
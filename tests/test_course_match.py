@@ -0,0 +1,183 @@
+"""
+Test the building blocks of the Course Match algorithm on random instances.
+
+Since:  2026-10
+"""
+
+import pytest
+
+import numpy as np
+from itertools import combinations
+from fairpyx.algorithms.course_match.A_CEEI import find_preference_order_for_each_student
+from fairpyx.algorithms.course_match.demand_oracle import DemandOracle
+from fairpyx.algorithms.course_match.knapsack_demand import KnapsackDemandOracle
+from fairpyx.algorithms.course_match.preference_cache import PreferenceCache
+from fairpyx.algorithms.course_match.schedule_store import ScheduleStore
+from fairpyx.algorithms.course_match.remove_oversubscription import remove_oversubscription
+from fairpyx.algorithms.course_match.fairness_audit import FairnessAudit
+from fairpyx import Instance, AllocationBuilder
+
+NUM_OF_RANDOM_INSTANCES=10
+
+
+def all_schedules_sorted(valuation:dict, capacity:int, item_conflicts:dict, agent_conflicts:list)->list:
+    """
+    Reference implementation: enumerate all the feasible schedules, then sort them
+    by descending value, then by descending size, then lexicographically.
+    """
+    items = list(valuation.keys())
+    schedules = []
+    for size in range(1, capacity+1):
+        for schedule in combinations(items, size):
+            if any(item in agent_conflicts for item in schedule):
+                continue
+            if any(other in item_conflicts.get(item,[]) for item in schedule for other in schedule):
+                continue
+            schedules.append([1 if item in schedule else 0 for item in items])
+    value = lambda schedule: sum(valuation[item] for item,taken in zip(items,schedule) if taken)
+    return sorted(schedules, key=lambda schedule: (-value(schedule), -sum(schedule)))
+
+
+def random_course_match_input(random_seed:int):
+    np.random.seed(random_seed)
+    num_of_items = np.random.randint(3, 8)
+    items = [f"c{i+1}" for i in range(num_of_items)]
+    agents = [f"s{i+1}" for i in range(4)]
+    valuations = {agent: {item: int(np.random.choice([0, 10, 20, 30, 40])) for item in items} for agent in agents}
+    agent_capacities = {agent: int(np.random.randint(1, 4)) for agent in agents}
+    item_conflicts = {item: [] for item in items}
+    for _ in range(2):
+        first, second = np.random.choice(items, 2, replace=False)
+        item_conflicts[first].append(second)
+        item_conflicts[second].append(first)
+    agent_conflicts = {agent: list(np.random.choice(items, np.random.randint(0, 2), replace=False)) for agent in agents}
+    return valuations, agent_capacities, item_conflicts, agent_conflicts
+
+
+def test_lazy_preference_order_matches_full_enumeration():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        valuations, agent_capacities, item_conflicts, agent_conflicts = random_course_match_input(i)
+        preferred_schedules = find_preference_order_for_each_student(valuations, agent_capacities, item_conflicts, agent_conflicts)
+        for agent in agent_capacities:
+            expected = all_schedules_sorted(valuations[agent], agent_capacities[agent], item_conflicts, agent_conflicts[agent])
+            assert list(preferred_schedules[agent]) == expected, f"Seed {i}, agent {agent}"
+
+
+def test_demand_oracle_matches_linear_scan():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        valuations, agent_capacities, item_conflicts, agent_conflicts = random_course_match_input(i)
+        items = list(valuations["s1"].keys())
+        budget = {agent: 1 + np.random.uniform(0, 0.5) for agent in agent_capacities}
+        full_orders = {agent: all_schedules_sorted(valuations[agent], agent_capacities[agent], item_conflicts, agent_conflicts[agent]) for agent in agent_capacities}
+        preferred_schedules = find_preference_order_for_each_student(valuations, agent_capacities, item_conflicts, agent_conflicts)
+        oracle = DemandOracle(items, [1]*len(items), budget, preferred_schedules, initial_rows_per_student=1)
+        for _ in range(5):
+            prices = np.random.uniform(0, 1.5, len(items))
+            expected = []
+            for agent, schedules in full_orders.items():
+                affordable = [schedule for schedule in schedules if np.dot(schedule, prices) <= budget[agent]]
+                expected.append(affordable[0] if affordable else [0]*len(items))
+            assert oracle.best_schedules(prices) == expected, f"Seed {i}"
+
+
+def test_knapsack_backend_matches_ranking_backend():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        valuations, agent_capacities, item_conflicts, agent_conflicts = random_course_match_input(i)
+        items = list(valuations["s1"].keys())
+        budget = {agent: 1 + np.random.uniform(0, 0.5) for agent in agent_capacities}
+        preferred_schedules = find_preference_order_for_each_student(valuations, agent_capacities, item_conflicts, agent_conflicts)
+        ranking_oracle = DemandOracle(items, [1]*len(items), budget, preferred_schedules)
+        knapsack_oracle = KnapsackDemandOracle(items, [1]*len(items), budget, preferred_schedules)
+        for _ in range(10):
+            prices = np.random.uniform(0, 1.5, len(items))
+            assert knapsack_oracle.best_schedules(prices) == ranking_oracle.best_schedules(prices), f"Seed {i}"
+
+
+def test_incremental_demand_matches_full_computation():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        valuations, agent_capacities, item_conflicts, agent_conflicts = random_course_match_input(i)
+        items = list(valuations["s1"].keys())
+        budget = {agent: 1 + np.random.uniform(0, 0.5) for agent in agent_capacities}
+        preferred_schedules = find_preference_order_for_each_student(valuations, agent_capacities, item_conflicts, agent_conflicts)
+        oracle = DemandOracle(items, [1]*len(items), budget, preferred_schedules, initial_rows_per_student=1)
+        prices = np.random.uniform(0, 1.5, len(items))
+        incremental = oracle.incremental(prices)
+        for _ in range(20):
+            course = np.random.randint(len(items))
+            prices[course] = np.random.uniform(0, 1.5)
+            incremental.set_price(course, prices[course])
+            expected = np.sum(oracle.best_schedules(prices), axis=0)
+            assert list(incremental.demand) == list(expected), f"Seed {i}"
+
+
+def test_schedule_store_invalidates_only_changed_students(tmp_path):
+    valuations, agent_capacities, item_conflicts, agent_conflicts = random_course_match_input(0)
+    instance = Instance(valuations=valuations, agent_capacities=agent_capacities, item_conflicts=item_conflicts, agent_conflicts=agent_conflicts)
+    cache = PreferenceCache(instance, ScheduleStore(tmp_path))
+    for ranking in cache.rankings.values():
+        ranking.indices(0)
+    cache.save()
+
+    valuations["s1"] = {item: value + 5 for item, value in valuations["s1"].items()}
+    instance = Instance(valuations=valuations, agent_capacities=agent_capacities, item_conflicts=item_conflicts, agent_conflicts=agent_conflicts)
+    cache = PreferenceCache(instance, ScheduleStore(tmp_path))
+    assert {agent: ranking.num_of_stored for agent, ranking in cache.rankings.items()} == {"s1": 0, "s2": 1, "s3": 1, "s4": 1}
+    for agent in agent_capacities:
+        expected = all_schedules_sorted(valuations[agent], agent_capacities[agent], item_conflicts, agent_conflicts[agent])
+        assert list(cache[agent]) == expected, f"Agent {agent}"
+
+
+def test_pruning_does_not_change_remove_oversubscription():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        valuations, agent_capacities, item_conflicts, agent_conflicts = random_course_match_input(i)
+        instance = Instance(valuations=valuations, agent_capacities=agent_capacities, item_capacities=1, item_conflicts=item_conflicts, agent_conflicts=agent_conflicts)
+        budget = {agent: 1 + np.random.uniform(0, 0.5) for agent in agent_capacities}
+        initial_prices = {item: float(np.random.uniform(0, 0.5)) for item in instance.items}
+        results = [
+            remove_oversubscription(AllocationBuilder(instance), dict(initial_prices), budget, prune_schedules=prune_schedules)
+            for prune_schedules in (False, True)
+        ]
+        assert results[0] == results[1], f"Seed {i}"
+
+
+
+def test_knapsack_backend_does_not_change_remove_oversubscription():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        valuations, agent_capacities, item_conflicts, agent_conflicts = random_course_match_input(i)
+        instance = Instance(valuations=valuations, agent_capacities=agent_capacities, item_capacities=1, item_conflicts=item_conflicts, agent_conflicts=agent_conflicts)
+        budget = {agent: 1 + np.random.uniform(0, 0.5) for agent in agent_capacities}
+        initial_prices = {item: float(np.random.uniform(0, 0.5)) for item in instance.items}
+        results = [
+            remove_oversubscription(AllocationBuilder(instance), dict(initial_prices), budget, preference_cache=PreferenceCache(instance, backend=backend))
+            for backend in ("ranking", "knapsack")
+        ]
+        assert results[0] == results[1], f"Seed {i}"
+
+
+def test_fairness_audit_matches_pairwise_check():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        valuations, agent_capacities, item_conflicts, agent_conflicts = random_course_match_input(i)
+        instance = Instance(valuations=valuations, agent_capacities=agent_capacities)
+        items = list(valuations["s1"].keys())
+        allocation = {agent: [item for item in items if np.random.random() < 0.4] for agent in agent_capacities}
+        budget = {agent: 1 + np.random.uniform(0, 0.5) for agent in agent_capacities}
+        value = lambda agent, bundle: sum(valuations[agent][item] for item in bundle)
+        expected = {"envy": set(), "ef1": set(), "eftb": set(), "budget_weighted_envy": set()}
+        for agent in allocation:
+            for other in allocation:
+                envy = value(agent, allocation[other]) - value(agent, allocation[agent])
+                if envy > 0:
+                    expected["envy"].add((agent, other))
+                    if all(envy - valuations[agent][item] > 0 for item in allocation[other]):
+                        expected["ef1"].add((agent, other))
+                    if budget[agent] > budget[other]:
+                        expected["eftb"].add((agent, other))
+                if value(agent, allocation[other]) * budget[agent] / budget[other] - value(agent, allocation[agent]) > 1e-9:
+                    expected["budget_weighted_envy"].add((agent, other))
+        audit = FairnessAudit(instance, allocation, budget, tile_size=1)
+        for criterion, pairs in expected.items():
+            assert {(agent, other) for agent, other, _ in audit.violations(criterion)} == pairs, f"Seed {i}, {criterion}"
+
+
+if __name__ == "__main__":
+     pytest.main(["-v",__file__])
@@ -28,6 +28,23 @@ def test_feasibility():
         fairpyx.validate_allocation(instance, allocation, title=f"Seed {i}, adjusted")
 
 
+def test_incremental_network_matches_networkx():
+    from fairpyx.utils.graph_utils import IncrementalMatchingNetwork, many_to_many_matching_using_network_flow
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        np.random.seed(i)
+        weights = np.random.randint(-3, 10, (30, 8)).astype(float)
+        item_capacities = np.random.randint(0, 5, 8)
+        active_agents = np.random.random(30) < 0.8
+        network = IncrementalMatchingNetwork(np.where(weights >= 0, weights, -np.inf))
+        assigned = network.assignment(*network.match(active_agents.astype(int), item_capacities))
+        expected = many_to_many_matching_using_network_flow(
+            items=range(8), item_capacity=lambda item: int(item_capacities[item]),
+            agents=np.flatnonzero(active_agents).tolist(), agent_capacity=lambda _:1,
+            agent_item_value=lambda agent,item: weights[agent,item])
+        assert (assigned>=0).sum() == sum(len(bundle) for bundle in expected.values()), f"Seed {i}"
+        assert sum(weights[agent,item] for agent,item in enumerate(assigned) if item>=0) == sum(weights[agent,item] for agent,bundle in expected.items() for item in bundle), f"Seed {i}"
+
+
 if __name__ == "__main__":
      pytest.main(["-v",__file__])
 
@@ -9,6 +9,7 @@ import pytest
 
 import fairpyx
 import numpy as np
+from fairpyx.algorithms.picking_sequence import picking_sequence
 
 NUM_OF_RANDOM_INSTANCES=10
 
@@ -28,6 +29,43 @@ def test_feasibility():
         fairpyx.validate_allocation(instance, allocation, title=f"Seed {i}, bidirectional round-robin")
 
 
+def reference_picking_sequence(alloc, agent_order:list):
+    # The straightforward implementation: in each turn, scan all the available items.
+    from itertools import cycle
+    for agent in cycle(agent_order):
+        if alloc.isdone() or not any(agent in alloc.remaining_agent_capacities for agent in agent_order):
+            break
+        if not agent in alloc.remaining_agent_capacities:
+            continue
+        potential_items_for_agent = alloc.remaining_items_for_agent(agent)
+        if len(potential_items_for_agent)==0:
+            alloc.remove_agent_from_loop(agent)
+            continue
+        alloc.give(agent, max(potential_items_for_agent, key=lambda item: alloc.effective_value(agent,item)))
+
+
+def test_picking_sequence_matches_reference_implementation():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        np.random.seed(i)
+        instance = fairpyx.Instance.random_uniform(
+            num_of_agents=70, num_of_items=10, normalized_sum_of_values=10,
+            agent_capacity_bounds=[2,6], 
+            item_capacity_bounds=[20,40], 
+            item_base_value_bounds=[1,1000],
+            item_subjective_ratio_bounds=[0.5, 1.5]
+            )
+        items = list(instance.items)
+        instance = fairpyx.Instance(
+            valuations=instance._valuations, agent_capacities=instance._agent_capacities, item_capacities=instance._item_capacities,
+            item_conflicts={items[0]: [items[1]], items[1]: [items[0]]},
+            agent_conflicts={agent: [items[np.random.randint(len(items))]] for agent in instance.agents})
+        agent_order = list(instance.agents)
+        for order in (agent_order, agent_order + list(reversed(agent_order))):
+            expected = fairpyx.divide(reference_picking_sequence, instance=instance, agent_order=order)
+            assert fairpyx.divide(picking_sequence, instance=instance, agent_order=order) == expected, f"Seed {i}"
+            assert fairpyx.divide(picking_sequence, instance=instance.compile(), agent_order=order) == expected, f"Seed {i}"
+
+
 if __name__ == "__main__":
      pytest.main(["-v",__file__])
 
@@ -26,6 +26,40 @@ def test_feasibility():
         fairpyx.validate_allocation(instance, allocation, title=f"Seed {i}")
 
 
+def test_arrays_backend_matches_networkx():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        np.random.seed(i)
+        instance = fairpyx.Instance.random_uniform(
+            num_of_agents=30, num_of_items=8, normalized_sum_of_values=1000,
+            agent_capacity_bounds=[1,4], 
+            item_capacity_bounds=[1,10], 
+            item_base_value_bounds=[1,1000],
+            item_subjective_ratio_bounds=[0.5, 1.5]
+            )
+        welfares = []
+        for backend in ["arrays", "networkx"]:
+            allocation = fairpyx.divide(fairpyx.algorithms.utilitarian_matching, instance=instance, backend=backend)
+            fairpyx.validate_allocation(instance, allocation, title=f"Seed {i}, {backend}")
+            welfares.append(sum(instance.agent_bundle_value(agent, bundle) for agent,bundle in allocation.items()))
+        assert welfares[0] == pytest.approx(welfares[1]), f"Seed {i}"
+
+
+def test_sparse_mode_keeps_the_maximum_welfare():
+    for i in range(NUM_OF_RANDOM_INSTANCES):
+        np.random.seed(i)
+        valuations = np.random.randint(1, 100, (30, 8)) * (np.random.random((30, 8)) < 0.3)
+        instance = fairpyx.Instance(valuations=valuations, agent_capacities=3, item_capacities=np.random.randint(1, 6, 8).tolist()).compile(sparse=True)
+        welfares = []
+        for backend in ["arrays", "networkx"]:
+            allocation = fairpyx.divide(fairpyx.algorithms.utilitarian_matching, instance=instance, backend=backend, sparse=True)
+            fairpyx.validate_allocation(instance, allocation, title=f"Seed {i}, {backend}")
+            assert all(instance.agent_item_value(agent, item) > 0 for agent,bundle in allocation.items() for item in bundle)
+            welfares.append(sum(instance.agent_bundle_value(agent, bundle) for agent,bundle in allocation.items()))
+        assert welfares[0] == welfares[1], f"Seed {i}"
+        dense_allocation = fairpyx.divide(fairpyx.algorithms.utilitarian_matching, instance=instance)
+        assert welfares[0] >= sum(instance.agent_bundle_value(agent, bundle) for agent,bundle in dense_allocation.items()), f"Seed {i}"
+
+
 if __name__ == "__main__":
      pytest.main(["-v",__file__])
 